@@ -3,9 +3,12 @@ import logging
 import atexit
 from utils.content_generation import ContentGeneration
 from utils.graphic.chart_generation import ChartGeneration
-import utils.ppt_generation as ppt_gen
+from utils.ui_config import configure_slide_editor, get_client_id, show_jobs, show_thumbnails
+from utils.job_queue import job_queue_from_env
 from utils.clear_tmp import clear_temp_files
+from utils import metrics
 import asyncio
+import time
 
 
 
@@ -20,34 +23,50 @@ L, R = st.columns(2)
 with L:
     title = st.text_input("タイトル")
 with R:
-    num_of_slides = st.number_input("内容スライド数", min_value=1, max_value=20)
+    large = st.checkbox("大規模モード（最大300枚）")
+    # オフの場合は同じタイトル・テキストでも毎回新しい資料を生成
+    reuse = st.checkbox("同じ入力の生成結果を再利用")
+    num_of_slides = st.number_input("内容スライド数", min_value=1, max_value=300 if large else 20)
 outline = st.text_area("テキストを入力:", height=300, max_chars=1000)
 file_upload = st.file_uploader("テキストファイルをアップロード", accept_multiple_files=False)
 
-# Generate PPT
+# Generate PPT in the background job queue
+queue = job_queue_from_env()
+client_id = get_client_id()
 if st.button("資料生成"):
     text = file_upload.read().decode() if file_upload else ""
-    outline = outline + text
+    queue.submit({"title": title, "outline": outline + text, "num_of_slides": num_of_slides, "large": large, "use_cache": reuse}, owner=client_id)
+
+active = show_jobs(queue, client_id)
+
+# Edit a single slide without rebuilding the deck
+if 'deck' in st.session_state:
+    deck = st.session_state['deck']
+    index, action, values = configure_slide_editor(deck)
+    if action is not None:
+        with st.spinner("スライドを更新中..."):
+            deck.edit_slide(index, title=values['title'], content=values['content'])
+            if action == "regenerate_text":
+                deck.regenerate_text(index, ContentGeneration(deck_id=deck.deck_id), instruction=values['instruction'])
+            if action != "edit":
+                asyncio.run(deck.regenerate_chart(index, ChartGeneration(deck_id=deck.deck_id), force=True))
+            st.session_state['binary_ppt'] = deck.render()
     
-    with st.spinner("資料生成中..."):
-        cg = ContentGeneration()
-        content_generated = cg.generate_content(title=title, outline=outline, num_of_slides=num_of_slides)
-        
-        # Graphic generation
-        gg = ChartGeneration()
-        image_paths = []
-        for i, slide in enumerate(content_generated.values()):
-            content = slide['content']
-            graphic_prompt = slide.get('graphic_prompt', '')
-            image_path = asyncio.run(gg.run(content=content, chart_type='mindmap', custom_prompt=graphic_prompt, filename=f"slide_{i+1}"))
-            image_paths.append(image_path)
-        
-        binary_ppt = ppt_gen.generate_ppt(title=title, content=content_generated, num_of_slides=num_of_slides, img_path=image_paths)
-        
+    show_thumbnails(deck)
+
     # Download PPT
     download = st.download_button(label="資料ダウンロード", 
-                                  data=binary_ppt, 
-                                  file_name=f'{title}.pptx')   
+                                  data=st.session_state['binary_ppt'], 
+                                  file_name=f'{deck.title}.pptx')   
     
+# Metrics
+with st.sidebar.expander("メトリクス"):
+    st.json(metrics.snapshot())
+
+# Poll job progress
+if active:
+    time.sleep(2)
+    st.rerun()
+
 # Clear tmp file on exit
 atexit.register(clear_temp_files)
@@ -2,14 +2,22 @@ import streamlit as st
 import logging
 import atexit
 import asyncio
+import time
+import uuid
 import base64
 import os
 from utils.content_generation import ContentGeneration
 from utils.graphic.chart_generation import ChartGeneration
-import utils.ppt_generation as ppt_gen
 from utils.clear_tmp import clear_temp_files
+from utils import metrics
+from utils.memory_accounting import memory_tracker_from_env
+from utils.profiling import maybe_profile, request_allowed
+from utils.deadline import lida_deadline_from_env
 from utils.graph_gen import GraphGeneration, VisualizationProcessor, PPTXGenerator, load_settings
-from utils.ui_config import configure_sidebar
+from utils.ui_config import configure_sidebar, configure_slide_editor, get_client_id, show_jobs, show_thumbnails, wait_for_task
+from utils.job_queue import job_queue_from_env
+from utils.viz_prefetch import prefetcher_from_env
+from utils.viz_dedup import dedup_visualizations
 from lida import Manager, llm
 from lida.datamodel import Goal
 from PIL import Image
@@ -26,6 +34,8 @@ openai_key = load_settings('.env')
 vp = VisualizationProcessor()
 ppt = PPTXGenerator()
 gg = GraphGeneration(openai_key)
+prefetcher = prefetcher_from_env()
+memory = memory_tracker_from_env()
 
 def get_openai_key(openai_key=None):
     if openai_key is None:
@@ -43,10 +53,6 @@ def initialize_session_state(defaults):
         if key not in st.session_state:
             st.session_state[key] = value
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
-
 def main():
     #global gg
     st.title("プレゼン資料生成📑")
@@ -64,31 +70,52 @@ def main():
         'viz_titles': [],
         'goal_generation_mode': None,
         'selected_viz': None,
-        'generated_graphs': []
+        'generated_graphs': [],
+        'session_id': str(uuid.uuid4())
     })
 
     if 'api_key' not in st.session_state or st.session_state.api_key != openai_key:
         st.session_state.api_key = openai_key
         st.session_state.lida = Manager(text_gen=llm("openai", api_key=openai_key))
+        memory.watch(st.session_state['session_id'], st.session_state.lida, "lida_manager")
 
-    gg = GraphGeneration(openai_key)
+    # 制限時間は操作（ボタンを押した実行）ごとに数え、バックグラウンドの処理もこの時間で重複の補充や説明の生成を省く
+    gg = GraphGeneration(openai_key, session_id=st.session_state['session_id'], deadline=lida_deadline_from_env(st.session_state['session_id']))
 
     selected_model, temperature, use_cache, uploaded_file_path, selected_method, selected_library, num_visualizations = configure_sidebar()
+    visualization_params = {
+        "model": selected_model,
+        "num_visualizations": num_visualizations,
+        "temperature": temperature,
+        "use_cache": use_cache,
+        "library": selected_library,
+        "fill": st.session_state.get("fill_duplicates", False),
+    }
 
     # Graph generation in sidebar
     st.sidebar.header("グラフ生成")
     if st.sidebar.button('データの要約を生成'):
-        with st.spinner('データを要約しています...'):
-            st.session_state['summary'] = gg.generate_summary(
-                manager=st.session_state.lida,
-                uploaded_file_path=uploaded_file_path,
-                summary_method=selected_method,
-                model=selected_model,
-                temperature=temperature,
-                use_cache=use_cache
-            )
+        # 設定を変えて押し直した場合は、前回の要約の生成を取り消す
+        gg.generate_summary_async(
+            manager=st.session_state.lida,
+            uploaded_file_path=uploaded_file_path,
+            summary_method=selected_method,
+            model=selected_model,
+            temperature=temperature,
+            use_cache=use_cache
+        )
+    # 他のウィジェットの操作で待機が中断された場合も、次の実行で同じ処理の結果を受け取る
+    summary = wait_for_task(gg.tasks, st.session_state['session_id'], "lida_summary", 'データを要約しています...')
+    if summary is not None:
+        st.session_state['summary'] = summary
 
     if st.session_state.summary:
+        if st.sidebar.button('LLMを使わずにグラフを生成'):
+            # 列の型と値の種類数から決まった形式のグラフを作成（LIDAのグラフがある場合は後ろに追加）
+            visualizations = st.session_state['visualizations'] or []
+            quick = vp.quick_visualizations(uploaded_file_path, st.session_state.summary)
+            st.session_state['visualizations'] = visualizations + dedup_visualizations(quick, seen=visualizations)
+
         st.sidebar.write("## ゴール設定")
         st.session_state['goal_generation_mode'] = st.sidebar.radio(
             "ゴール生成か、手動入力のどちらかを選んでください",
@@ -96,18 +123,29 @@ def main():
         )
 
         if st.session_state['goal_generation_mode'] == 'Generate':
+            prefetch = st.sidebar.checkbox("すべてのゴールのグラフを先に生成", key="prefetch_visualizations")
             if st.sidebar.button('ゴールを生成'):
-                with st.spinner('ゴールを生成しています...'):
-                    st.session_state['goals'] = gg.generate_goals(
-                        manager=st.session_state.lida,
-                        summary=st.session_state['summary'],
-                        num_goals=3,
-                        model=selected_model,
-                        temperature=temperature,
-                        use_cache=use_cache
+                gg.generate_goals_async(
+                    manager=st.session_state.lida,
+                    summary=st.session_state['summary'],
+                    num_goals=3,
+                    model=selected_model,
+                    temperature=temperature,
+                    use_cache=use_cache
+                )
+            goals = wait_for_task(gg.tasks, st.session_state['session_id'], "lida_goals", 'ゴールを生成しています...')
+            if goals is not None:
+                st.session_state['goals'] = goals
+                if prefetch:
+                    # ゴールを選んでいる間に、すべてのゴールのグラフをバックグラウンドで生成
+                    prefetcher.start(
+                        st.session_state['session_id'], gg, st.session_state.lida, st.session_state['summary'],
+                        [goal.question for goal in st.session_state['goals']],
+                        **visualization_params
                     )
-                    goal_options = [goal.question for goal in st.session_state['goals']]
-                    st.session_state['selected_goal'] = st.sidebar.selectbox("以下からゴールを選択してください", goal_options)
+            if st.session_state['goals']:
+                goal_options = [goal.question for goal in st.session_state['goals']]
+                st.session_state['selected_goal'] = st.sidebar.selectbox("以下からゴールを選択してください", goal_options)
         else:
             if st.session_state['selected_goal'] is None:
                 user_goal = st.sidebar.text_input("あなたのゴールを記述してください")
@@ -117,21 +155,32 @@ def main():
         if st.session_state['selected_goal'] is not None:
             st.sidebar.write("選択されたゴール:")
             st.sidebar.write(st.session_state['selected_goal'])
+            st.sidebar.checkbox("重複したグラフを作り直す", key="fill_duplicates")
             if st.sidebar.button('グラフを生成'):
                 with st.spinner('グラフを生成しています...'):
-                    st.session_state['visualizations'] = gg.generate_visualizations(
+                    visualizations = prefetcher.take(
+                        st.session_state['session_id'], st.session_state.selected_goal, **visualization_params
+                    )
+                if visualizations is None:
+                    gg.generate_visualizations_async(
                         manager=st.session_state.lida,
                         summary=st.session_state.summary,
                         goal=st.session_state.selected_goal,
-                        model=selected_model,
-                        num_visualizations=num_visualizations,
-                        temperature=temperature,
-                        use_cache=use_cache,
-                        library=selected_library
+                        **visualization_params
                     )
+                else:
+                    # 先読みした結果を使う場合は、待っている前回のリクエストの結果で上書きしない
+                    gg.tasks.cancel(st.session_state['session_id'], "lida_visualize")
+            else:
+                visualizations = None
+            if visualizations is None:
+                visualizations = wait_for_task(gg.tasks, st.session_state['session_id'], "lida_visualize", 'グラフを生成しています...')
+            if visualizations is not None:
+                st.session_state['visualizations'] = visualizations
+                for visualization in visualizations:
+                    memory.watch(st.session_state['session_id'], visualization, "lida_visualization")
 
         if st.session_state['visualizations'] is not None:
-            file_paths = vp.render_visualizations(st.session_state['visualizations'])
             st.session_state['viz_titles'] = [f'Visualization {i+1}' for i in range(len(st.session_state['visualizations']))]
             st.session_state['selected_viz_title'] = st.sidebar.selectbox(
                 '選択して詳細表示',
@@ -144,9 +193,11 @@ def main():
             )
             
             if selected_index is not None:
-                base64_image = encode_image(file_paths[selected_index])
+                # 一時ファイル（temp_visualization_N.png）は全セッションで同じ名前になり、他のセッションが書き込み中のファイルを読むことがあるため、メモリ上の画像を使う
+                base64_image = st.session_state['selected_viz'].raster
                 image_data = base64.b64decode(base64_image)
                 image = Image.open(BytesIO(image_data))
+                memory.watch(st.session_state['session_id'], image, "pil_image")
                 st.sidebar.image(image, use_column_width=True)
             
             if st.sidebar.button('グラフを決定'):
@@ -165,7 +216,10 @@ def main():
 
     with col1:
         title = st.text_input("タイトル")
-        num_of_slides = st.number_input("内容スライド数", min_value=1, max_value=20)
+        large = st.checkbox("大規模モード（最大300枚）")
+        # オフの場合は同じタイトル・テキストでも毎回新しい資料を生成
+        reuse = st.checkbox("同じ入力の生成結果を再利用")
+        num_of_slides = st.number_input("内容スライド数", min_value=1, max_value=300 if large else 20)
         outline = st.text_area("テキストを入力:", height=300, max_chars=1000)
         file_upload = st.file_uploader("テキストファイルをアップロード", accept_multiple_files=False)
 
@@ -178,43 +232,77 @@ def main():
             # Base64エンコードされた画像をデコードしてPIL Imageオブジェクトに変換
             image_data = base64.b64decode(graph['base64_image'])
             image = Image.open(BytesIO(image_data))
+            memory.watch(st.session_state['session_id'], image, "pil_image")
         
             # PIL ImageオブジェクトをStreamlitで表示
             st.image(image, use_column_width=True)
 
-    # Generate PPT
+    # Generate PPT in the background job queue
+    queue = job_queue_from_env()
+    client_id = get_client_id()
     if st.button("資料生成"):
         text = file_upload.read().decode() if file_upload else ""
-        outline = outline + text
-        
-        with st.spinner("資料生成中..."):
-            cg = ContentGeneration()
-            content_generated = cg.generate_content(title=title, outline=outline, num_of_slides=num_of_slides)
-            
-            # Graphic generation
-            gg = ChartGeneration()
-            image_paths = []
-            for i, slide in enumerate(content_generated.values()):
-                content = slide['content']
-                graphic_prompt = slide.get('graphic_prompt', '')
-                image_path = asyncio.run(gg.run(content=content, chart_type='mindmap', custom_prompt=graphic_prompt, filename=f"slide_{i+1}"))
-                image_paths.append(image_path)
-            
-            binary_ppt = ppt_gen.generate_ppt(
-                title=title, 
-                content=content_generated, 
-                num_of_slides=len(content_generated), 
-                img_path=image_paths,
-                generated_graphs=st.session_state['generated_graphs']
-                )   
+        queue.submit({
+            "title": title,
+            "outline": outline + text,
+            "num_of_slides": num_of_slides,
+            "large": large,
+            "use_cache": reuse,
+            "generated_graphs": [graph['base64_image'] for graph in st.session_state['generated_graphs']],
+            "profile": requested_profile()
+        }, owner=client_id)
+
+    active = show_jobs(queue, client_id)
+
+    # Edit a single slide without rebuilding the deck
+    if 'deck' in st.session_state:
+        deck = st.session_state['deck']
+        index, action, values = configure_slide_editor(deck)
+        if action is not None:
+            with st.spinner("スライドを更新中..."):
+                deck.edit_slide(index, title=values['title'], content=values['content'])
+                if action == "regenerate_text":
+                    deck.regenerate_text(index, ContentGeneration(deck_id=deck.deck_id), instruction=values['instruction'])
+                if action != "edit":
+                    asyncio.run(deck.regenerate_chart(index, ChartGeneration(deck_id=deck.deck_id), force=True))
+                st.session_state['binary_ppt'] = deck.render()
+                memory.watch(st.session_state['session_id'], st.session_state['binary_ppt'], "deck_bytes")
            
+        show_thumbnails(deck)
+
         # Download PPT
         download = st.download_button(label="資料ダウンロード", 
-                                      data=binary_ppt, 
-                                      file_name=f'{title}.pptx')   
+                                      data=st.session_state['binary_ppt'], 
+                                      file_name=f'{deck.title}.pptx')   
+
+    with st.sidebar.expander("メトリクス"):
+        st.json(metrics.snapshot())
+
+    return active
+
+def requested_profile():
+    # URLに?profile=sample（またはcprofile）と&profile_token=（環境変数PROFILE_TOKENSのいずれか）を付けると、
+    # その画面の処理と資料生成ジョブをプロファイル。画面は同じURLにつき1回（&profile_id=を変えると再度プロファイル）
+    params = st.experimental_get_query_params()
+    if not request_allowed(params.get("profile_token", [None])[0]):
+        return None
+    return params.get("profile", [None])[0]
+
+
+def profile_request_id():
+    params = st.experimental_get_query_params()
+    return f"ui:{params.get('client', [None])[0]}:{params.get('profile_id', [None])[0]}"
 
 # Clear tmp file on exit
 atexit.register(clear_temp_files)
 
 if __name__ == "__main__":
-    main()
+    # MEMORY_TRACKINGが有効な場合は、実行ごとのメモリの増加とセッションの状態のサイズを記録
+    with maybe_profile(f"ui_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}", requested_profile(), request_id=profile_request_id()), \
+            memory.rerun(st.session_state):
+        active = main()
+
+    # Poll job progress
+    if active:
+        time.sleep(2)
+        st.rerun()
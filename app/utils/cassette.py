@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from utils import metrics
+from utils.shared_cache import fingerprint
+
+RECORD = "record"
+REPLAY = "replay"
+
+
+class CassetteMissError(KeyError):
+    pass
+
+
+def _to_json(value):
+    return json.loads(json.dumps(value, ensure_ascii=False, default=str))
+
+
+class Cassette:
+    def __init__(self, path: str, mode: str = REPLAY, latency_scale: float = 1.0) -> None:
+        """OpenAIとのやり取りを記録・再生するカセット（JSON Lines形式のファイル）
+
+        記録モードでは、リクエスト・レスポンス・レイテンシを1行ずつ追記する。
+        再生モードでは、同じリクエストに記録したレスポンスを返し、記録したレイテンシだけ待つ。
+        同じリクエストが複数回記録されている場合は記録順に返し、使い切った後は最後のレスポンスを返す。
+
+        Args:
+            path (str): カセットファイルのパス
+            mode (str): "record"または"replay"
+            latency_scale (float): 再生時のレイテンシの倍率（0の場合は待たない）
+
+        """
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Unknown cassette mode: {mode}. Choose from {RECORD}, {REPLAY}")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self._lock = threading.Lock()
+        self._interactions = defaultdict(deque)
+        self._last = {}
+        self._counts = {"recorded": 0, "replayed": 0, "missed": 0}
+
+        if mode == REPLAY:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        interaction = json.loads(line)
+                        self._interactions[interaction["key"]].append(interaction)
+            logging.info(f"Cassette loaded: {sum(len(queue) for queue in self._interactions.values())} interactions from {path}")
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def key(self, kind: str, request) -> str:
+        return f"{kind}:{fingerprint(request)}"
+
+    def _append(self, kind: str, stage: str, request, response: dict, latency: float) -> None:
+        interaction = {
+            "key": self.key(kind, request),
+            "kind": kind,
+            "stage": stage,
+            "request": _to_json(request),
+            "response": response,
+            "latency": latency,
+            "timestamp": time.time(),
+        }
+        line = json.dumps(interaction, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self._counts["recorded"] += 1
+
+    def _next(self, kind: str, request) -> dict:
+        key = self.key(kind, request)
+        with self._lock:
+            queue = self._interactions.get(key)
+            if queue:
+                self._last[key] = queue.popleft()
+            interaction = self._last.get(key)
+            if interaction is None:
+                self._counts["missed"] += 1
+                raise CassetteMissError(f"No recorded {kind} interaction for request {key}")
+            self._counts["replayed"] += 1
+        return interaction
+
+    def call(self, kind: str, stage: str, request, call, encode, decode):
+        """リクエストを記録または再生
+
+        Args:
+            kind (str): 呼び出しの種類（openai_chat, llmx）
+            stage (str): 処理段階
+            request: リクエスト（キーの作成と記録に使用）
+            call (callable): 実際のAPI呼び出し
+            encode (callable): レスポンスをJSONに変換する関数
+            decode (callable): JSONからレスポンスを復元する関数
+
+        Returns:
+            レスポンス
+
+        """
+        if self.mode == REPLAY:
+            interaction = self._next(kind, request)
+            time.sleep(interaction["latency"] * self.latency_scale)
+            return decode(interaction["response"])
+
+        start = time.time()
+        response = call()
+        self._append(kind, stage, request, encode(response), time.time() - start)
+        return response
+
+    async def acall(self, kind: str, stage: str, request, call, encode, decode):
+        """callの非同期版（callはコルーチンを返す関数）"""
+        if self.mode == REPLAY:
+            interaction = self._next(kind, request)
+            await asyncio.sleep(interaction["latency"] * self.latency_scale)
+            return decode(interaction["response"])
+
+        start = time.time()
+        response = await call()
+        self._append(kind, stage, request, encode(response), time.time() - start)
+        return response
+
+    def metrics(self) -> dict:
+        with self._lock:
+            result = dict(self._counts)
+        result.update({"mode": self.mode, "path": self.path, "latency_scale": self.latency_scale})
+        return result
+
+
+def encode_chat_completion(response) -> dict:
+    return response.model_dump(mode="json")
+
+
+def decode_chat_completion(data: dict):
+    from openai.types.chat import ChatCompletion
+    return ChatCompletion.model_validate(data)
+
+
+class CassetteTextGenerator:
+    def __init__(self, text_gen, cassette: Cassette, stage=None) -> None:
+        """llmxのTextGeneratorをラップしてLIDAのやり取りを記録・再生する
+
+        Args:
+            text_gen (TextGenerator): ラップするTextGenerator
+            cassette (Cassette): 記録・再生先
+            stage (callable): 現在の処理段階を返す関数（記録用）
+
+        """
+        self.text_gen = text_gen
+        self.cassette = cassette
+        self.stage = stage or (lambda: "lida")
+
+    def __getattr__(self, name):
+        return getattr(self.text_gen, name)
+
+    def generate(self, messages, config, **kwargs):
+        from llmx.datamodel import Message, TextGenerationConfig, TextGenerationResponse
+
+        def encode(response) -> dict:
+            return _to_json({
+                "text": [dict(message) for message in response.text],
+                "config": dict(response.config) if response.config is not None else None,
+                "usage": response.usage,
+            })
+
+        def decode(data: dict):
+            return TextGenerationResponse(
+                text=[Message(**message) for message in data["text"]],
+                config=TextGenerationConfig(**data["config"]) if data["config"] is not None else config,
+                usage=data["usage"],
+            )
+
+        request = {"messages": messages, "config": dict(config)}
+        return self.cassette.call(
+            "llmx", self.stage(), request,
+            lambda: self.text_gen.generate(messages=messages, config=config, **kwargs),
+            encode, decode,
+        )
+
+
+_default_cassette = None
+_default_lock = threading.Lock()
+
+
+def cassette_from_env() -> Cassette:
+    """環境変数LLM_CASSETTEが指定されている場合にプロセス共通のCassetteを取得
+
+    LLM_CASSETTE_MODE（record, replay）、LLM_CASSETTE_LATENCY_SCALE（再生時のレイテンシの倍率）に従う。
+
+    Returns:
+        Cassette: 指定がない場合はNone
+
+    """
+    global _default_cassette
+    path = os.getenv("LLM_CASSETTE")
+    if not path:
+        return None
+
+    with _default_lock:
+        if _default_cassette is None:
+            _default_cassette = Cassette(
+                path,
+                mode=os.getenv("LLM_CASSETTE_MODE", REPLAY),
+                latency_scale=float(os.getenv("LLM_CASSETTE_LATENCY_SCALE", "1.0")),
+            )
+            metrics.register("cassette", _default_cassette.metrics)
+    return _default_cassette
@@ -5,44 +5,61 @@ from dotenv import load_dotenv
 import logging
 import json
 import time
-import re
+from utils.hedging import hedger_from_env
+from utils.model_router import router_from_env
+from utils.shared_cache import cache_from_env
+from utils.cassette import cassette_from_env, decode_chat_completion, encode_chat_completion
+from utils.usage_ledger import ledger_from_env
+from utils.deadline import Deadline
+from utils import prompts
+from utils.structured_output import SLIDE_SCHEMA, parse_response, repair_json, stats as structured_stats, unwrap_slides, validate
 
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 client = OpenAI()
 logging.basicConfig(level=logging.INFO)
 
+def _ranges(indices: list) -> list:
+    """連続する番号を(最初の番号, 個数)にまとめる"""
+    ranges = []
+    for index in indices:
+        if ranges and ranges[-1][0] + ranges[-1][1] == index:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+        else:
+            ranges.append((index, 1))
+    return ranges
+
+
 class ContentGeneration:
-    def __init__(self) -> None:
-        self.example ="""
-        "slide1": {
-            "title": "生成型AI(ジェネラティブAI)とは",
-            "content": [
-                "生成型AIは学習データから新しいコンテンツを生成する人工知能の一種です。",
-                "自然言語処理、画像生成、音声合成など多岐にわたる応用が可能です。",
-                "代表的な技術にはGAN(Generative Adversarial Networks)や変分オートエンコーダーがあります。",
-                "データの内在するパターンを理解し、それに基づいて新しいデータを創出します。"
-            ],
-            "graphic_prompt": "AIのシンボル(人工知能の脳)がデジタル情報(0と1)を吸収している様子"
-            },
-        "slide2": {
-            "title": "ジェネラティブAIの応用例",
-            "content": [
-                "テキスト：チャットボット、物語や記事の自動生成、プログラムコードの作成補助。",
-                "画像：アート作品の生成、写真リアルなイメージの作成、顔写真の年齢変化シミュレーション。",
-                "音声：バーチャルアシスタントの応答音声生成、オーディオブック読み上げ、音楽作成。",
-                "予測分析：商品需要予測や金融市場予測などビジネスでの意思決定支援。"
-            ],
-            "graphic_prompt": "様々な応用分野（記事、ゲーム、音楽、教育）が回転する歯車として描かれるイメージ"
-        }
+    def __init__(self, hedger=None, ledger=None, deck_id: str = None, cache=None, deadline: Deadline = None, router=None) -> None:
+        """
+        Args:
+            hedger (RequestHedger): リクエストのヘッジ。未指定の場合は環境変数LLM_HEDGINGに従う
+            ledger (UsageLedger): トークン使用量の台帳。未指定の場合はプロセス共通の台帳
+            deck_id (str): 資料ID
+            cache (SharedCache): レプリカ間で共有するキャッシュ。未指定の場合は環境変数CACHE_BACKENDに従う
+            deadline (Deadline): 資料の制限時間（リクエストのタイムアウトに使用）。未指定の場合は無制限
+            router (ModelRouter): 段階ごとのモデルの振り分け。未指定の場合は環境変数MODEL_ROUTINGに従う
+
         """
+        self.deadline = deadline or Deadline()
+        self.router = router or router_from_env()
+        self.hedger = hedger or hedger_from_env()
+        self.ledger = ledger or ledger_from_env()
+        self.cache = cache or cache_from_env()
+        self.cassette = cassette_from_env()
+        self.deck_id = deck_id
         
-    def generate_content(self, title: str, outline: str, num_of_slides: int) -> dict:
+    def generate_content(self, title: str, outline: str, num_of_slides: int, first_slide: int = 1, total_slides: int = None, use_cache: bool = False) -> dict:
         """タイトルとアウトラインで内容を生成
 
         Args:
             title (str): タイトル,
             outline (str): アウトライン
+            num_of_slides (int): 生成するスライド数
+            first_slide (int): 分割して生成する場合の最初のスライド番号
+            total_slides (int): 分割して生成する場合の全体のスライド数
+            use_cache (bool): 同じリクエストで生成済みの内容を再利用する（Falseの場合は毎回新しく生成）
 
         Returns: 
             dict: 生成された内容
@@ -51,42 +68,130 @@ class ContentGeneration:
         
         start_time = time.time()
 
-        response = client.chat.completions.create(
-            model="gpt-4-0125-preview",
-            messages=[
-                {
-                    "role": "system",
-                    "content" : f"You will act as a business presenter that speaks and writes fluently in Japanese.\
-                        I will give you the title and materials, and you will summarize it into a easy to understand presentation.\
-                        The presentation should be written in Japanese. Response should be in JSON format like {self.example}."
-                },
-                {
-                    "role": "user",
-                    "content": f"You will provide content for a presentation on {title} based on text provided.\
-                        Text: {outline}. Split the text into {num_of_slides} slides. Summarize into 2 to 5 bullet points for each slide.\
-                        Do not generate any escape sequence.\
-                        Suggest a graphic to help provide a visual to reinforce each slide. Label the graphic as a prompt to be used with DALL-E 3 to generate the graphic.\
-                        "
-                }
-            ],
-            temperature=0.8,
-            response_format={"type": "json_object"}
-        )
+        slides, finish_reason = self._request_slides(title, outline, num_of_slides, first_slide, total_slides, use_cache=use_cache)
+        if finish_reason != "stop":
+            logging.warning(f"Generation not completed. Finish reason: {finish_reason}. Repairing incomplete slides.")
+
+        # 形式に合わないスライドと足りないスライドだけを再リクエスト（資料全体は作り直さない）
+        last_slide = first_slide + num_of_slides - 1
+        invalid = [i for i in range(num_of_slides) if i >= len(slides) or validate(slides[i], SLIDE_SCHEMA, f"slide{first_slide + i}")]
+        slides = slides[:num_of_slides] + [None] * (num_of_slides - len(slides))
+        for start, count in _ranges(invalid):
+            structured_stats.add(invalid_fragments=count, rerequests=1)
+            repaired, _ = self._request_slides(title, outline, count, first_slide + start, total_slides or last_slide, stage="content_repair", use_cache=use_cache)
+            for offset in range(count):
+                slide = repaired[offset] if offset < len(repaired) else None
+                errors = validate(slide, SLIDE_SCHEMA, f"slide{first_slide + start + offset}") if slide is not None else ["missing"]
+                if errors:
+                    structured_stats.add(failures=1)
+                    raise ValueError(f"Invalid slide {first_slide + start + offset} after re-request: {errors}")
+                slides[start + offset] = slide
 
-        escape_characters = r'[\n\r\t\f\v]'
-        content_generated = response.choices[0].message.content
-        cleaned_content = json.loads(re.sub(escape_characters, '', content_generated))
+        cleaned_content = {f"slide{i+1}": slide for i, slide in enumerate(slides)}
         
         time_taken = time.time() - start_time
         logging.info(f"Response: {cleaned_content}")
-        logging.info(f"Finish Reason: {response.choices[0].finish_reason}")
+        logging.info(f"Re-requested slides: {[first_slide + i for i in invalid]}")
         logging.info(f"Time Taken: {time_taken}")
 
-        if response.choices[0].finish_reason != "stop":
-            raise Exception(f"Generation not completed. Finish reason: {response.choices[0].finish_reason}")
-
         return cleaned_content
 
+    def _request_slides(self, title: str, outline: str, num_of_slides: int, first_slide: int = 1, total_slides: int = None, stage: str = "content", use_cache: bool = False):
+        part = ""
+        if total_slides is not None:
+            part = f"This is part of a {total_slides}-slide presentation. Only write slides {first_slide} to {first_slide + num_of_slides - 1}, covering the corresponding part of the text in order."
+
+        def complete(response) -> bool:
+            # 途中で切れた応答や、形式に合わないスライドを含む応答はキャッシュしない
+            if response.choices[0].finish_reason != "stop":
+                return False
+            try:
+                value, _ = repair_json(response.choices[0].message.content)
+            except ValueError:
+                return False
+            slides = unwrap_slides(value)
+            return len(slides) >= num_of_slides and not any(
+                validate(slide, SLIDE_SCHEMA, f"slide{first_slide + i}") for i, slide in enumerate(slides[:num_of_slides])
+            )
+
+        response = self._create(
+            stage=stage,
+            use_cache=use_cache,
+            cacheable=complete,
+            model="gpt-4-0125-preview",
+            messages=prompts.CONTENT.messages(title=title, outline=outline, num_of_slides=num_of_slides, part=part),
+            temperature=0.8,
+            response_format={"type": "json_object"}
+        )
+
+        value, _ = parse_response(response.choices[0].message.content)
+        if value is None:
+            # 読み込めない場合は、すべてのスライドを再リクエストの対象にする
+            return [], response.choices[0].finish_reason
+        return unwrap_slides(value), response.choices[0].finish_reason
+
+    def regenerate_slide(self, title: str, outline: str, slide: dict, instruction: str = "") -> dict:
+        """1枚のスライドの内容だけを再生成
+
+        Args:
+            title (str): タイトル
+            outline (str): アウトライン
+            slide (dict): 現在のスライドの内容（title, content, graphic_prompt）
+            instruction (str): 修正の指示
+
+        Returns:
+            dict: 再生成されたスライドの内容
+
+        """
+
+        start_time = time.time()
+
+        response = self._create(
+            stage="content_slide",
+            model="gpt-4-0125-preview",
+            messages=prompts.SLIDE.messages(title=title, outline=outline, slide=json.dumps(slide, ensure_ascii=False), instruction=instruction),
+            temperature=0.8,
+            response_format={"type": "json_object"}
+        )
+
+        slide_generated, errors = parse_response(response.choices[0].message.content, SLIDE_SCHEMA)
+        if errors:
+            structured_stats.add(failures=1)
+            raise ValueError(f"Invalid slide response: {errors}")
+
+        logging.info(f"Response: {slide_generated}")
+        logging.info(f"Time Taken: {time.time() - start_time}")
+
+        return slide_generated
+
+    def _client(self):
+        if not self.deadline.bounded:
+            return client
+        # 制限時間がある場合は、テキストだけのPPTを作る時間を残してタイムアウトする（再試行はヘッジに任せる）
+        return client.with_options(timeout=self.deadline.timeout("content"), max_retries=0)
+
+    def _create(self, stage: str = "content", use_cache: bool = False, cacheable=None, **request):
+        if use_cache:
+            # 同じリクエストは他のレプリカの結果も再利用（キャッシュから返した場合はトークンを使わないので記録しない）
+            return self.cache.get_or_compute(self.cache.key(stage, request), lambda: self._create(stage, **request), cacheable=cacheable)
+        def call(model):
+            return self._client().chat.completions.create(**dict(request, model=model))
+
+        def hedged(model):
+            run = lambda: call(model)
+            if self.hedger is not None:
+                run = lambda: self.hedger.run_sync(lambda: call(model), stage=stage, deck_id=self.deck_id)
+            if self.cassette is None:
+                return run()
+            # ヘッジの外側で記録する（負けたリクエストは記録せず、返した応答だけを1件記録する）
+            return self.cassette.call("openai_chat", stage, dict(request, model=model), run, encode_chat_completion, decode_chat_completion)
+
+        # キャッシュのキーは呼び出し元のモデルのまま（振り分け先が変わってもキャッシュを再利用）
+        start = time.time()
+        response = self.router.run_sync(stage, request["model"], hedged)
+        self.ledger.record(self.deck_id, stage, response.model, response.usage, time.time() - start)
+        return response
+
 
 if __name__ == "__main__":
     outline = "生成型AIは学習データから新しいコンテンツを生成する人工知能の一種です."
@@ -0,0 +1,183 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter
+from utils import metrics
+
+# 各段階を始めるのに最低限残しておく時間（秒）。残り時間がこれより短い場合はその段階を縮退する
+STAGE_RESERVES = {
+    "content": 2,  # 内容の生成後、テキストだけのPPTを作る時間
+    "content_batch": 30,  # 大規模モードで次の内容を生成する時間
+    "chart": 10,  # 図を1枚生成して描画する時間
+    "chart_fix": 6,  # 図のコードを修正して描画し直す時間
+    "assembly": 5,  # 図を含めてPPTを作る時間
+    "thumbnails": 2,
+    "lida_refill": 15,
+    "description": 8,
+}
+# リクエストに設定するタイムアウトの下限（秒）
+MIN_TIMEOUT = 1
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class DeadlineStats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counts = {"decks": 0, "met": 0, "missed": 0, "degraded": 0}
+        self._actions = Counter()
+
+    def add(self, report: dict) -> None:
+        with self._lock:
+            self._counts["decks"] += 1
+            self._counts["met" if report["met"] else "missed"] += 1
+            if report["degradations"]:
+                self._counts["degraded"] += 1
+            self._actions.update(report["actions"])
+
+    def report(self) -> dict:
+        with self._lock:
+            result = dict(self._counts)
+            result["actions"] = dict(self._actions)
+        return result
+
+
+stats = DeadlineStats()
+metrics.register("deadline", stats.report)
+
+
+class Deadline:
+    def __init__(self, seconds: float = None, deck_id: str = None) -> None:
+        """資料1件の生成にかけられる時間（各段階に渡し、残り時間に応じて処理を縮退する）
+
+        Args:
+            seconds (float): 制限時間（秒）。Noneの場合は無制限
+            deck_id (str): 資料ID
+
+        """
+        self.seconds = seconds
+        self.deck_id = deck_id
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+        self._degradations = []
+        self._report = None
+
+    @property
+    def bounded(self) -> bool:
+        return self.seconds is not None
+
+    def remaining(self) -> float:
+        if self.seconds is None:
+            return math.inf
+        return self.seconds - (time.monotonic() - self.start)
+
+    def allows(self, stage: str) -> bool:
+        """段階を始める時間が残っているか
+
+        Args:
+            stage (str): 段階（STAGE_RESERVESのキー）
+
+        Returns:
+            bool: 残り時間が段階の必要時間以上の場合はTrue
+
+        """
+        return self.remaining() >= STAGE_RESERVES.get(stage, 0)
+
+    def timeout(self, reserve: str = None) -> float:
+        """リクエストのタイムアウトを取得（後の段階の時間を残す）
+
+        Args:
+            reserve (str): 後に残しておく段階（STAGE_RESERVESのキー）
+
+        Returns:
+            float: タイムアウト（秒）。無制限の場合はNone
+
+        Raises:
+            DeadlineExceeded: 後の段階の時間を残すとリクエストする時間がない場合
+
+        """
+        if self.seconds is None:
+            return None
+        timeout = self.remaining() - STAGE_RESERVES.get(reserve, 0)
+        if timeout < MIN_TIMEOUT:
+            raise DeadlineExceeded(f"Deadline of {self.seconds}s exceeded for deck {self.deck_id}")
+        return timeout
+
+    def degrade(self, stage: str, action: str, detail: str = "") -> None:
+        """縮退した処理を記録
+
+        Args:
+            stage (str): 段階
+            action (str): 縮退の内容（例: skip_fix_retry, drop_chart, text_only）
+            detail (str): 対象（スライドのファイル名など）
+
+        """
+        with self._lock:
+            self._degradations.append({"stage": stage, "action": action, "detail": detail, "remaining": round(self.remaining(), 1)})
+        logging.warning(f"Deadline: {stage} degraded ({action}) {detail}. Remaining: {self.remaining():.1f}s")
+
+    def report(self) -> dict:
+        elapsed = time.monotonic() - self.start
+        with self._lock:
+            degradations = list(self._degradations)
+        return {
+            "deadline": self.seconds,
+            "elapsed": round(elapsed, 1),
+            "met": self.seconds is None or elapsed <= self.seconds,
+            "degradations": degradations,
+            "actions": dict(Counter(item["action"] for item in degradations)),
+        }
+
+    def finish(self) -> dict:
+        """資料の生成が終わったとき（失敗した場合も）に呼び、結果をメトリクスに記録
+
+        2回目以降の呼び出しは記録せずに最初の結果を返す。
+
+        Returns:
+            dict: 経過時間と縮退した処理
+
+        """
+        with self._lock:
+            if self._report is not None:
+                return self._report
+        report = self.report()
+        with self._lock:
+            if self._report is not None:
+                return self._report
+            self._report = report
+        if self.bounded:
+            stats.add(report)
+        logging.info(f"Deadline report: {report}")
+        return report
+
+
+def deck_deadline_from_env(deck_id: str = None) -> Deadline:
+    """環境変数DECK_DEADLINE（秒、0または未設定の場合は無制限）から資料の制限時間を作成
+
+    Args:
+        deck_id (str): 資料ID
+
+    Returns:
+        Deadline: 制限時間
+
+    """
+    seconds = float(os.getenv("DECK_DEADLINE", "0"))
+    return Deadline(seconds or None, deck_id=deck_id)
+
+
+def lida_deadline_from_env(session_id: str = None) -> Deadline:
+    """環境変数LIDA_DEADLINE（秒、0または未設定の場合は無制限）から画面の操作1回あたりの制限時間を作成
+
+    Args:
+        session_id (str): セッションID
+
+    Returns:
+        Deadline: 制限時間
+
+    """
+    seconds = float(os.getenv("LIDA_DEADLINE", "0"))
+    return Deadline(seconds or None, deck_id=session_id)
@@ -0,0 +1,266 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass, field
+from io import BytesIO
+from pptx import Presentation
+import utils.ppt_generation as ppt_gen
+from utils.pptx_stream import generate_ppt_parallel, generate_ppt_streamed, slide_workers_from_env
+
+
+def _hash(*values) -> str:
+    return hashlib.sha1(json.dumps(values, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class SlideState:
+    title: str
+    content: list
+    graphic_prompt: str = ""
+    chart_code: str = None
+    chart_source: str = None  # 図を生成したときのcontent_hash
+    image_path: str = None
+    image_hash: str = None
+    graph: dict = None
+
+    @property
+    def content_hash(self) -> str:
+        return _hash(self.title, self.content, self.graphic_prompt)
+
+    @property
+    def chart_stale(self) -> bool:
+        return self.chart_source != self.content_hash
+
+    @property
+    def render_hash(self) -> str:
+        graph_hash = None
+        if self.graph is not None:
+            graph_hash = hashlib.sha1(ppt_gen.decode_graph(self.graph)).hexdigest()
+        return _hash(self.title, self.content, self.image_hash, graph_hash)
+
+    def to_content(self) -> dict:
+        return {"title": self.title, "content": self.content, "graphic_prompt": self.graphic_prompt}
+
+
+@dataclass
+class Deck:
+    title: str
+    slides: list = field(default_factory=list)
+    outline: str = ""
+    deck_id: str = None
+    chart_type: str = "mindmap"
+    large: bool = False
+    text_only: bool = False  # 時間が足りない場合に図を入れずに出力
+    degradations: list = field(default_factory=list)  # 制限時間のために縮退した処理
+    _pptx: bytes = None
+    _built_title: str = None
+    _built_hashes: list = field(default_factory=list)
+    _built_text_only: bool = False
+
+    @classmethod
+    def from_content(cls, title: str, content: dict, generated_graphs: list = None, outline: str = "", deck_id: str = None) -> "Deck":
+        """generate_contentの結果から資料モデルを作成
+
+        Args:
+            title (str): タイトル
+            content (dict): 生成された内容（slide1, slide2, ...）
+            generated_graphs (list): 生成されたグラフ
+            outline (str): アウトライン（テキストの再生成に使用）
+            deck_id (str): 資料ID
+
+        Returns:
+            Deck: 資料モデル
+
+        """
+        generated_graphs = generated_graphs or []
+        slides = []
+        for i in range(len(content)):
+            slide = content[f"slide{i+1}"]
+            slides.append(SlideState(
+                title=slide["title"],
+                content=slide["content"],
+                graphic_prompt=slide.get("graphic_prompt", ""),
+                graph=generated_graphs[i] if i < len(generated_graphs) else None,
+            ))
+        return cls(title=title, slides=slides, outline=outline, deck_id=deck_id)
+
+    def to_content(self) -> dict:
+        return {f"slide{i+1}": slide.to_content() for i, slide in enumerate(self.slides)}
+
+    def edit_slide(self, index: int, title: str = None, content: list = None, graphic_prompt: str = None) -> None:
+        """スライドのテキストを編集（図は次回の再生成まで保持）
+
+        Args:
+            index (int): スライド番号（0始まり）
+            title (str): タイトル
+            content (list): 箇条書き
+            graphic_prompt (str): 図のプロンプト
+
+        """
+        slide = self.slides[index]
+        if title is not None:
+            slide.title = title
+        if content is not None:
+            slide.content = content
+        if graphic_prompt is not None:
+            slide.graphic_prompt = graphic_prompt
+
+    def set_chart(self, index: int, chart_code: str, image_path: str) -> None:
+        slide = self.slides[index]
+        slide.chart_code = chart_code
+        slide.chart_source = slide.content_hash
+        slide.image_path = image_path
+        if image_path is None:
+            slide.image_hash = None
+        else:
+            with open(image_path, "rb") as f:
+                slide.image_hash = hashlib.sha1(f.read()).hexdigest()
+
+    def persist_images(self, directory: str) -> None:
+        """図の画像をdirectoryにコピーし、スライドの参照を差し替える（一時ディレクトリの画像が削除されても読み込めるようにする）
+
+        Args:
+            directory (str): 保存先
+
+        """
+        os.makedirs(directory, exist_ok=True)
+        for i, slide in enumerate(self.slides):
+            if slide.image_path is None or not os.path.exists(slide.image_path):
+                continue
+            path = os.path.join(directory, f"slide_{i+1}_{slide.image_hash[:8]}.png")
+            if os.path.abspath(path) != os.path.abspath(slide.image_path):
+                shutil.copyfile(slide.image_path, path)
+            slide.image_path = path
+
+    def set_graph(self, index: int, graph) -> None:
+        self.slides[index].graph = graph
+
+    def regenerate_text(self, index: int, content_generation, instruction: str = "") -> None:
+        """1枚のスライドのテキストをLLMで再生成
+
+        Args:
+            index (int): スライド番号（0始まり）
+            content_generation (ContentGeneration): 内容生成
+            instruction (str): 修正の指示
+
+        """
+        slide = self.slides[index]
+        regenerated = content_generation.regenerate_slide(
+            title=self.title, outline=self.outline, slide=slide.to_content(), instruction=instruction
+        )
+        self.edit_slide(
+            index,
+            title=regenerated.get("title", slide.title),
+            content=regenerated.get("content", slide.content),
+            graphic_prompt=regenerated.get("graphic_prompt", slide.graphic_prompt),
+        )
+
+    async def regenerate_chart(self, index: int, chart_generation, force: bool = False, chart_code: str = None) -> None:
+        """1枚のスライドの図を再生成
+
+        内容が変わっていない場合は何もしない。chart_codeを指定した場合はLLMを使わずに描画のみ行う。
+
+        Args:
+            index (int): スライド番号（0始まり）
+            chart_generation (ChartGeneration): 図の生成
+            force (bool): 内容が変わっていなくても再生成する
+            chart_code (str): 編集済みのmermaid.jsコード
+
+        """
+        slide = self.slides[index]
+        if chart_code is None and not force and not slide.chart_stale:
+            return
+        chart_code, image_path = await chart_generation.generate(
+            content=slide.content,
+            chart_type=self.chart_type,
+            custom_prompt=slide.graphic_prompt,
+            filename=f"slide_{index+1}_{slide.content_hash[:8]}",
+            chart_code=chart_code,
+            use_cache=not force,
+        )
+        self.set_chart(index, chart_code, image_path)
+        if image_path is not None:
+            # 図を作り直した場合は、時間切れで省いた図も含めて出力する
+            self.text_only = False
+
+    def _full_render(self) -> BytesIO:
+        # PPT_WORKERSが2以上の場合は、内容スライドを複数のプロセスで作成
+        generate = generate_ppt_parallel if slide_workers_from_env() > 1 else ppt_gen.generate_ppt
+        binary_ppt = generate(
+            title=self.title,
+            content=self.to_content(),
+            num_of_slides=len(self.slides),
+            img_path=[slide.image_path for slide in self.slides],
+            generated_graphs=[slide.graph for slide in self.slides],
+            text_only=self.text_only,
+        )
+        return binary_ppt
+
+    def render(self) -> BytesIO:
+        """PPTを出力（前回から変更されたスライドだけを作り直す）
+
+        Returns:
+            BytesIO: 生成されたPPT
+
+        """
+        start = time.time()
+        hashes = [slide.render_hash for slide in self.slides]
+
+        if (self._pptx is None or self._built_title != self.title or len(hashes) != len(self._built_hashes)
+                or self._built_text_only != self.text_only):
+            binary_ppt = self._full_render()
+        else:
+            changed = [i for i, (new, old) in enumerate(zip(hashes, self._built_hashes)) if new != old]
+            if not changed:
+                return BytesIO(self._pptx)
+
+            prs = Presentation(BytesIO(self._pptx))
+            slide_ids = prs.slides._sldIdLst
+            for i in changed:
+                slide = self.slides[i]
+                ppt_gen.add_content_slide(prs, slide.to_content(), image_path=slide.image_path, graph_data=slide.graph, text_only=self.text_only)
+
+                # 新しいスライドを元の位置に移動し、古いスライドを削除（表紙の分+1）
+                new_id = slide_ids[-1]
+                old_id = slide_ids[i + 1]
+                slide_ids.remove(new_id)
+                slide_ids.insert(i + 1, new_id)
+                prs.part.drop_rel(old_id.rId)
+                slide_ids.remove(old_id)
+
+            binary_ppt = BytesIO()
+            prs.save(binary_ppt)
+            logging.info(f"Updated slides: {[i + 1 for i in changed]}")
+
+        self._pptx = binary_ppt.getvalue()
+        self._built_title = self.title
+        self._built_hashes = hashes
+        self._built_text_only = self.text_only
+        logging.info(f"Deck rendered. Time taken: {time.time() - start}")
+        return BytesIO(self._pptx)
+
+    def write_to(self, path: str) -> None:
+        """PPTをファイルに書き出し（大規模モードでは一定枚数ずつ作成してメモリ使用量を抑える）
+
+        Args:
+            path (str): 保存先
+
+        """
+        if not self.large:
+            with open(path, "wb") as f:
+                f.write(self.render().getbuffer())
+            return
+
+        output = generate_ppt_streamed(
+            title=self.title,
+            content=self.to_content(),
+            num_of_slides=len(self.slides),
+            img_path=[slide.image_path for slide in self.slides],
+            generated_graphs=[slide.graph for slide in self.slides],
+            text_only=self.text_only,
+        )
+        with output, open(path, "wb") as f:
+            shutil.copyfileobj(output, f)
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import time
+import uuid
+from openai import APITimeoutError
+from utils.content_generation import ContentGeneration
+from utils.deadline import Deadline, DeadlineExceeded, deck_deadline_from_env
+from utils.deck_model import Deck
+from utils.memory_accounting import track_memory
+from utils.graphic.chart_generation import ChartGeneration
+from utils.hedging import hedger_from_env
+from utils.outline_compression import SENTENCE_PATTERN, compress_outline, outline_budget_from_env
+from utils.semantic_cache import semantic_cache_from_env
+from utils.slide_preview import deck_thumbnails
+from utils.usage_ledger import ledger_from_env
+
+CONTENT_BATCH_SIZE = 20
+
+
+def _noop_progress(stage: str, done: int = 0, total: int = 0) -> None:
+    pass
+
+
+def generate_content_batched(cg: ContentGeneration, title: str, outline: str, num_of_slides: int, batch_size: int = CONTENT_BATCH_SIZE, progress=None, deadline: Deadline = None, use_cache: bool = False) -> dict:
+    """スライド数が多い場合に、一定枚数ずつ内容を生成して結合
+
+    Args:
+        cg (ContentGeneration): 内容生成
+        title (str): タイトル
+        outline (str): アウトライン
+        num_of_slides (int): スライド数
+        batch_size (int): 1回の生成で作成するスライド数
+        progress (callable): 進捗の通知先
+        deadline (Deadline): 資料の制限時間（足りない場合やリクエストがタイムアウトした場合は生成済みのスライドまでで終える）
+        use_cache (bool): 同じリクエストで生成済みの内容を再利用する
+
+    Returns:
+        dict: 生成された内容（slide1, slide2, ...）
+
+    """
+    progress = progress or _noop_progress
+    deadline = deadline or Deadline()
+    slides = []
+    for first in range(0, num_of_slides, batch_size):
+        if slides and not deadline.allows("content_batch"):
+            deadline.degrade("content", "truncate_slides", f"{len(slides)}/{num_of_slides} slides")
+            break
+        count = min(batch_size, num_of_slides - first)
+        try:
+            generated = cg.generate_content(title=title, outline=outline, num_of_slides=count, first_slide=first + 1, total_slides=num_of_slides, use_cache=use_cache)
+        except (APITimeoutError, DeadlineExceeded) as e:
+            if not (slides and deadline.bounded):
+                raise
+            deadline.degrade("content", "truncate_slides", f"{len(slides)}/{num_of_slides} slides ({e})")
+            break
+        slides.extend(generated.values())
+        progress("content", len(slides), num_of_slides)
+    return {f"slide{i+1}": slide for i, slide in enumerate(slides)}
+
+
+def outline_content(title: str, outline: str, num_of_slides: int) -> dict:
+    """LLMを使わずにアウトラインの文を順に振り分けてスライドの内容を作成
+
+    Args:
+        title (str): タイトル
+        outline (str): アウトライン
+        num_of_slides (int): スライド数（文の数より多い場合は文の数まで）
+
+    Returns:
+        dict: 内容（slide1, slide2, ...）
+
+    """
+    sentences = [sentence.strip() for sentence in SENTENCE_PATTERN.findall(outline) if sentence.strip()] or [title]
+    count = max(1, min(num_of_slides, len(sentences)))
+    content = {}
+    for i in range(count):
+        content[f"slide{i+1}"] = {
+            "title": title if count == 1 else f"{title}（{i + 1}/{count}）",
+            "content": sentences[i * len(sentences) // count:(i + 1) * len(sentences) // count],
+            "graphic_prompt": "",
+        }
+    return content
+
+
+def generate_deck(title: str, outline: str, num_of_slides: int, generated_graphs: list = None, deck_id: str = None, progress=None, large: bool = False, deadline: Deadline = None, use_cache: bool = False) -> Deck:
+    """内容生成、図の生成、PPT作成までを一括で実行
+
+    Args:
+        title (str): タイトル
+        outline (str): アウトライン
+        num_of_slides (int): スライド数
+        generated_graphs (list): 生成されたグラフ
+        deck_id (str): 資料ID
+        progress (callable): 進捗の通知先 progress(stage, done, total)
+        large (bool): 大規模モード（内容を分割して生成し、PPTはwrite_toで逐次書き出す）
+        deadline (Deadline): 資料の制限時間。未指定の場合は環境変数DECK_DEADLINEに従う。
+            足りない場合は段階ごとに縮退し、内容はdeck.degradationsに記録する。
+            渡した場合は、呼び出し元が出力を書き出した後にfinish()を呼ぶ
+        use_cache (bool): 同じ入力で生成済みの内容と図を再利用する（Falseの場合は毎回新しく生成。生成した結果はキャッシュに保存する）
+
+    Returns:
+        Deck: 資料モデル（render()またはwrite_to()で出力を取得）
+
+    """
+    start = time.time()
+    deck_id = deck_id or str(uuid.uuid4())
+    owns_deadline = deadline is None
+    deadline = deadline or deck_deadline_from_env(deck_id)
+    try:
+        deck = _generate_deck(title, outline, num_of_slides, generated_graphs, deck_id, progress or _noop_progress, large, deadline, use_cache)
+        logging.info(f"Deck generated. Time taken: {time.time() - start}")
+        return deck
+    finally:
+        # 失敗した場合もヘッジの枠を返し、制限時間の結果（未達）を記録する
+        hedger = hedger_from_env()
+        if hedger is not None:
+            hedger.release_deck(deck_id)
+        if owns_deadline:
+            deadline.finish()
+        logging.info(f"Deck usage: {ledger_from_env().finish_deck(deck_id)}")
+
+
+def _generate_deck(title: str, outline: str, num_of_slides: int, generated_graphs: list, deck_id: str, progress, large: bool, deadline: Deadline, use_cache: bool) -> Deck:
+    # タイトルとアウトラインがほぼ同じ資料を生成済みの場合は、内容と図のコードを再利用
+    semantic_cache = semantic_cache_from_env()
+    reused = semantic_cache.lookup(title, outline, num_of_slides, large) if semantic_cache is not None and use_cache else None
+    submitted_outline = outline
+
+    # 長いテキストは重要な文に絞ってからLLMに渡す（スライドの再生成でも同じテキストを使用）
+    budget = outline_budget_from_env()
+    if budget is not None:
+        outline = compress_outline(outline, budget)
+
+    progress("content", 0, num_of_slides)
+    cg = ContentGeneration(deck_id=deck_id, deadline=deadline)
+    with track_memory("content"):
+        if reused is not None:
+            content_generated = reused["content"]
+            progress("content", num_of_slides, num_of_slides)
+        else:
+            try:
+                if large:
+                    content_generated = generate_content_batched(cg, title=title, outline=outline, num_of_slides=num_of_slides, progress=progress, deadline=deadline, use_cache=use_cache)
+                else:
+                    content_generated = cg.generate_content(title=title, outline=outline, num_of_slides=num_of_slides, use_cache=use_cache)
+            except (APITimeoutError, DeadlineExceeded) as e:
+                if not deadline.bounded:
+                    raise
+                # 内容を生成できなかった場合は、失敗にせずアウトラインの文をそのまま並べた資料を返す
+                deadline.degrade("content", "outline_only", str(e))
+                content_generated = outline_content(title, outline, num_of_slides)
+            progress("content", len(content_generated), num_of_slides)
+        deck = Deck.from_content(title=title, content=content_generated, generated_graphs=generated_graphs, outline=outline, deck_id=deck_id)
+        deck.large = large
+
+    # Graphic generation（再利用する場合はLLMを使わずに描画のみ）
+    gg = ChartGeneration(deck_id=deck_id, deadline=deadline)
+    chart_codes = reused["chart_codes"] if reused is not None else []
+    progress("charts", 0, len(deck.slides))
+    with track_memory("charts"):
+        for i in range(len(deck.slides)):
+            chart_code = chart_codes[i] if i < len(chart_codes) else None
+            asyncio.run(deck.regenerate_chart(i, gg, force=not use_cache, chart_code=chart_code))
+            progress("charts", i + 1, len(deck.slides))
+
+    # 図を入れてPPTを作る時間がない場合は、テキストだけのレイアウトにする（大規模モードのwrite_toも同様）
+    if not deadline.allows("assembly"):
+        deadline.degrade("assembly", "text_only")
+        deck.text_only = True
+
+    # 大規模モードではメモリ上にPPTを作らず、write_toで書き出す
+    if not large:
+        progress("assembly", len(deck.slides), len(deck.slides))
+        with track_memory("assembly"):
+            deck.render()
+        # 画面で資料を開いたときにすぐ表示できるよう、サムネイルを先に作成してキャッシュ
+        if deadline.allows("thumbnails"):
+            with track_memory("thumbnails"):
+                deck_thumbnails(deck)
+        else:
+            deadline.degrade("assembly", "skip_thumbnails")
+
+    deck.degradations = deadline.report()["degradations"]
+    # 縮退した資料や、スライド・図が足りない資料は再利用すると欠けたまま返るため保存しない
+    complete = not deck.degradations and len(deck.slides) == num_of_slides and all(slide.chart_code for slide in deck.slides)
+    if semantic_cache is not None and reused is None and complete:
+        semantic_cache.add(title, submitted_outline, num_of_slides, content_generated, [slide.chart_code for slide in deck.slides], large)
+    return deck
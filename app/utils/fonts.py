@@ -0,0 +1,51 @@
+import logging
+from functools import lru_cache
+from matplotlib import font_manager
+from matplotlib.font_manager import FontProperties
+
+# 日本語を表示できるフォント（優先順）
+CJK_FONT_CANDIDATES = [
+    "Meiryo",
+    "Yu Gothic",
+    "Hiragino Sans",
+    "Hiragino Kaku Gothic ProN",
+    "Noto Sans CJK JP",
+    "Noto Sans JP",
+    "IPAexGothic",
+    "IPAGothic",
+    "TakaoGothic",
+    "MS Gothic",
+]
+
+
+@lru_cache(maxsize=1)
+def find_cjk_font_path() -> str:
+    """インストール済みの日本語フォントのパスを取得
+
+    Returns:
+        str: フォントファイルのパス（見つからない場合はNone）
+
+    """
+    available = {font.name: font.fname for font in font_manager.fontManager.ttflist}
+    for name in CJK_FONT_CANDIDATES:
+        if name in available:
+            return available[name]
+
+    logging.warning("No CJK font found. Japanese text may not be rendered correctly.")
+    return None
+
+
+def cjk_font_properties(size: float = 10) -> FontProperties:
+    """日本語フォントのFontPropertiesを取得
+
+    Args:
+        size (float): フォントサイズ
+
+    Returns:
+        FontProperties: matplotlib用のフォント設定
+
+    """
+    font_path = find_cjk_font_path()
+    if font_path is None:
+        return FontProperties(size=size)
+    return FontProperties(fname=font_path, size=size)
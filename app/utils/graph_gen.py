@@ -1,8 +1,8 @@
 import os
 import io
 import time
-import json
 import logging
+import threading
 from io import BytesIO
 import base64
 import pandas as pd
@@ -12,14 +12,49 @@ from dotenv import load_dotenv
 from pptx import Presentation
 from pptx.util import Inches, Pt
 from lida import TextGenerationConfig, Manager
+from openai import APITimeoutError
 from llmx import llm
 #from src.lida.components import Manager
-from lida.datamodel import TextGenerationConfig
+from lida.datamodel import ChartExecutorResponse, TextGenerationConfig
+from lida.utils import read_dataframe
 from llmx import TextGenerator
+from utils.usage_ledger import LedgerTextGenerator, ledger_from_env
+from utils.model_router import router_from_env
+from utils.shared_cache import cache_from_env, file_fingerprint, fingerprint
+from utils.cassette import CassetteTextGenerator, cassette_from_env
+from utils.viz_dedup import dedup_visualizations, stats as viz_dedup_stats
+from utils.summary_enrichment import enricher_from_env
+from utils.quick_charts import quick_charts
+from utils.deadline import Deadline, DeadlineExceeded
+from utils.memory_accounting import track_memory
+from utils.graph_tasks import TaskCancelled, raise_if_cancelled, task_manager_from_env
+from utils import prompts
+from utils.structured_output import FEATURE_DESCRIPTION_SCHEMA, parse_response, stats as structured_stats, validate
 
 
 logging.basicConfig(level=logging.INFO)
 
+# LIDA runs the generated plot code on the global matplotlib.pyplot state, which is shared by every thread
+_execution_lock = threading.Lock()
+
+
+class SerializedExecutor:
+    def __init__(self, executor) -> None:
+        """
+        Wrap LIDA's ChartExecutor so that generated code runs one chart set at a time in this process.
+        Prefetch threads, background tasks and the script thread can then visualize concurrently without
+        one goal's plot leaking into another's figure. Only execution is serialized, not the LLM calls.
+        """
+        self.executor = executor
+
+    def __getattr__(self, name):
+        return getattr(self.executor, name)
+
+    def execute(self, *args, **kwargs):
+        with _execution_lock:
+            return self.executor.execute(*args, **kwargs)
+
+
 def load_settings(env_path) -> dict:
     load_dotenv(env_path)
     return os.getenv('OPENAI_API_KEY')
@@ -49,59 +84,120 @@ class FeatureDescriber:
             dict: Generated descriptions for the data features.
         """
 
-        system_prompt_base = f"""
-        あなたは、経験豊富なデータアナリストです。「{goal}」の目的に沿ったデータを説明してください。
-        必ず日本語で出力してください。体言止めにしてください。説明には改行などのフォーマットやラベルを絶対に含まないでください。
-        フィールドの情報: {summary['fields']}
-        """
-
-        user_prompt = f"""
-        あなたは、経験豊富なデータアナリストです。以下の項目について説明してください。
-        1. データセットの目的: データセットの目的を説明する文章は末尾に〜データセットとなるようにしてください。要点を簡潔に表現してください。
-        2. グラフの解釈: グラフが何を示しているのか、視覚的な観点から説明してください。要点を簡潔に表現してください。
-        3. 主要なインサイト: データセットやグラフから得られる具体的な発見やトレンドを詳細に説明してください。具体的な数値や変化に触れて事実を述べてください。
-        
-
-        それぞれの項目で説明する内容が重複しないように注意してください。以下の形式に従ってください：
-        {{
-            "dataset_purpose": "データセットの目的",
-            "graph_interpretation": "グラフの解釈",
-            "key_insights": "主要なインサイト"
-        }}
-
-        以下の画像は作成したグラフを示しています。参考にしてください：
-        data:image/png;base64,{base64_image}
-        """
-        messages = [
+        # The instructions are a fixed prefix shared by every call; the goal, fields and image follow in the user message
+        messages = prompts.FEATURE_DESCRIPTION.messages(goal=goal, fields=summary['fields'], base64_image=base64_image)
+        response = text_gen.generate(messages=messages, config=textgen_config)
 
-            {"role": "system", "content": system_prompt_base.strip()},
-            {"role": "user", "content":user_prompt.strip() }   
+        logging.debug(f"Response content: {response.text[0]['content']}")
 
+        feature_descriptions, errors = parse_response(response.text[0]['content'], FEATURE_DESCRIPTION_SCHEMA)
+        feature_descriptions = feature_descriptions if isinstance(feature_descriptions, dict) else {}
+        invalid = [
+            name for name, schema in FEATURE_DESCRIPTION_SCHEMA["properties"].items()
+            if name not in feature_descriptions or validate(feature_descriptions[name], schema, name)
         ]
-        response = text_gen.generate(messages=messages, config=textgen_config)
+        if invalid:
+            # Re-request only the invalid or missing items, keeping the valid ones
+            logging.warning("Invalid feature descriptions %s: %s", invalid, errors)
+            structured_stats.add(invalid_fragments=len(invalid), rerequests=1)
+            retry_messages = messages + [
+                {"role": "assistant", "content": response.text[0]['content']},
+                {"role": "user", "content": f"次の項目だけを、それぞれ文字列のJSONオブジェクトで出力してください: {invalid}"},
+            ]
+            retry = text_gen.generate(messages=retry_messages, config=textgen_config)
+            repaired, _ = parse_response(retry.text[0]['content'])
+            for name in invalid:
+                value = repaired.get(name) if isinstance(repaired, dict) else None
+                if validate(value, FEATURE_DESCRIPTION_SCHEMA["properties"][name], name):
+                    structured_stats.add(failures=1)
+                    feature_descriptions.pop(name, None)
+                else:
+                    feature_descriptions[name] = value
 
-        print("Response content:", response.text[0]['content'])
+        return feature_descriptions
 
-        try:
-            feature_descriptions = json.loads(response.text[0]['content'])
-        except json.JSONDecodeError as e:
-            logging.error("JSONDecodeError: %s", e)
-            logging.error("Invalid response content: %s", response.text[0]['content'])
-            return {}
 
-        return feature_descriptions
 
+def _executed(visualizations) -> bool:
+    """True when every chart's code ran; charts that failed to execute are not cached."""
+    return bool(visualizations) and all(visualization.status for visualization in visualizations)
 
 
 class GraphGeneration():
-    def __init__(self, openai_key):
+    def __init__(self, openai_key, ledger=None, session_id=None, cache=None, deadline=None, tasks=None):
+        """
+        Args:
+            deadline (Deadline): Time budget for one page interaction (the page passes lida_deadline_from_env()).
+                Goal and visualization requests time out at the remaining budget and return no result instead of failing;
+                when it runs short, duplicate refills and feature descriptions are skipped. All are recorded as degradations.
+            tasks (GraphTaskManager): Runs the *_async variants in the background, keeping only the latest
+                request per session and stage. Defaults to the process-wide manager.
+        """
         self.manager = Manager(text_gen=llm("openai", api_key=openai_key))
         self.feature_describer = FeatureDescriber()
+        self.ledger = ledger or ledger_from_env()
+        self.session_id = session_id
+        self.cache = cache or cache_from_env()
+        self.deadline = deadline or Deadline()
+        self.tasks = tasks or task_manager_from_env()
+
+    def _cached(self, use_cache, stage, key_parts, compute, cacheable=bool):
+        """
+        Share LIDA results across server processes. LIDA's own use_cache only works within one process,
+        so the same flag also enables the shared cache. Only results that pass cacheable are stored, so an
+        empty or failed result is recomputed on the next request. Memory growth is recorded per stage and
+        session when MEMORY_TRACKING is set.
+        """
+        with track_memory(stage, self.session_id):
+            if not use_cache:
+                return compute()
+            key = self.cache.key(stage, *key_parts)
+            try:
+                return self.cache.get_or_compute(key, compute, cacheable=cacheable)
+            except TaskCancelled:
+                # Joined another session's identical request that was superseded; compute it unless ours was too
+                raise_if_cancelled()
+                return self.cache.get_or_compute(key, compute, cacheable=cacheable)
+
+    def _submit(self, stage, key_parts, fn, **kwargs):
+        """
+        Run fn in the background and return a cancellable, awaitable GraphTask. A newer request for the same
+        session and stage cancels this one: it stops before its next LLM call or before LIDA executes the
+        returned code, and its result is never delivered. Resubmitting the same parameters returns the
+        existing handle.
+        """
+        return self.tasks.submit(self.session_id, stage, fingerprint(*key_parts), fn, **kwargs)
+
+    def _text_gen(self, manager) -> LedgerTextGenerator:
+        """
+        Wrap the manager's text generator so that every LIDA call is recorded in the usage ledger
+        (and in the cassette when LLM_CASSETTE is set), and routed per stage when MODEL_ROUTING is set.
+        The manager's chart executor is wrapped once so that generated code never runs concurrently.
+        """
+        if not isinstance(manager.text_gen, LedgerTextGenerator):
+            text_gen = manager.text_gen
+            cassette = cassette_from_env()
+            if cassette is not None:
+                text_gen = CassetteTextGenerator(text_gen, cassette)
+            manager.text_gen = LedgerTextGenerator(text_gen, self.ledger, deck_id=self.session_id, router=router_from_env())
+            if cassette is not None:
+                text_gen.stage = manager.text_gen.current_stage
+        manager.text_gen.deck_id = self.session_id
+        if not isinstance(manager.executor, SerializedExecutor):
+            manager.executor = SerializedExecutor(manager.executor)
+        return manager.text_gen
 
     def generate_summary(self, manager,uploaded_file_path, summary_method, model, temperature, use_cache):
         start_time = time.time()
         textgen_config = TextGenerationConfig(n=1, temperature=temperature, model=model, use_cache=use_cache)
-        summary = manager.summarize(uploaded_file_path, summary_method=summary_method, textgen_config=textgen_config)
+        def compute():
+            if summary_method == "llm_columns":
+                # Annotate column groups in parallel; each column's annotation is cached by its statistics.
+                summary = manager.summarize(uploaded_file_path, summary_method="default", textgen_config=textgen_config)
+                return enricher_from_env().enrich(summary, self._text_gen(manager), textgen_config, use_cache=use_cache)
+            with self._text_gen(manager).stage("lida_summary"):
+                return manager.summarize(uploaded_file_path, summary_method=summary_method, textgen_config=textgen_config)
+        summary = self._cached(use_cache, "lida_summary", (file_fingerprint(uploaded_file_path), summary_method, model, temperature), compute)
         time_taken = time.time() - start_time
         logging.info(f"Response: {summary}")
         logging.info(f"Time Taken: {time_taken}")
@@ -110,23 +206,93 @@ class GraphGeneration():
     def generate_goals(self,manager,summary, num_goals, model, temperature, use_cache):
         start_time = time.time()
         textgen_config = TextGenerationConfig(n=num_goals, temperature=temperature, model=model, use_cache=use_cache)
-        goals = manager.goals(summary, n=num_goals, textgen_config=textgen_config)
+        def compute():
+            try:
+                with self._text_gen(manager).stage("lida_goals", deadline=self.deadline):
+                    return manager.goals(summary, n=num_goals, textgen_config=textgen_config)
+            except (APITimeoutError, DeadlineExceeded) as e:
+                if not self.deadline.bounded:
+                    raise
+                # An empty result is not cached, so the next request asks again
+                self.deadline.degrade("lida_goals", "skip_goals", str(e))
+                return []
+        goals = self._cached(use_cache, "lida_goals", (summary, num_goals, model, temperature), compute)
         time_taken = time.time() - start_time
         logging.info(f"Response: {goals}")
         logging.info(f"Time Taken: {time_taken}")
         return goals
 
-    def generate_visualizations(self,manager,summary, goal, model, num_visualizations, temperature, use_cache, library):
+    def generate_visualizations(self,manager,summary, goal, model, num_visualizations, temperature, use_cache, library, dedup=True, fill=False):
+        """
+        Generate visualizations for a goal. Near-identical charts (same normalized code or close perceptual hash)
+        are removed before they are rendered, shown or described. With fill=True, one extra request is made
+        to replace the removed charts.
+        """
         start_time = time.time()
         textgen_config = TextGenerationConfig(n=num_visualizations, temperature=temperature, model=model, use_cache=use_cache)
-        visualizations = manager.visualize(summary=summary, goal=goal, textgen_config=textgen_config, library=library)
+        def compute():
+            try:
+                with self._text_gen(manager).stage("lida_visualize", deadline=self.deadline):
+                    visualizations = manager.visualize(summary=summary, goal=goal, textgen_config=textgen_config, library=library)
+            except (APITimeoutError, DeadlineExceeded) as e:
+                if not self.deadline.bounded:
+                    raise
+                self.deadline.degrade("lida_graphs", "skip_graphs", str(e))
+                return []
+            if not dedup:
+                return visualizations
+            unique = dedup_visualizations(visualizations)
+            missing = num_visualizations - len(unique)
+            if fill and missing > 0 and not self.deadline.allows("lida_refill"):
+                self.deadline.degrade("lida_graphs", "skip_refill", f"{missing} charts")
+            elif fill and missing > 0:
+                # 同じ結果が返らないようにLLMのキャッシュを使わずに補充
+                refill_config = TextGenerationConfig(n=missing, temperature=max(temperature, 0.7), model=model, use_cache=False)
+                try:
+                    with self._text_gen(manager).stage("lida_visualize", deadline=self.deadline):
+                        extra = manager.visualize(summary=summary, goal=goal, textgen_config=refill_config, library=library)
+                except (APITimeoutError, DeadlineExceeded):
+                    if not self.deadline.bounded:
+                        raise
+                    self.deadline.degrade("lida_graphs", "skip_refill", f"{missing} charts")
+                    return unique
+                extra = dedup_visualizations(extra, seen=unique)
+                viz_dedup_stats.add(replacements=len(extra))
+                unique += extra
+            return unique
+        key_parts = (summary, goal, num_visualizations, model, temperature, library, dedup, fill)
+        visualizations = self._cached(use_cache, "lida_visualize", key_parts, compute, cacheable=_executed)
         time_taken = time.time() - start_time
         logging.info(f"Time Taken: {time_taken}")
         return visualizations
 
+    def generate_summary_async(self, manager, uploaded_file_path, summary_method, model, temperature, use_cache):
+        key_parts = (file_fingerprint(uploaded_file_path), summary_method, model, temperature, use_cache)
+        return self._submit("lida_summary", key_parts, self.generate_summary, manager=manager, uploaded_file_path=uploaded_file_path,
+                            summary_method=summary_method, model=model, temperature=temperature, use_cache=use_cache)
+
+    def generate_goals_async(self, manager, summary, num_goals, model, temperature, use_cache):
+        key_parts = (summary, num_goals, model, temperature, use_cache)
+        return self._submit("lida_goals", key_parts, self.generate_goals, manager=manager, summary=summary,
+                            num_goals=num_goals, model=model, temperature=temperature, use_cache=use_cache)
+
+    def generate_visualizations_async(self, manager, summary, goal, model, num_visualizations, temperature, use_cache, library, dedup=True, fill=False):
+        key_parts = (summary, goal, model, num_visualizations, temperature, use_cache, library, dedup, fill)
+        return self._submit("lida_visualize", key_parts, self.generate_visualizations, manager=manager, summary=summary, goal=goal,
+                            model=model, num_visualizations=num_visualizations, temperature=temperature, use_cache=use_cache,
+                            library=library, dedup=dedup, fill=fill)
+
+    def edit_chart_async(self, manager, summary, model, temperature, use_cache, code, instructions, library):
+        key_parts = (summary, model, temperature, use_cache, code, instructions, library)
+        return self._submit("lida_edit", key_parts, self.edit_chart, manager=manager, summary=summary, model=model,
+                            temperature=temperature, use_cache=use_cache, code=code, instructions=instructions, library=library)
+
     def edit_chart(self, manager, summary, model, temperature, use_cache, code, instructions, library):
         textgen_config = TextGenerationConfig(n=1, temperature=temperature, model=model, use_cache=use_cache)
-        edited_charts = manager.edit(code=code, summary=summary, instructions=instructions, library=library, textgen_config=textgen_config)
+        def compute():
+            with self._text_gen(manager).stage("lida_edit"):
+                return manager.edit(code=code, summary=summary, instructions=instructions, library=library, textgen_config=textgen_config)
+        edited_charts = self._cached(use_cache, "lida_edit", (summary, code, instructions, model, temperature, library), compute, cacheable=_executed)
         return edited_charts
 
     def describe_features(
@@ -148,15 +314,45 @@ class GraphGeneration():
         Returns:
             dict: Generated descriptions for the data features.
         """
-        return self.feature_describer.describe(
-            summary=summary,
-            goal=goal,
-            base64_image=base64_image,
-            textgen_config=textgen_config,
-            text_gen=manager.text_gen,
-        )
+        if not self.deadline.allows("description"):
+            self.deadline.degrade("descriptions", "skip_description", goal)
+            return {}
+        def compute():
+            with self._text_gen(manager).stage("describe"):
+                return self.feature_describer.describe(
+                    summary=summary,
+                    goal=goal,
+                    base64_image=base64_image,
+                    textgen_config=textgen_config,
+                    text_gen=manager.text_gen,
+                )
+        key_parts = (summary, goal, base64_image, textgen_config.model, textgen_config.temperature)
+        complete = lambda descriptions: all(name in descriptions for name in FEATURE_DESCRIPTION_SCHEMA["properties"])
+        return self._cached(textgen_config.use_cache, "describe", key_parts, compute, cacheable=complete)
 
 class VisualizationProcessor:
+    @staticmethod
+    def quick_visualizations(uploaded_file_path, summary=None, max_charts=4):
+        """
+        Recommend and render charts directly from column dtypes and cardinality, without any LLM call.
+        The results have the same shape as LIDA's visualize() results, so they can be shown, edited
+        and described the same way.
+        """
+        start_time = time.time()
+        data = read_dataframe(uploaded_file_path)
+        visualizations = []
+        for spec, raster, code, error in quick_charts(data, summary, max_charts):
+            visualizations.append(ChartExecutorResponse(
+                spec=None,
+                status=error is None,
+                raster=raster,
+                code=code,
+                library="matplotlib",
+                error=None if error is None else {"message": str(error)},
+            ))
+        logging.info(f"Time Taken: {time.time() - start_time}")
+        return visualizations
+
     @staticmethod
     def process_summary(summary):
         fields = summary["fields"]
@@ -0,0 +1,294 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from utils import metrics
+
+_local = threading.local()
+# 受け取られなかった結果を保持する時間（秒、完了時から）。受け取られた結果はrelease()ですぐに破棄する
+TASK_TTL = 300
+
+
+class TaskCancelled(BaseException):
+    """新しいリクエストに置き換えられた処理を途中で止める例外
+
+    asyncio.CancelledErrorと同じくBaseExceptionを継承し、処理中の`except Exception`で握りつぶされないようにする。
+    """
+
+
+class GraphTask:
+    def __init__(self, session_id: str, stage: str, key: tuple) -> None:
+        """バックグラウンドで実行するLIDAの処理の結果を受け取るハンドル（awaitも可）
+
+        Args:
+            session_id (str): セッションID
+            stage (str): 処理段階（例: lida_summary, lida_goals）
+            key (tuple): 入力パラメータ（同じ値の再実行は同じハンドルを返す）
+
+        """
+        self.session_id = session_id
+        self.stage = stage
+        self.key = key
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        # 実行中でも取り消せるように、呼び出し元に返すFutureは完了までPENDINGのままにする
+        self._future = Future()
+
+    def cancel(self) -> bool:
+        """処理を取り消す（実行中の場合は次のLLMの呼び出しの前後で止まり、結果は返さない）
+
+        Returns:
+            bool: 取り消した場合True（完了済みの場合はFalse）
+
+        """
+        with self._lock:
+            self._event.set()
+            return self._future.cancel()
+
+    def cancel_requested(self) -> bool:
+        return self._event.is_set()
+
+    def cancelled(self) -> bool:
+        return self._future.cancelled()
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def failed(self) -> bool:
+        return self.done() and not self.cancelled() and self._future.exception() is not None
+
+    def result(self, timeout: float = None):
+        """結果を待って取得
+
+        Args:
+            timeout (float): 待つ時間（秒）
+
+        Returns:
+            処理の結果
+
+        Raises:
+            concurrent.futures.CancelledError: 取り消された場合
+            concurrent.futures.TimeoutError: 時間内に終わらなかった場合
+
+        """
+        return self._future.result(timeout=timeout)
+
+    def __await__(self):
+        return asyncio.wrap_future(self._future).__await__()
+
+    def _finish(self, value=None, error: BaseException = None) -> bool:
+        with self._lock:
+            if self._future.cancelled():
+                return False
+            if error is not None:
+                self._future.set_exception(error)
+            else:
+                self._future.set_result(value)
+            self.finished_at = time.time()
+            return True
+
+
+def current_task() -> GraphTask:
+    return getattr(_local, "task", None)
+
+
+def raise_if_cancelled() -> None:
+    """実行中の処理が取り消されていればTaskCancelledを送出（GraphTaskの外では何もしない）
+
+    Raises:
+        TaskCancelled: 取り消された場合
+
+    """
+    task = current_task()
+    if task is not None and task.cancel_requested():
+        raise TaskCancelled(f"{task.stage} was superseded")
+
+
+@contextmanager
+def running(task: GraphTask):
+    """ブロックの実行中、このスレッドの処理をtaskにする（GraphTaskManagerの外で実行する処理も取り消せるようにする）
+
+    Args:
+        task (GraphTask): 取り消しを確認する処理
+
+    """
+    previous = current_task()
+    _local.task = task
+    try:
+        yield task
+    finally:
+        _local.task = previous
+
+
+def propagate(fn):
+    """呼び出したスレッドの処理をfnの実行中も引き継ぐ（ワーカースレッドでも取り消しを確認できるようにする）
+
+    Args:
+        fn (callable): 他のスレッドで実行する関数
+
+    Returns:
+        callable: ラップした関数
+
+    """
+    task = current_task()
+
+    def run(*args, **kwargs):
+        previous = current_task()
+        _local.task = task
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.task = previous
+
+    return run
+
+
+class GraphTaskManager:
+    def __init__(self, max_workers: int = 4) -> None:
+        """セッションと処理段階ごとに最新のリクエストだけを実行し、置き換えられたリクエストを取り消す
+
+        Args:
+            max_workers (int): 同時に実行する処理数（全セッション共通）
+
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="graph-task")
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._counts = {"submitted": 0, "reused": 0, "superseded": 0, "stopped": 0, "completed": 0, "failed": 0, "discarded": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+
+    def _sweep(self) -> None:
+        # 受け取られないまま残った結果（base64の画像を含む）を破棄（ロックを取得して呼ぶ）
+        now = time.time()
+        for expired in [item for item, task in self._latest.items() if task.done() and now - (task.finished_at or task.submitted_at) > TASK_TTL]:
+            del self._latest[expired]
+
+    def submit(self, session_id: str, stage: str, key: tuple, fn, *args, **kwargs) -> GraphTask:
+        """処理をバックグラウンドで開始し、同じセッション・段階の前回のリクエストを取り消す
+
+        入力パラメータが前回と同じで、取り消されも失敗もしていない場合は前回のハンドルを返す（Streamlitの再実行で二重に実行しない）。
+
+        Args:
+            session_id (str): セッションID
+            stage (str): 処理段階
+            key (tuple): 入力パラメータ
+            fn (callable): 実行する関数
+            *args: fnの引数
+            **kwargs: fnのキーワード引数
+
+        Returns:
+            GraphTask: 結果のハンドル
+
+        """
+        with self._lock:
+            self._sweep()
+            previous = self._latest.get((session_id, stage))
+            if previous is not None and previous.key == key and not previous.cancelled() and not previous.failed():
+                self._counts["reused"] += 1
+                return previous
+            task = GraphTask(session_id, stage, key)
+            self._latest[(session_id, stage)] = task
+            self._counts["submitted"] += 1
+        if previous is not None and not previous.done():
+            previous.cancel()
+            self._count("superseded")
+            logging.info(f"Superseded {stage} request for session {session_id}")
+        self._executor.submit(self._run, task, fn, args, kwargs)
+        return task
+
+    def _run(self, task: GraphTask, fn, args: tuple, kwargs: dict) -> None:
+        if task.cancel_requested():
+            return
+        _local.task = task
+        start = time.time()
+        try:
+            value = fn(*args, **kwargs)
+        except TaskCancelled:
+            self._count("stopped")
+            logging.info(f"Stopped superseded {task.stage} request. Time Taken: {time.time() - start}")
+            return
+        except BaseException as e:
+            self._count("failed")
+            task._finish(error=e)
+            return
+        finally:
+            _local.task = None
+        # 取り消しの確認の後に終わった処理の結果は捨てる（新しいリクエストの結果を上書きしない）
+        self._count("completed" if task._finish(value) else "discarded")
+        logging.info(f"Time Taken: {time.time() - start}")
+
+    def latest(self, session_id: str, stage: str) -> GraphTask:
+        """セッション・段階の最新の処理を取得（Streamlitの再実行で待機が中断された場合も、次の実行で結果を受け取れる）
+
+        Args:
+            session_id (str): セッションID
+            stage (str): 処理段階
+
+        Returns:
+            GraphTask: 処理のハンドル。ない場合（受け取り済みを含む）はNone
+
+        """
+        with self._lock:
+            self._sweep()
+            return self._latest.get((session_id, stage))
+
+    def release(self, task: GraphTask) -> None:
+        """受け取った結果をマネージャーから外す（結果への参照を残さない）
+
+        Args:
+            task (GraphTask): 結果を受け取った処理
+
+        """
+        with self._lock:
+            if task.done() and self._latest.get((task.session_id, task.stage)) is task:
+                del self._latest[(task.session_id, task.stage)]
+
+    def is_latest(self, task: GraphTask) -> bool:
+        return self.latest(task.session_id, task.stage) is task
+
+    def cancel(self, session_id: str, stage: str = None) -> None:
+        """セッションの処理を取り消す
+
+        Args:
+            session_id (str): セッションID
+            stage (str): 処理段階。Noneの場合はセッションのすべての処理
+
+        """
+        with self._lock:
+            keys = [key for key in self._latest if key[0] == session_id and (stage is None or key[1] == stage)]
+            tasks = [self._latest.pop(key) for key in keys]
+        for task in tasks:
+            task.cancel()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            result = dict(self._counts)
+            result["running"] = sum(1 for task in self._latest.values() if not task.done())
+        return result
+
+
+_default_manager = None
+_default_lock = threading.Lock()
+
+
+def task_manager_from_env() -> GraphTaskManager:
+    """プロセス共通のGraphTaskManagerを取得（環境変数GRAPH_TASK_WORKERS）
+
+    Returns:
+        GraphTaskManager: 共通のマネージャー
+
+    """
+    global _default_manager
+    with _default_lock:
+        if _default_manager is None:
+            _default_manager = GraphTaskManager(max_workers=int(os.getenv("GRAPH_TASK_WORKERS", "4")))
+            metrics.register("graph_tasks", _default_manager.metrics)
+    return _default_manager
@@ -7,96 +7,103 @@ from openai import AsyncOpenAI
 from dotenv import load_dotenv
 import asyncio
 from PIL import Image
+from utils.graphic import native_renderer
+from utils.hedging import hedger_from_env
+from utils.model_router import router_from_env
+from utils.shared_cache import cache_from_env
+from utils.cassette import cassette_from_env, decode_chat_completion, encode_chat_completion
+from utils.usage_ledger import ledger_from_env
+from utils.deadline import Deadline
+from utils import prompts
 
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 client = AsyncOpenAI()
 logging.basicConfig(level=logging.INFO)
 
+RENDERERS = ("mmdc", "native", "auto")
+TEMPDIR = "./tmp"
+
 class ChartGeneration:
-    def __init__(self) -> None:
-        self.example = {
-            "er_diagram": """erDiagram
-                                CUSTOMER }|..|{ DELIVERY-ADDRESS : has
-                                CUSTOMER ||--o{ ORDER : places
-                                CUSTOMER ||--o{ INVOICE : "liable for"
-                                DELIVERY-ADDRESS ||--o{ ORDER : receives
-                                INVOICE ||--|{ ORDER : covers
-                                ORDER ||--|{ ORDER-ITEM : includes
-                                PRODUCT-CATEGORY ||--|{ PRODUCT : contains
-                                PRODUCT ||--o{ ORDER-ITEM : "ordered in"
-                                """,
-            "flowchart": """flowchart TD
-                                Start --> Stop
-                            """,
-            "mindmap": """mindmap
-                            root((mindmap))
-                              Origins
-                                Long history
-                                ::icon(fa fa-book)
-                                Popularisation
-                                  British popular psychology author Tony Buzan
-                              Research
-                                On effectivness<br/>and features
-                                On Automatic creation
-                                  Uses
-                                      Creative techniques
-                                      Strategic planning
-                                      Argument mapping
-                              Tools
-                                Pen and paper
-                                Mermaid""",
-            "timeline": """timeline
-                                title History of Social Media Platform
-                                2002 : LinkedIn
-                                2004 : Facebook
-                                     : Google
-                                2005 : Youtube
-                                2006 : Twitter"""
-        }
+    def __init__(self, renderer: str = None, hedger=None, ledger=None, deck_id: str = None, cache=None, deadline: Deadline = None, router=None) -> None:
+        """
+        Args:
+            renderer (str): 描画方法。"mmdc"（Node版mermaid CLI）、"native"（プロセス内描画）、
+                "auto"（対応するチャートはnative、それ以外はmmdc）。未指定の場合は環境変数CHART_RENDERER
+            hedger (RequestHedger): リクエストのヘッジ。未指定の場合は環境変数LLM_HEDGINGに従う
+            ledger (UsageLedger): トークン使用量の台帳。未指定の場合はプロセス共通の台帳
+            deck_id (str): 資料ID
+            cache (SharedCache): レプリカ間で共有するキャッシュ。未指定の場合は環境変数CACHE_BACKENDに従う
+            deadline (Deadline): 資料の制限時間（足りない場合は修正の再試行や図を省く）。未指定の場合は無制限
+            router (ModelRouter): 段階ごとのモデルの振り分け。未指定の場合は環境変数MODEL_ROUTINGに従う
+
+        """
+        self.deadline = deadline or Deadline()
+        self.router = router or router_from_env()
+        self.hedger = hedger or hedger_from_env()
+        self.ledger = ledger or ledger_from_env()
+        self.cache = cache or cache_from_env()
+        self.cassette = cassette_from_env()
+        self.deck_id = deck_id
+        self.renderer = renderer or os.getenv("CHART_RENDERER", "mmdc")
+        if self.renderer not in RENDERERS:
+            raise ValueError(f"Unknown renderer: {self.renderer}. Choose from {RENDERERS}")
+        self.example = prompts.CHART_EXAMPLES
     
-    async def generate_chart(self, content: list, chart_type: str, custom_prompt: str) -> str:
+    async def generate_chart(self, content: list, chart_type: str, custom_prompt: str, use_cache: bool = True) -> str:
         """タイトルと内容からチャートを生成
 
         Args:
             content (list): 内容
             graphic_prompt (str): プロンプト
+            use_cache (bool): 同じ内容で生成済みのチャートを再利用する
 
         Returns: 
             str: 生成されたチャートのmermaid.jsコード
 
         """ 
-        
-        start = time.time()
-        
-        # Create Chart
-        response = await client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content" : f"You will act as a engineer fluent in making chart, mindmaps, timelines, ER diagrams etc. in mermaid.js.\
-                        I will give you the content, type of chart, and a customization prompt. You will generate a mermaid.js chart that follow the customization prompt.\
-                        Example: {self.example[chart_type]}. Make necesssary changes based on customization prompt. Do not use theme as it is not supported with CLI.\
-                        Only return the mermaid.js code. "
-                },
-                {
-                    "role": "user",
-                    "content" : f"Content: {content}\
-                        Type of chart: {chart_type}\
-                        Customization prompt: {custom_prompt}."
-                }
-            ],
-            temperature=0.8,
-        )
-        
-        chart_code = response.choices[0].message.content
-        cleaned_code = chart_code.replace("```mermaid", "").replace("```", "").strip()
-        logging.info(f"Time Taken: {time.time() - start}")
-        logging.info(f"Mermaid.js Generated: {cleaned_code}")
-        
-        return cleaned_code
-    
+        return await self._generate_chart(content, chart_type, custom_prompt, use_cache)
+
+    async def _generate_chart(self, content: list, chart_type: str, custom_prompt: str, use_cache: bool, filename: str = "chart") -> str:
+        request = {
+            "model": "gpt-4o",
+            "messages": prompts.CHART.messages(chart_type=chart_type, example=prompts.chart_example(chart_type), custom_prompt=custom_prompt, content=content),
+            "temperature": 0.8,
+        }
+        completed = []
+
+        async def compute():
+            start = time.time()
+            response = await self._create(stage="chart", **request)
+
+            chart_code = response.choices[0].message.content
+            cleaned_code = chart_code.replace("```mermaid", "").replace("```", "").strip()
+            logging.info(f"Time Taken: {time.time() - start}")
+            logging.info(f"Mermaid.js Generated: {cleaned_code}")
+
+            finish_reason = response.choices[0].finish_reason
+            if finish_reason != "stop":
+                logging.warning(f"Chart generation not completed. Finish reason: {finish_reason}")
+            else:
+                completed.append(cleaned_code)
+            return cleaned_code
+
+        def renders(chart_code: str) -> bool:
+            # 途中で切れたコードや描画できないコードは保存しない（描画結果はキャッシュされ、save_chartで再利用する）
+            if chart_code not in completed:
+                return False
+            try:
+                self._image(chart_code, filename)
+                return True
+            except Exception as e:
+                logging.info(f"Not caching chart code that does not render: {e}")
+                return False
+
+        if not use_cache:
+            return await compute()
+        # 他のレプリカで描画できたコードも再利用し、同時に同じリクエストが来た場合は1回だけ生成する
+        return await self.cache.aget_or_compute(self.cache.key("chart_code", request), compute, cacheable=renders)
+
     def save_chart(self, chart_code: str, filename: str) -> None:
         """mermaid.jsコードをファイルに保存
 
@@ -106,20 +113,40 @@ class ChartGeneration:
 
         """ 
         
-        tempdir = "./tmp"
-        os.makedirs(tempdir, exist_ok=True)
-        file_path = os.path.join(tempdir, f"{filename}.mmd")
+        image_path = os.path.join(TEMPDIR, f"{filename}.png")
+        image = self._image(chart_code, filename)
+        with open(image_path, "wb") as file:
+            file.write(image)
+        logging.info(f"Chart saved to {image_path}")
+        return image_path
+
+    def _image(self, chart_code: str, filename: str) -> bytes:
+        os.makedirs(TEMPDIR, exist_ok=True)
+        native = self.renderer == "native" or (self.renderer == "auto" and native_renderer.is_supported(chart_code))
+        # 描画結果はコードだけで決まるため、他のレプリカで描画済みの画像を再利用
+        return self.cache.get_or_compute(
+            self.cache.key("chart_render", "native" if native else "mmdc", chart_code),
+            lambda: self._render(chart_code, os.path.join(TEMPDIR, filename), native),
+        )
+
+    def _render(self, chart_code: str, path: str, native: bool) -> bytes:
+        if native:
+            return native_renderer.render(chart_code)
+
+        file_path = f"{path}.mmd"
+        image_path = f"{path}.render.png"
         with open(file_path, "w") as file:
             file.write(chart_code)
-        image_path = os.path.join(tempdir, f"{filename}.png")
         try:
-            subprocess.run(["mmdc", "-i", file_path, "-o", image_path, "-b", "transparent"], check=True, capture_output=True)
-            logging.info(f"Chart saved to {image_path}")
-        
+            subprocess.run(["mmdc", "-i", file_path, "-o", image_path, "-b", "transparent"], check=True, capture_output=True,
+                           timeout=self.deadline.timeout("assembly"))
         except subprocess.CalledProcessError as e:
             raise Exception(e.stderr.decode("utf-8"))
-        
-        return image_path
+
+        with open(image_path, "rb") as file:
+            image = file.read()
+        os.remove(image_path)
+        return image
     
     async def fix_code(self, code: str, error: str) -> str:
         """エラーを修正
@@ -134,19 +161,10 @@ class ChartGeneration:
         """ 
         
         logging.info(f"Fixing code. Error: {error}")
-        response = await client.chat.completions.create(
+        response = await self._create(
+            stage="chart_fix",
             model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"You are a software engineer who is fluent in fixing mermaid.js code errors. I will give you a code snippet and an error message.\
-                        You will fix the code to remove the error. Only return the fixed mermaid.js code"
-                },
-                {
-                    "role": "user",
-                    "content": f"#Code: {code}"
-                }
-            ],
+            messages=prompts.CHART_FIX.messages(error=error, code=code),
         )
         
         fixed_code = response.choices[0].message.content
@@ -155,21 +173,73 @@ class ChartGeneration:
         
         return cleaned_code
     
+    def _client(self):
+        if not self.deadline.bounded:
+            return client
+        # 制限時間がある場合は、PPTを作る時間を残してタイムアウトする（再試行はヘッジに任せる）
+        return client.with_options(timeout=self.deadline.timeout("assembly"), max_retries=0)
+
+    async def _create(self, stage: str, **request):
+        def call(model):
+            return self._client().chat.completions.create(**dict(request, model=model))
+
+        async def hedged(model):
+            run = lambda: call(model)
+            if self.hedger is not None:
+                run = lambda: self.hedger.run(lambda: call(model), stage=stage, deck_id=self.deck_id)
+            if self.cassette is None:
+                return await run()
+            # ヘッジの外側で記録する（負けたリクエストは記録せず、返した応答だけを1件記録する）
+            return await self.cassette.acall("openai_chat", stage, dict(request, model=model), run, encode_chat_completion, decode_chat_completion)
+
+        # キャッシュのキーは呼び出し元のモデルのまま（振り分け先が変わってもキャッシュを再利用）
+        start = time.time()
+        response = await self.router.run(stage, request["model"], hedged)
+        self.ledger.record(self.deck_id, stage, response.model, response.usage, time.time() - start)
+        return response
     
     #local test run
     async def run(self, content: list, chart_type: str, custom_prompt:str, filename: str) -> None:
+        chart_code, image_path = await self.generate(content=content, chart_type=chart_type, custom_prompt=custom_prompt, filename=filename)
+        return image_path
+    
+    async def generate(self, content: list, chart_type: str, custom_prompt: str, filename: str, chart_code: str = None, use_cache: bool = True) -> tuple:
+        """チャートを生成して画像を保存（失敗した場合は修正を試みる）
+
+        Args:
+            content (list): 内容
+            chart_type (str): チャートの種類
+            custom_prompt (str): プロンプト
+            filename (str): ファイル名
+            chart_code (str): 既存のmermaid.jsコード（指定した場合は生成せずに描画のみ）
+            use_cache (bool): 同じ内容で生成済みのチャートを再利用する（再生成の場合はFalse）
+
+        Returns:
+            tuple: (mermaid.jsコード, 画像のパス)。失敗した場合は(None, None)
+
+        """
         try_count = 0
         error = ""
         while try_count < 3:
+            if not self.ledger.within_budget(self.deck_id):
+                logging.warning(f"Token budget exceeded for deck {self.deck_id}. Skipping chart {filename}.")
+                return None, None
+            if try_count == 0 and not self.deadline.allows("chart"):
+                self.deadline.degrade("charts", "drop_chart", filename)
+                return None, None
+            if try_count > 0 and not self.deadline.allows("chart_fix"):
+                self.deadline.degrade("charts", "skip_fix_retry", filename)
+                return None, None
             try:
-                if try_count == 0:
-                    chart_code = await self.generate_chart(content=content, chart_type=chart_type, custom_prompt=custom_prompt)
-                else:
+                if try_count == 0 and chart_code is None:
+                    chart_code = await self._generate_chart(content, chart_type, custom_prompt, use_cache, filename)
+                elif try_count > 0:
+                    # 修正したコードはキャッシュしない
                     chart_code = await self.fix_code(code=chart_code, error=error)
     
                 image_path = self.save_chart(chart_code=chart_code, filename=filename)
                 
-                return image_path
+                return chart_code, image_path
         
             except Exception as e:
                 error = str(e)
@@ -178,7 +248,7 @@ class ChartGeneration:
                 
         else:
             logging.error("Failed to generate chart after 3 attempts.")
-            return None
+            return None, None
                
     
 if __name__ == "__main__":
@@ -0,0 +1,279 @@
+import logging
+import math
+import re
+import textwrap
+import time
+from io import BytesIO
+import networkx as nx
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from utils.fonts import cjk_font_properties
+
+SUPPORTED_CHART_TYPES = ("mindmap", "timeline")
+
+PALETTE = ["#4E79A7", "#F28E2B", "#59A14F", "#E15759", "#76B7B2", "#EDC948", "#B07AA1", "#FF9DA7"]
+ROOT_COLOR = "#2F3E4E"
+
+# mermaid.jsのノード形状: ((circle)), ))bang((, )cloud(, {{hexagon}}, [square], (rounded)
+NODE_PATTERN = re.compile(
+    r"^(?P<id>[^\s()\[\]{}]*)\s*"
+    r"(?:\(\((?P<circle>.*)\)\)|\)\)(?P<bang>.*)\(\(|\)(?P<cloud>.*)\(|\{\{(?P<hexagon>.*)\}\}|\[(?P<square>.*)\]|\((?P<rounded>.*)\))\s*$"
+)
+
+
+class UnsupportedChartError(ValueError):
+    pass
+
+
+def detect_chart_type(chart_code: str) -> str:
+    """mermaid.jsコードからチャートの種類を判定
+
+    Args:
+        chart_code (str): mermaid.jsコード
+
+    Returns:
+        str: チャートの種類（例: mindmap, timeline）
+
+    """
+    for line in chart_code.splitlines():
+        line = line.strip()
+        if line and not line.startswith("%%"):
+            return line.split()[0]
+    return ""
+
+
+def is_supported(chart_code: str) -> bool:
+    return detect_chart_type(chart_code) in SUPPORTED_CHART_TYPES
+
+
+def _clean_label(text: str, width: int = 12) -> str:
+    text = text.strip().strip('"').strip("`")
+    text = re.sub(r"<br\s*/?>", "\n", text)
+    lines = []
+    for line in text.split("\n"):
+        lines.extend(textwrap.wrap(line.strip(), width=width) or [""])
+    return "\n".join(lines)
+
+
+def _parse_node(text: str) -> str:
+    match = NODE_PATTERN.match(text)
+    if match is None:
+        return _clean_label(text)
+    for shape in ("circle", "bang", "cloud", "hexagon", "square", "rounded"):
+        if match.group(shape) is not None:
+            return _clean_label(match.group(shape))
+    return _clean_label(match.group("id"))
+
+
+def parse_mindmap(chart_code: str) -> nx.DiGraph:
+    """mindmapのmermaid.jsコードを木構造に変換
+
+    Args:
+        chart_code (str): mermaid.jsコード
+
+    Returns:
+        nx.DiGraph: ノードにlabel属性を持つ木
+
+    """
+    graph = nx.DiGraph()
+    stack = []
+    lines = [line.expandtabs(4) for line in chart_code.splitlines()]
+    body = [line for line in lines if line.strip()][1:]
+
+    for line in body:
+        stripped = line.strip()
+        if stripped.startswith("%%") or stripped.startswith("::icon") or stripped.startswith(":::"):
+            continue
+        indent = len(line) - len(line.lstrip())
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+
+        node = len(graph)
+        if not stack and node > 0:
+            raise ValueError(f"Parse error: mindmap can only have one root node (line: {stripped})")
+        graph.add_node(node, label=_parse_node(stripped))
+        if stack:
+            graph.add_edge(stack[-1][1], node)
+        stack.append((indent, node))
+
+    if len(graph) == 0:
+        raise ValueError("Parse error: mindmap has no nodes")
+    return graph
+
+
+def parse_timeline(chart_code: str) -> nx.DiGraph:
+    """timelineのmermaid.jsコードを木構造（タイトル→期間→イベント）に変換
+
+    Args:
+        chart_code (str): mermaid.jsコード
+
+    Returns:
+        nx.DiGraph: ノードにlabel, section属性を持つ木
+
+    """
+    graph = nx.DiGraph()
+    graph.add_node(0, label="", section=None)
+    section = None
+    period = None
+
+    body = [line.strip() for line in chart_code.splitlines() if line.strip()][1:]
+    for line in body:
+        if line.startswith("%%"):
+            continue
+        if line.startswith("title "):
+            graph.nodes[0]["label"] = _clean_label(line[len("title "):], width=30)
+            continue
+        if line.startswith("section "):
+            section = line[len("section "):].strip()
+            continue
+
+        parts = [part.strip() for part in line.split(":")]
+        if parts[0]:
+            period = len(graph)
+            graph.add_node(period, label=_clean_label(parts[0]), section=section)
+            graph.add_edge(0, period)
+        elif period is None:
+            raise ValueError(f"Parse error: event without time period (line: {line})")
+
+        for event in parts[1:]:
+            if event:
+                node = len(graph)
+                graph.add_node(node, label=_clean_label(event), section=section)
+                graph.add_edge(period, node)
+
+    if graph.out_degree(0) == 0:
+        raise ValueError("Parse error: timeline has no time periods")
+    return graph
+
+
+def _radial_tree_layout(graph: nx.DiGraph, root: int = 0) -> dict:
+    weights = {}
+    for node in nx.dfs_postorder_nodes(graph, root):
+        weights[node] = max(1, sum(weights[child] for child in graph.successors(node)))
+
+    pos = {root: (0.0, 0.0)}
+    spans = {root: (0.0, 2 * math.pi)}
+    for parent in nx.dfs_preorder_nodes(graph, root):
+        start, end = spans[parent]
+        children = list(graph.successors(parent))
+        total = sum(weights[child] for child in children)
+        depth = nx.shortest_path_length(graph, root, parent) + 1
+        for child in children:
+            span = (end - start) * weights[child] / total
+            spans[child] = (start, start + span)
+            angle = start + span / 2
+            pos[child] = (depth * math.cos(angle), depth * math.sin(angle))
+            start += span
+    return pos
+
+
+def _timeline_layout(graph: nx.DiGraph, root: int = 0) -> dict:
+    pos = {root: (0.0, 1.2)}
+    periods = list(graph.successors(root))
+    offset = (len(periods) - 1) / 2
+    for i, period in enumerate(periods):
+        x = (i - offset) * 1.6
+        pos[period] = (x, 0.0)
+        for j, event in enumerate(graph.successors(period)):
+            pos[event] = (x, -0.9 * (j + 1))
+    return pos
+
+
+def _branch_colors(graph: nx.DiGraph, root: int = 0) -> dict:
+    colors = {root: ROOT_COLOR}
+    for i, branch in enumerate(graph.successors(root)):
+        for node in nx.dfs_preorder_nodes(graph, branch):
+            colors[node] = PALETTE[i % len(PALETTE)]
+    return colors
+
+
+def _section_colors(graph: nx.DiGraph, root: int = 0) -> dict:
+    sections = []
+    colors = {root: ROOT_COLOR}
+    for i, period in enumerate(graph.successors(root)):
+        section = graph.nodes[period]["section"]
+        if section is None:
+            key = i
+        else:
+            if section not in sections:
+                sections.append(section)
+            key = sections.index(section)
+        for node in nx.dfs_preorder_nodes(graph, period):
+            colors[node] = PALETTE[key % len(PALETTE)]
+    return colors
+
+
+def _draw(graph: nx.DiGraph, pos: dict, colors: dict, dpi: int) -> bytes:
+    xs = [x for x, _ in pos.values()]
+    ys = [y for _, y in pos.values()]
+    width = max(4.0, (max(xs) - min(xs)) * 2.2 + 2)
+    height = max(3.0, (max(ys) - min(ys)) * 1.6 + 1.5)
+
+    fig = Figure(figsize=(width, height), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.set_xlim(min(xs) - 1, max(xs) + 1)
+    ax.set_ylim(min(ys) - 0.6, max(ys) + 0.6)
+
+    nx.draw_networkx_edges(graph, pos, ax=ax, arrows=False, edge_color="#9AA5B1", width=1.5)
+    font = cjk_font_properties(size=11)
+    for node, (x, y) in pos.items():
+        label = graph.nodes[node]["label"]
+        if not label:
+            continue
+        ax.text(
+            x, y, label,
+            ha="center", va="center", color="white", fontproperties=font,
+            bbox=dict(boxstyle="round,pad=0.5", facecolor=colors[node], edgecolor="none"),
+        )
+
+    buffer = BytesIO()
+    fig.savefig(buffer, format="png", transparent=True, bbox_inches="tight", pad_inches=0.1)
+    return buffer.getvalue()
+
+
+def render(chart_code: str, dpi: int = 150) -> bytes:
+    """mermaid.jsコードをプロセス内で描画
+
+    Args:
+        chart_code (str): mermaid.jsコード（mindmap, timelineのみ対応）
+        dpi (int): 解像度
+
+    Returns:
+        bytes: 背景透過のPNG画像
+
+    """
+    start = time.time()
+    chart_type = detect_chart_type(chart_code)
+
+    if chart_type == "mindmap":
+        graph = parse_mindmap(chart_code)
+        pos = _radial_tree_layout(graph)
+        colors = _branch_colors(graph)
+    elif chart_type == "timeline":
+        graph = parse_timeline(chart_code)
+        pos = _timeline_layout(graph)
+        colors = _section_colors(graph)
+    else:
+        raise UnsupportedChartError(f"Native renderer does not support chart type: {chart_type}")
+
+    png = _draw(graph, pos, colors, dpi=dpi)
+    logging.info(f"Native render time: {time.time() - start}")
+    return png
+
+
+if __name__ == "__main__":
+    code = """mindmap
+    root((プロジェクト管理))
+      スケジュール
+        計画
+        進捗管理
+      リソース
+        人材
+        物資
+      リスク
+        予測
+        対策"""
+    with open("mindmap.png", "wb") as f:
+        f.write(render(code))
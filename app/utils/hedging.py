@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from utils import metrics
+
+
+class RequestHedger:
+    def __init__(
+        self,
+        percentile: float = 0.95,
+        initial_delay: float = 15.0,
+        min_delay: float = 2.0,
+        max_delay: float = 60.0,
+        window: int = 50,
+        min_samples: int = 5,
+        max_extra_requests: int = 5,
+    ) -> None:
+        """冪等なLLM呼び出しのヘッジ（遅い場合に同じリクエストを重複送信）
+
+        Args:
+            percentile (float): 直近のレイテンシからしきい値を求めるパーセンタイル
+            initial_delay (float): 十分なサンプルがない場合のしきい値（秒）
+            min_delay (float): しきい値の下限（秒）
+            max_delay (float): しきい値の上限（秒）
+            window (int): しきい値の学習に使う直近の呼び出し数
+            min_samples (int): 学習したしきい値を使い始めるサンプル数
+            max_extra_requests (int): 資料1件あたりの追加リクエスト数の上限
+
+        """
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.max_extra_requests = max_extra_requests
+
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+        self._extra_used = defaultdict(int)
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+        self.stats = {"calls": 0, "hedged": 0, "hedge_won": 0, "budget_exhausted": 0}
+
+    def threshold(self, stage: str) -> float:
+        """ヘッジを発火するまでの待ち時間を取得
+
+        Args:
+            stage (str): 処理段階（例: content, chart）
+
+        Returns:
+            float: しきい値（秒）
+
+        """
+        with self._lock:
+            latencies = sorted(self._latencies[stage])
+        if len(latencies) < self.min_samples:
+            return self.initial_delay
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile))
+        return min(self.max_delay, max(self.min_delay, latencies[index]))
+
+    def metrics(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stages = list(self._latencies)
+        stats["trigger_rate"] = stats["hedged"] / stats["calls"] if stats["calls"] else 0.0
+        stats["win_rate"] = stats["hedge_won"] / stats["hedged"] if stats["hedged"] else 0.0
+        stats["thresholds"] = {stage: self.threshold(stage) for stage in stages}
+        return stats
+
+    def release_deck(self, deck_id: str) -> None:
+        with self._lock:
+            self._extra_used.pop(deck_id, None)
+
+    def _record(self, stage: str, latency: float) -> None:
+        with self._lock:
+            self._latencies[stage].append(latency)
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+    def _take_budget(self, deck_id: str) -> bool:
+        # 資料IDがない呼び出しは上限を数える単位がなく、release_deckでも戻せないためヘッジしない
+        if deck_id is None:
+            return False
+        with self._lock:
+            if self._extra_used[deck_id] >= self.max_extra_requests:
+                self.stats["budget_exhausted"] += 1
+                return False
+            self._extra_used[deck_id] += 1
+            self.stats["hedged"] += 1
+            return True
+
+    async def run(self, request, stage: str, deck_id: str = None):
+        """非同期リクエストをヘッジ付きで実行
+
+        Args:
+            request (callable): コルーチンを返す引数なしの関数
+            stage (str): 処理段階
+            deck_id (str): 資料ID（追加リクエスト数の上限の単位）。Noneの場合はヘッジしない
+
+        Returns:
+            最初に成功したレスポンス
+
+        """
+        self._count("calls")
+        delay = self.threshold(stage)
+        start = time.time()
+        primary = asyncio.ensure_future(request())
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done and self._take_budget(deck_id):
+                logging.info(f"Hedging {stage} request after {delay:.1f}s")
+                pending.add(asyncio.ensure_future(request()))
+
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is not primary:
+                        self._count("hedge_won")
+                    # ヘッジが勝った場合も最初のリクエストからの時間を記録（勝った分だけの時間ではしきい値が下がり、ヘッジが増え続ける）
+                    self._record(stage, time.time() - start)
+                    return task.result()
+            raise error
+        finally:
+            # 負けたリクエストと、呼び出し元が取り消された（制限時間など）場合の実行中のリクエストを止める
+            for task in pending:
+                task.cancel()
+
+    def run_sync(self, request, stage: str, deck_id: str = None):
+        """同期リクエストをヘッジ付きで実行
+
+        負けたリクエストは結果を破棄する（実行中のスレッドは中断できないため完了まで待たない）。
+
+        Args:
+            request (callable): 引数なしの関数
+            stage (str): 処理段階
+            deck_id (str): 資料ID（追加リクエスト数の上限の単位）。Noneの場合はヘッジしない
+
+        Returns:
+            最初に成功したレスポンス
+
+        """
+        self._count("calls")
+        delay = self.threshold(stage)
+        start = time.time()
+        primary = self._executor.submit(request)
+        pending = {primary}
+        try:
+            done, _ = wait(pending, timeout=delay)
+            if not done and self._take_budget(deck_id):
+                logging.info(f"Hedging {stage} request after {delay:.1f}s")
+                pending.add(self._executor.submit(request))
+
+            error = None
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is not None:
+                        error = future.exception()
+                        continue
+                    if future is not primary:
+                        self._count("hedge_won")
+                    self._record(stage, time.time() - start)
+                    return future.result()
+            raise error
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+_default_hedger = None
+_default_lock = threading.Lock()
+
+
+def hedger_from_env() -> RequestHedger:
+    """環境変数LLM_HEDGINGが有効な場合にプロセス共通のRequestHedgerを取得
+
+    Returns:
+        RequestHedger: 無効な場合はNone
+
+    """
+    global _default_hedger
+    if os.getenv("LLM_HEDGING", "").lower() not in ("1", "true", "yes"):
+        return None
+
+    with _default_lock:
+        if _default_hedger is None:
+            _default_hedger = RequestHedger(
+                max_extra_requests=int(os.getenv("LLM_HEDGING_MAX_EXTRA", "5")),
+            )
+            metrics.register("hedging", _default_hedger.metrics)
+    return _default_hedger
@@ -0,0 +1,266 @@
+import json
+import logging
+import os
+import pickle
+import secrets
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from utils.deadline import Deadline, deck_deadline_from_env
+from utils.memory_accounting import track_memory
+from utils.profiling import maybe_profile
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    owner TEXT,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    progress TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# 実行中のジョブはHEARTBEAT_INTERVALごとにupdated_atを更新し、LEASE_TTLの間更新がないジョブだけを再実行する
+HEARTBEAT_INTERVAL = 15
+LEASE_TTL = 60
+
+# Streamlitの静的ファイル配信（server.enableStaticServing）で配信されるディレクトリ。
+# 配信にはアクセス制御がないため、資料は推測できない名前で保存し、STATIC_DECK_TTLが過ぎたら削除する
+STATIC_DECK_DIR = "app/static/decks"
+STATIC_DECK_TTL = 60 * 60
+
+
+def run_deck_job(params: dict, job_id: str, progress, deadline: Deadline = None):
+    from utils.deck_pipeline import generate_deck
+    return generate_deck(deck_id=job_id, progress=progress, deadline=deadline, **params)
+
+
+class JobQueue:
+    def __init__(self, db_path: str = "jobs/jobs.sqlite3", output_dir: str = "jobs", static_dir: str = STATIC_DECK_DIR, max_workers: int = 2, runner=run_deck_job,
+                 static_ttl: float = STATIC_DECK_TTL) -> None:
+        """SQLiteに保存されるローカルのジョブキュー（Streamlitのスクリプトスレッド外で資料を生成）
+
+        Args:
+            db_path (str): SQLiteファイルのパス
+            output_dir (str): 生成した資料の保存先
+            static_dir (str): 大規模モードの資料の保存先（Streamlitの静的ファイル配信でダウンロード）
+            max_workers (int): 同時に実行するジョブ数
+            runner (callable): ジョブの処理 runner(params, job_id, progress, deadline) -> Deck
+            static_ttl (float): 大規模モードの資料をダウンロードできる時間（秒、書き出しから）
+
+        """
+        self.db_path = db_path
+        self.output_dir = output_dir
+        self.static_dir = static_dir
+        self.runner = runner
+        self.static_ttl = static_ttl
+        self._swept_at = 0.0
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        os.makedirs(output_dir, exist_ok=True)
+        os.makedirs(static_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(SCHEMA)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="deck-job")
+        self._recover()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _recover(self) -> None:
+        # 停止したプロセスで完了しなかったジョブを再実行（他のレプリカが実行中のジョブはハートビートが新しいので残す）
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ? WHERE status = ? AND updated_at < ?", (QUEUED, RUNNING, time.time() - LEASE_TTL))
+            rows = conn.execute("SELECT id FROM jobs WHERE status = ? ORDER BY created_at", (QUEUED,)).fetchall()
+        for row in rows:
+            logging.info(f"Requeue job {row['id']}")
+            self._executor.submit(self._run, row["id"])
+
+    def _update(self, job_id: str, **values) -> None:
+        values["updated_at"] = time.time()
+        columns = ", ".join(f"{key} = ?" for key in values)
+        with self._lock, self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*values.values(), job_id))
+
+    def _claim(self, job_id: str) -> bool:
+        # 待機中のジョブを1つのワーカーだけが取得する（他のワーカーやレプリカが取得済みの場合はFalse）
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE id = ? AND status = ?", (RUNNING, time.time(), job_id, QUEUED))
+        return cursor.rowcount == 1
+
+    @contextmanager
+    def _heartbeat(self, job_id: str):
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(HEARTBEAT_INTERVAL):
+                self._update(job_id)
+
+        thread = threading.Thread(target=beat, name=f"job-heartbeat-{job_id[:8]}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def submit(self, params: dict, owner: str = None) -> str:
+        """ジョブを登録
+
+        Args:
+            params (dict): generate_deckの引数（JSONに変換できる値のみ）
+            owner (str): ジョブの所有者（ブラウザ単位のID）
+
+        Returns:
+            str: ジョブID
+
+        """
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, owner, status, params, progress, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, owner, QUEUED, json.dumps(params, ensure_ascii=False), json.dumps({"stage": QUEUED}), now, now),
+            )
+        self._executor.submit(self._run, job_id)
+        logging.info(f"Job submitted: {job_id}")
+        return job_id
+
+    def _row_to_job(self, row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["progress"] = json.loads(job["progress"]) if job["progress"] else {}
+        return job
+
+    def get(self, job_id: str) -> dict:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def list_jobs(self, owner: str, limit: int = 20) -> list:
+        self._sweep_static()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE owner = ? ORDER BY created_at DESC LIMIT ?", (owner, limit)
+            ).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def result_path(self, job_id: str) -> str:
+        return os.path.join(self.output_dir, f"{job_id}.pptx")
+
+    def download_path(self, job: dict) -> str:
+        """大規模モードの資料の保存先（期限切れで削除された場合はNone）
+
+        Args:
+            job (dict): 完了したジョブ
+
+        Returns:
+            str: 静的ファイルのパス
+
+        """
+        file_name = job["progress"].get("download")
+        if not file_name:
+            return None
+        path = os.path.join(self.static_dir, file_name)
+        return path if os.path.exists(path) else None
+
+    def _sweep_static(self) -> None:
+        # 期限を過ぎた大規模モードの資料を削除（ページの更新ごとに呼ばれるため、一定間隔でのみ確認）
+        now = time.time()
+        if now - self._swept_at < min(self.static_ttl, 60):
+            return
+        self._swept_at = now
+        for entry in os.scandir(self.static_dir):
+            try:
+                if entry.is_file() and now - entry.stat().st_mtime > self.static_ttl:
+                    os.remove(entry.path)
+            except OSError as e:
+                logging.warning(f"Failed to remove expired deck {entry.name}: {e}")
+
+    def load_deck(self, job_id: str):
+        """完了したジョブの資料モデルを読み込み
+
+        Args:
+            job_id (str): ジョブID
+
+        Returns:
+            Deck: 資料モデル
+
+        """
+        with open(os.path.join(self.output_dir, f"{job_id}.deck"), "rb") as f:
+            return pickle.load(f)
+
+    def _run(self, job_id: str) -> None:
+        if not self._claim(job_id):
+            return
+        job = self.get(job_id)
+
+        def progress(stage: str, done: int = 0, total: int = 0) -> None:
+            self._update(job_id, progress=json.dumps({"stage": stage, "done": done, "total": total}))
+
+        start = time.time()
+        params = dict(job["params"])
+        # 制限時間は資料の書き出しまでを含めて数え、失敗した場合も記録する
+        deadline = deck_deadline_from_env(job_id)
+        try:
+            # プロファイルは資料と同じディレクトリに{job_id}.collapsedなどとして出力
+            with self._heartbeat(job_id), maybe_profile(job_id, params.pop("profile", None), self.output_dir, request_id=job_id), \
+                    track_memory("deck_job", job["owner"]):
+                deck = self.runner(params, job_id, progress, deadline)
+                progress("assembly", len(deck.slides), len(deck.slides))
+                # 大規模モードの資料は静的ファイルとして配信するため、ジョブIDではなく推測できない名前で保存
+                download = f"{secrets.token_urlsafe(32)}.pptx" if deck.large else None
+                deck.write_to(os.path.join(self.static_dir, download) if download else self.result_path(job_id))
+            deck.degradations = deadline.finish()["degradations"]
+            # ./tmpの図は終了時に削除されるため、再起動後も読み込めるように資料と一緒に保存
+            deck.persist_images(os.path.join(self.output_dir, f"{job_id}_images"))
+            with open(os.path.join(self.output_dir, f"{job_id}.deck"), "wb") as f:
+                pickle.dump(deck, f)
+            self._update(job_id, status=DONE, progress=json.dumps({"stage": DONE, "degradations": getattr(deck, "degradations", []), "download": download}))
+            logging.info(f"Job {job_id} finished. Time taken: {time.time() - start}")
+        except Exception as e:
+            logging.exception(f"Job {job_id} failed")
+            self._update(job_id, status=FAILED, error=str(e))
+        finally:
+            deadline.finish()
+
+
+_default_queue = None
+_default_lock = threading.Lock()
+
+
+def job_queue_from_env() -> JobQueue:
+    """プロセス共通のJobQueueを取得（環境変数JOB_DB_PATH, JOB_WORKERS, DECK_DOWNLOAD_TTL）
+
+    Returns:
+        JobQueue: 共通のジョブキュー
+
+    """
+    global _default_queue
+    with _default_lock:
+        if _default_queue is None:
+            _default_queue = JobQueue(
+                db_path=os.getenv("JOB_DB_PATH", "jobs/jobs.sqlite3"),
+                max_workers=int(os.getenv("JOB_WORKERS", "2")),
+                static_ttl=float(os.getenv("DECK_DOWNLOAD_TTL", STATIC_DECK_TTL)),
+            )
+    return _default_queue
@@ -0,0 +1,447 @@
+import argparse
+import ast
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from utils.prompts import MIN_CACHED_PREFIX_TOKENS, count_tokens
+
+# AppTestで実行するページ（リポジトリのルートから実行する）
+SCRIPT_PATH = "app/main2.py"
+SAMPLE_DATA = "data/Survey_Results.csv"
+# セッションが書き込む一時ファイルの場所
+TEMP_PATHS = ("tmp", "data", "jobs", "app/static/decks", "temp_visualization_*.png")
+
+STEPS = ("load", "summarize", "goals", "visualize", "pick_graph", "generate_deck")
+
+
+def _usage(prompt: str, completion: str, cached_tokens: int = 0) -> SimpleNamespace:
+    prompt_tokens, completion_tokens = count_tokens(prompt), count_tokens(completion)
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens,
+                           prompt_tokens_details=SimpleNamespace(cached_tokens=min(cached_tokens, prompt_tokens)))
+
+
+def _cached_tokens(prefix: str) -> int:
+    # OpenAIと同じく、MIN_CACHED_PREFIX_TOKENS以上の先頭部分だけを128トークン単位でキャッシュされたとみなす
+    tokens = count_tokens(prefix)
+    if tokens < MIN_CACHED_PREFIX_TOKENS:
+        return 0
+    return MIN_CACHED_PREFIX_TOKENS + (tokens - MIN_CACHED_PREFIX_TOKENS) // 128 * 128
+
+
+def _stub_content(messages: list) -> str:
+    system, user = messages[0]["content"], messages[-1]["content"]
+    if "mermaid" in system:
+        return "mindmap\n  root((テーマ))\n    要点A\n      詳細1\n    要点B\n      詳細2\n    要点C"
+
+    slide = lambda i: {
+        "title": f"スライド {i}",
+        "content": [f"負荷試験用の箇条書き {i}-{j}。" for j in range(1, 4)],
+        "graphic_prompt": "シンプルな図",
+    }
+    if "rewrite one slide" in user:
+        return json.dumps(slide(1), ensure_ascii=False)
+    match = re.search(r"Split the text into (\d+) slides", user)
+    num_of_slides = int(match.group(1)) if match else 3
+    return json.dumps({f"slide{i}": slide(i) for i in range(1, num_of_slides + 1)}, ensure_ascii=False)
+
+
+class StubChatCompletions:
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self._prefixes = set()
+
+    def _response(self, request: dict) -> SimpleNamespace:
+        content = _stub_content(request["messages"])
+        message = SimpleNamespace(role="assistant", content=content)
+        # 同じsystemを送ったことがあれば、その分はプロバイダー側でキャッシュされたとみなす（短いsystemはキャッシュされない）
+        system = request["messages"][0]["content"]
+        cached_tokens = _cached_tokens(system) if system in self._prefixes else 0
+        self._prefixes.add(system)
+        return SimpleNamespace(
+            model=request["model"],
+            choices=[SimpleNamespace(message=message, finish_reason="stop")],
+            usage=_usage(json.dumps(request["messages"], ensure_ascii=False), content, cached_tokens),
+        )
+
+    def create(self, **request) -> SimpleNamespace:
+        time.sleep(self.latency)
+        return self._response(request)
+
+
+class StubAsyncChatCompletions(StubChatCompletions):
+    async def create(self, **request) -> SimpleNamespace:
+        import asyncio
+        await asyncio.sleep(self.latency)
+        return self._response(request)
+
+
+class StubOpenAI:
+    def __init__(self, latency: float, asynchronous: bool = False) -> None:
+        """OpenAIクライアントの代わりに、決まった形式の応答を一定の遅延で返す
+
+        Args:
+            latency (float): 応答までの時間（秒）
+            asynchronous (bool): AsyncOpenAIの代わりとして使う
+
+        """
+        completions = StubAsyncChatCompletions(latency) if asynchronous else StubChatCompletions(latency)
+        self.chat = SimpleNamespace(completions=completions)
+
+    def with_options(self, **options) -> "StubOpenAI":
+        return self
+
+
+class StubTextGenerator:
+    def __init__(self, latency: float) -> None:
+        """LIDAのTextGeneratorの代わりに、要約・ゴール・グラフのコードを一定の遅延で返す
+
+        Args:
+            latency (float): 応答までの時間（秒）
+
+        """
+        self.latency = latency
+        self.provider = "openai"
+        self.model = "stub"
+
+    def _summary(self, prompt: str) -> dict:
+        # 注釈を付ける前の要約がそのまま含まれているので、説明を追加して返す
+        try:
+            summary = ast.literal_eval(prompt[prompt.index("{"):prompt.rindex("}") + 1])
+        except (ValueError, SyntaxError):
+            summary = {"name": "dataset", "fields": []}
+        summary["dataset_description"] = "負荷試験用のデータセット"
+        for field in summary.get("fields", []):
+            field.setdefault("properties", {})["description"] = f"{field.get('column')}の値"
+        return summary
+
+    def _goals(self, n: int) -> list:
+        return [
+            {"index": i, "question": f"最も多い値は何か（{i + 1}）", "visualization": "先頭の列の棒グラフ", "rationale": "分布を確認する"}
+            for i in range(n)
+        ]
+
+    def _plot(self) -> str:
+        return (
+            "```\nimport matplotlib.pyplot as plt\nimport pandas as pd\n\n"
+            "def plot(data: pd.DataFrame):\n"
+            "    data.iloc[:, 0].astype(str).value_counts().head(10).plot(kind='bar')\n"
+            "    plt.title('load test', wrap=True)\n"
+            "    return plt;\n\n"
+            "chart = plot(data)\n```"
+        )
+
+    def generate(self, messages, config, **kwargs):
+        from llmx.datamodel import Message, TextGenerationResponse
+
+        time.sleep(self.latency)
+        system = messages[0]["content"]
+        if "annotate datasets" in system:
+            texts = [json.dumps(self._summary(messages[-1]["content"]), ensure_ascii=False, default=str)]
+        elif "GOALS" in system:
+            texts = [json.dumps(self._goals(3), ensure_ascii=False)]
+        elif "visualizations" in system:
+            texts = [self._plot() for _ in range(config.n or 1)]
+        else:
+            texts = [json.dumps({"dataset_purpose": "負荷試験", "graph_interpretation": "棒グラフ", "key_insights": "なし"}, ensure_ascii=False)]
+        prompt = json.dumps(messages, ensure_ascii=False, default=str)
+        return TextGenerationResponse(
+            text=[Message(role="assistant", content=text) for text in texts],
+            config=config,
+            usage=vars(_usage(prompt, "".join(texts))),
+        )
+
+
+def install_stubs(latency: float) -> None:
+    """OpenAIとLIDAの呼び出しをローカルのスタブに置き換える（AppTestはセッションのプロセスでスクリプトを実行する）
+
+    Args:
+        latency (float): LLM呼び出し1回あたりの遅延（秒）
+
+    """
+    os.environ.setdefault("OPENAI_API_KEY", "sk-load-test")
+    # mermaid CLIを使わずにプロセス内で描画
+    os.environ.setdefault("CHART_RENDERER", "native")
+
+    import lida
+    import utils.content_generation as content_generation
+    import utils.graph_gen as graph_gen
+    import utils.graphic.chart_generation as chart_generation
+
+    stub_llm = lambda *args, **kwargs: StubTextGenerator(latency)
+    lida.llm = stub_llm
+    graph_gen.llm = stub_llm
+    content_generation.client = StubOpenAI(latency)
+    chart_generation.client = StubOpenAI(latency, asynchronous=True)
+
+
+def _disk_usage() -> int:
+    total = 0
+    for pattern in TEMP_PATHS:
+        for path in glob.glob(pattern):
+            if os.path.isfile(path):
+                total += os.path.getsize(path)
+            for root, _, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(root, name)) for name in files if os.path.exists(os.path.join(root, name)))
+    return total
+
+
+def _process_usage(pid: int) -> tuple:
+    """プロセスの累積CPU時間（秒）とRSS（バイト）。/procがない場合や終了済みの場合はNone"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # コマンド名に空白が含まれる場合があるため、最後の")"より後ろを分割する（utime, stimeは14, 15番目）
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return cpu, pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class ResourceSampler:
+    def __init__(self, pids, interval: float = 0.5) -> None:
+        """セッションのプロセスのCPU使用率とRSSの合計を一定間隔で記録（Linuxの/procを使用）
+
+        Args:
+            pids (callable): 記録するプロセスIDのリストを返す
+            interval (float): 記録の間隔（秒）
+
+        """
+        self.pids = pids
+        self.interval = interval
+        self.samples = []
+        self._cpu = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="resource-sampler")
+
+    def _run(self) -> None:
+        last_wall = time.time()
+        while not self._stop.wait(self.interval):
+            wall, cpu, rss = time.time(), 0.0, 0
+            for pid in self.pids():
+                usage = _process_usage(pid)
+                if usage is None:
+                    continue
+                # 前回からの増加分だけを数える（途中で終了したプロセスは0）
+                cpu += usage[0] - self._cpu.get(pid, 0.0)
+                self._cpu[pid] = usage[0]
+                rss += usage[1]
+            self.samples.append({"cpu": cpu / (wall - last_wall) * 100, "rss": rss})
+            last_wall = wall
+
+    def __enter__(self) -> "ResourceSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def run_session(index: int, timeout: float, deck_timeout: float, num_of_slides: int) -> dict:
+    """1セッション分の操作（CSVのアップロードから資料生成まで）を実行し、操作ごとの時間を計測
+
+    AppTestはStreamlitのプロセス共通の状態（ランタイム、設定）を実行ごとに差し替えるため、1プロセスで1セッションだけ実行する。
+
+    Args:
+        index (int): セッション番号
+        timeout (float): 1回の操作のタイムアウト（秒）
+        deck_timeout (float): 資料生成（ジョブ完了までのポーリングを含む）のタイムアウト（秒）
+        num_of_slides (int): 内容スライド数
+
+    Returns:
+        dict: 操作ごとの時間（秒）とエラー
+
+    """
+    from streamlit.testing.v1 import AppTest
+
+    # アップロードの代わりに、セッションごとにCSVをdataに保存して選択済みにする（アプリと同じく削除しない）
+    data_path = os.path.join("data", f"load_test_{index}.csv")
+    shutil.copyfile(SAMPLE_DATA, data_path)
+
+    at = AppTest.from_file(SCRIPT_PATH, default_timeout=timeout)
+    at.query_params["client"] = [f"load-test-{index}"]
+    at.session_state["uploaded_file"] = [(f"load_test_{index}", data_path)]
+
+    timings, errors = {}, []
+
+    def step(name: str, action, step_timeout: float = None) -> None:
+        start = time.time()
+        try:
+            action(step_timeout or timeout)
+            if at.exception:
+                errors.append(f"{name}: {at.exception[0].value}")
+        except Exception as e:
+            errors.append(f"{name}: {e}")
+        timings[name] = time.time() - start
+
+    def click(label: str, sidebar: bool = True):
+        def action(step_timeout: float) -> None:
+            buttons = at.sidebar.button if sidebar else at.main.button
+            button = next(button for button in buttons if button.label == label)
+            button.click().run(timeout=step_timeout)
+        return action
+
+    def generate_deck(step_timeout: float) -> None:
+        at.main.text_input[0].input(f"負荷試験 {index}")
+        at.main.number_input[0].set_value(num_of_slides)
+        at.main.text_area[0].input("負荷試験用のテキストです。" * 20)
+        # 生成中はページが2秒ごとに再実行されるため、ジョブが完了するまでの時間になる
+        click("資料生成", sidebar=False)(step_timeout)
+
+    step("load", lambda step_timeout: at.run(timeout=step_timeout))
+    step("summarize", click("データの要約を生成"))
+    step("goals", click("ゴールを生成"))
+    step("visualize", click("グラフを生成"))
+    step("pick_graph", click("グラフを決定"))
+    step("generate_deck", generate_deck, deck_timeout)
+    return {"timings": timings, "errors": errors}
+
+
+def _percentile(values: list, percentile: float) -> float:
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(percentile * (len(values) - 1))))]
+
+
+def spawn_session(index: int, args: argparse.Namespace, workdir: str) -> subprocess.Popen:
+    """1セッションを別のプロセスで開始（スタブを入れた上で、AppTestをそのまま実行する）
+
+    Args:
+        index (int): セッション番号
+        args (argparse.Namespace): 負荷試験の引数
+        workdir (str): 結果のJSON（session_{index}.json）とログ（session_{index}.log）の保存先
+
+    Returns:
+        subprocess.Popen: セッションのプロセス
+
+    """
+    command = [
+        sys.executable, os.path.abspath(__file__), "--session", str(index),
+        "--latency", str(args.latency), "--slides", str(args.slides),
+        "--timeout", str(args.timeout), "--deck-timeout", str(args.deck_timeout),
+        "--output", os.path.join(workdir, f"session_{index}.json"),
+    ]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, ["app", os.environ.get("PYTHONPATH")])))
+    # パイプは読み出すまで詰まるため、ログはファイルに書き出す
+    with open(os.path.join(workdir, f"session_{index}.log"), "w") as log:
+        return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+
+
+def _session_result(process: subprocess.Popen, index: int, workdir: str, timeout: float) -> dict:
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        return {"timings": {}, "errors": [f"session {index} timed out after {timeout}s"]}
+    try:
+        with open(os.path.join(workdir, f"session_{index}.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        with open(os.path.join(workdir, f"session_{index}.log"), encoding="utf-8", errors="replace") as f:
+            lines = f.read().strip().splitlines()
+        return {"timings": {}, "errors": [f"session {index} failed: {lines[-1] if lines else f'exit code {process.returncode}'}"]}
+
+
+def run_level(sessions: int, args: argparse.Namespace) -> dict:
+    """同時にsessions個のセッションを、それぞれ別のプロセスで実行して集計
+
+    Returns:
+        dict: 操作ごとのレイテンシ、CPU、RSS（全セッションのプロセスの合計）、一時ファイルの増加量
+
+    """
+    disk_before = _disk_usage()
+    start = time.time()
+    processes = []
+    # 読み込みと5回の操作、資料生成の合計に、プロセスの起動時間を加えた時間で打ち切る
+    session_timeout = args.timeout * (len(STEPS) - 1) + args.deck_timeout + 60
+    with tempfile.TemporaryDirectory(prefix="load_test_") as workdir:
+        with ResourceSampler(lambda: [process.pid for process in processes]) as sampler:
+            processes.extend(spawn_session(i, args, workdir) for i in range(sessions))
+            results = [_session_result(process, i, workdir, session_timeout) for i, process in enumerate(processes)]
+    elapsed = time.time() - start
+
+    steps = {}
+    for name in STEPS:
+        values = [result["timings"][name] for result in results if name in result["timings"]]
+        steps[name] = {"p50": _percentile(values, 0.5), "p95": _percentile(values, 0.95), "max": max(values) if values else None}
+    interactions = [result["timings"][name] for result in results for name in STEPS if name != "generate_deck" and name in result["timings"]]
+    samples = sampler.samples or [{"cpu": 0.0, "rss": 0}]
+
+    return {
+        "sessions": sessions,
+        "elapsed": elapsed,
+        "errors": [error for result in results for error in result["errors"]],
+        "steps": steps,
+        "interaction_p95": _percentile(interactions, 0.95),
+        "cpu_mean": statistics.mean(sample["cpu"] for sample in samples),
+        "cpu_peak": max(sample["cpu"] for sample in samples),
+        "rss_peak": max(sample["rss"] for sample in samples),
+        "disk_growth": _disk_usage() - disk_before,
+    }
+
+
+def capacity(levels: list, threshold: float) -> int:
+    """エラーがなく、操作のp95がthreshold秒以内だった最大の同時セッション数"""
+    passed = [level["sessions"] for level in levels if not level["errors"] and level["interaction_p95"] is not None and level["interaction_p95"] <= threshold]
+    return max(passed) if passed else 0
+
+
+def print_report(levels: list, threshold: float) -> None:
+    print(f"{'sessions':>8} {'p95 (s)':>8} {'deck p50 (s)':>12} {'cpu mean %':>10} {'cpu peak %':>10} {'RSS (MB)':>9} {'disk (MB)':>9} {'errors':>6}")
+    for level in levels:
+        deck = level["steps"]["generate_deck"]["p50"]
+        print(
+            f"{level['sessions']:>8} {level['interaction_p95'] or 0:>8.2f} {deck or 0:>12.2f} {level['cpu_mean']:>10.0f} {level['cpu_peak']:>10.0f}"
+            f" {level['rss_peak'] / 1024 / 1024:>9.1f} {level['disk_growth'] / 1024 / 1024:>9.1f} {len(level['errors']):>6}"
+        )
+    print(f"Capacity per host (interaction p95 <= {threshold}s, no errors): {capacity(levels, threshold)} sessions")
+
+
+def main() -> None:
+    # PYTHONPATH=app python app/utils/load_harness.py --sessions 1,2,4,8 （リポジトリのルートで実行）
+    parser = argparse.ArgumentParser(description="main2.pyの同時セッション負荷試験（OpenAIとLIDAはスタブ）")
+    parser.add_argument("--sessions", default="1,2,4,8", help="同時セッション数（カンマ区切り）")
+    parser.add_argument("--latency", type=float, default=1.0, help="スタブのLLM呼び出し1回あたりの遅延（秒）")
+    parser.add_argument("--slides", type=int, default=5, help="内容スライド数")
+    parser.add_argument("--threshold", type=float, default=2.0, help="許容する操作のp95（秒）")
+    parser.add_argument("--timeout", type=float, default=120, help="1回の操作のタイムアウト（秒）")
+    parser.add_argument("--deck-timeout", type=float, default=600, help="資料生成のタイムアウト（秒）")
+    parser.add_argument("--output", default="load_test_report.json", help="結果のJSONの保存先")
+    parser.add_argument("--session", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.session is not None:
+        # spawn_sessionから起動されたセッションのプロセス
+        install_stubs(args.latency)
+        result = run_session(args.session, args.timeout, args.deck_timeout, args.slides)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        return
+
+    levels = []
+    for sessions in (int(value) for value in args.sessions.split(",")):
+        levels.append(run_level(sessions, args))
+        logging.warning(f"{sessions} sessions finished in {levels[-1]['elapsed']:.1f}s")
+
+    print_report(levels, args.threshold)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"args": vars(args), "levels": levels, "capacity": capacity(levels, args.threshold)}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
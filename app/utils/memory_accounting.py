@@ -0,0 +1,292 @@
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import weakref
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from utils import metrics
+try:
+    import resource
+except ImportError:
+    # Windowsにはない（/procもないため、RSSは記録しない）
+    resource = None
+
+# セッションの状態のサイズを数えるときに辿る深さ（ChartExecutorResponse.rasterやDeck._pptxまで届く深さ）
+MAX_DEPTH = 4
+TOP_KEYS = 5
+
+
+def _rss() -> int:
+    """現在のRSS（バイト）。/procがない環境ではピークのRSS、resourceもない環境（Windows）では0"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        if resource is None:
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def deep_size(value, depth: int = MAX_DEPTH, seen: set = None) -> int:
+    """値が保持しているメモリのおおよそのサイズ（バイト）
+
+    Args:
+        value: 対象の値
+        depth (int): 辿る深さ
+        seen (set): 数えたオブジェクトのid（共有されているオブジェクトは1回だけ数える）
+
+    Returns:
+        int: サイズ
+
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value, 0)
+    if depth <= 0 or isinstance(value, (str, bytes, bytearray, int, float, bool, type(None))):
+        return size
+    if hasattr(value, "getbuffer"):
+        # BytesIO（ダウンロードボタンに渡したPPTなど）
+        return size + value.getbuffer().nbytes
+    if isinstance(value, dict):
+        children = [item for pair in value.items() for item in pair]
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        children = list(value)
+    elif hasattr(value, "__dict__"):
+        children = list(vars(value).values())
+    else:
+        return size
+    return size + sum(deep_size(child, depth - 1, seen) for child in children)
+
+
+class MemoryTracker:
+    def __init__(self, enabled: bool = True, frames: int = 1, session_ttl: float = 1800, report_interval: float = 60, top_n: int = 10) -> None:
+        """処理段階とセッションごとのメモリの増加を記録し、終了したセッションのオブジェクトが残っていないかを確認する
+
+        段階の増加量とピークはtracemallocで計測したプロセス全体の値のため、同時に動いている他の処理の分も含む。
+        ピークのリセットもプロセス全体に効くため、ピークは他に計測中の処理がないときに始めた計測（入れ子の外側）だけで記録する。
+
+        Args:
+            enabled (bool): 計測するか（tracemallocを開始する）
+            frames (int): tracemallocが記録するスタックの深さ
+            session_ttl (float): この時間アクセスがないセッションを終了したとみなす（秒）
+            report_interval (float): スナップショットの比較と残ったオブジェクトの確認の間隔（秒）
+            top_n (int): 増加したメモリの割り当て箇所を表示する数
+
+        """
+        self.enabled = enabled
+        self.session_ttl = session_ttl
+        self.report_interval = report_interval
+        self.top_n = top_n
+
+        self._lock = threading.Lock()
+        self._stages = defaultdict(lambda: {"calls": 0, "growth": 0, "max_growth": 0, "max_peak": None})
+        self._sessions = {}
+        self._watched = defaultdict(list)
+        self._ended = {}
+        self._report = {"top_growth": [], "survivors": {}, "checked_at": None}
+        self._baseline = None
+        # 計測中の処理の数と、ピークを記録する計測（tracemallocのピークをリセットした計測）
+        self._active = 0
+        self._peak_owner = None
+        if enabled:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self._baseline = self._snapshot()
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def _session(self, session_id: str) -> dict:
+        if session_id not in self._sessions:
+            self._sessions[session_id] = {"growth": 0, "reruns": 0, "state_bytes": 0, "state_keys": {}, "last_seen": time.time()}
+        return self._sessions[session_id]
+
+    @contextmanager
+    def track(self, stage: str, session_id: str = None):
+        """処理の前後でメモリの増加量を記録
+
+        Args:
+            stage (str): 処理段階
+            session_id (str): セッションID（またはジョブの所有者）
+
+        """
+        if not self.enabled:
+            yield
+            return
+        token = object()
+        with self._lock:
+            owns_peak = self._active == 0 and hasattr(tracemalloc, "reset_peak")
+            self._active += 1
+            if owns_peak:
+                self._peak_owner = token
+                tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            growth = current - before
+            with self._lock:
+                self._active -= 1
+                owns_peak = self._peak_owner is token
+                if owns_peak:
+                    self._peak_owner = None
+                stats = self._stages[stage]
+                stats["calls"] += 1
+                stats["growth"] += growth
+                stats["max_growth"] = max(stats["max_growth"], growth)
+                if owns_peak:
+                    # 入れ子や他の計測と重なった場合だけ呼ばれた段階はNoneのまま
+                    stats["max_peak"] = max(stats["max_peak"] or 0, peak - before)
+                if session_id is not None:
+                    session = self._session(session_id)
+                    session["growth"] += growth
+                    session["last_seen"] = time.time()
+
+    @contextmanager
+    def rerun(self, session_state):
+        """Streamlitの1回の実行を記録し、終了時にセッションの状態のサイズをキーごとに数える
+
+        Args:
+            session_state: st.session_state（session_idは実行後に読む）
+
+        """
+        if not self.enabled:
+            yield
+            return
+        with self.track("rerun"):
+            yield
+        session_id = session_state.get("session_id")
+        if session_id is None:
+            return
+        sizes = {str(key): deep_size(value) for key, value in session_state.items()}
+        with self._lock:
+            session = self._session(session_id)
+            session["reruns"] += 1
+            session["last_seen"] = time.time()
+            session["state_bytes"] = sum(sizes.values())
+            session["state_keys"] = dict(sorted(sizes.items(), key=lambda item: -item[1])[:TOP_KEYS])
+
+    def watch(self, session_id: str, obj, label: str) -> None:
+        """セッション終了後に解放されるべきオブジェクトを登録（weakrefを作れないオブジェクトは無視）
+
+        Args:
+            session_id (str): セッションID
+            obj: 対象のオブジェクト
+            label (str): 種類（例: pil_image, deck_bytes）
+
+        """
+        if not self.enabled or session_id is None:
+            return
+        try:
+            ref = weakref.ref(obj)
+        except TypeError:
+            return
+        with self._lock:
+            refs = self._watched[session_id]
+            # 解放済みの参照は登録のたびに取り除く
+            refs[:] = [(item, name) for item, name in refs if item() is not None]
+            refs.append((ref, label))
+
+    def end_session(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._ended[session_id] = self._watched.pop(session_id, [])
+
+    def _expire(self) -> None:
+        now = time.time()
+        with self._lock:
+            expired = [session_id for session_id, session in self._sessions.items() if now - session["last_seen"] > self.session_ttl]
+        for session_id in expired:
+            self.end_session(session_id)
+
+    def _check(self) -> None:
+        # 終了したセッションのオブジェクトが残っていないか、起動時からどこでメモリが増えたかを確認（重いので一定間隔）
+        self._expire()
+        gc.collect()
+        survivors = defaultdict(int)
+        with self._lock:
+            for session_id, refs in list(self._ended.items()):
+                alive = [(ref, label) for ref, label in refs if ref() is not None]
+                for _, label in alive:
+                    survivors[label] += 1
+                if alive:
+                    self._ended[session_id] = alive
+                else:
+                    del self._ended[session_id]
+            leaked_sessions = len(self._ended)
+
+        snapshot = self._snapshot()
+        top = [
+            {"at": str(stat.traceback), "growth": stat.size_diff, "size": stat.size, "count": stat.count}
+            for stat in snapshot.compare_to(self._baseline, "lineno")[:self.top_n]
+        ]
+        with self._lock:
+            self._report = {"top_growth": top, "survivors": dict(survivors), "leaked_sessions": leaked_sessions, "checked_at": time.time()}
+        if survivors:
+            logging.warning(f"Objects alive after session end: {dict(survivors)}")
+
+    def metrics(self) -> dict:
+        if not self.enabled:
+            return {"enabled": False}
+        checked_at = self._report["checked_at"]
+        if checked_at is None or time.time() - checked_at > self.report_interval:
+            self._check()
+        current, peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            sessions = sorted(self._sessions.items(), key=lambda item: -item[1]["state_bytes"])
+            return {
+                "enabled": True,
+                "rss": _rss(),
+                "traced_current": current,
+                "traced_peak": peak,
+                "stages": {stage: dict(stats) for stage, stats in self._stages.items()},
+                "active_sessions": len(self._sessions),
+                "sessions": {session_id: {name: value for name, value in session.items() if name != "last_seen"} for session_id, session in sessions[:self.top_n]},
+                **self._report,
+            }
+
+
+_default_tracker = None
+_default_lock = threading.Lock()
+
+
+def memory_tracker_from_env() -> MemoryTracker:
+    """プロセス共通のMemoryTrackerを取得（環境変数MEMORY_TRACKING, MEMORY_TRACKING_FRAMES, MEMORY_SESSION_TTL）
+
+    Returns:
+        MemoryTracker: 共通のトラッカー（無効な場合は何も記録しない）
+
+    """
+    global _default_tracker
+    with _default_lock:
+        if _default_tracker is None:
+            _default_tracker = MemoryTracker(
+                enabled=os.getenv("MEMORY_TRACKING", "").lower() in ("1", "true", "yes"),
+                frames=int(os.getenv("MEMORY_TRACKING_FRAMES", "1")),
+                session_ttl=float(os.getenv("MEMORY_SESSION_TTL", "1800")),
+            )
+            metrics.register("memory", _default_tracker.metrics)
+    return _default_tracker
+
+
+def track_memory(stage: str, session_id: str = None):
+    """MEMORY_TRACKINGが有効な場合だけ処理の前後のメモリを記録（無効な場合のオーバーヘッドはnullcontextのみ）
+
+    Args:
+        stage (str): 処理段階
+        session_id (str): セッションID
+
+    """
+    tracker = memory_tracker_from_env()
+    if not tracker.enabled:
+        return nullcontext()
+    return tracker.track(stage, session_id)
@@ -0,0 +1,36 @@
+import logging
+import threading
+
+_lock = threading.Lock()
+_providers = {}
+
+
+def register(name: str, provider) -> None:
+    """メトリクスの提供元を登録
+
+    Args:
+        name (str): メトリクス名
+        provider (callable): 現在の値をdictで返す関数
+
+    """
+    with _lock:
+        _providers[name] = provider
+
+
+def snapshot() -> dict:
+    """登録されたすべてのメトリクスを取得
+
+    Returns:
+        dict: メトリクス名ごとの値
+
+    """
+    with _lock:
+        providers = dict(_providers)
+
+    result = {}
+    for name, provider in providers.items():
+        try:
+            result[name] = provider()
+        except Exception as e:
+            logging.error(f"Failed to collect metrics for {name}: {e}")
+    return result
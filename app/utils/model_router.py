@@ -0,0 +1,266 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+import openai
+from utils import metrics
+
+# モデルの品質（大きいほど高品質）。段階ごとのmin_qualityを満たすモデルだけに振り分ける
+MODEL_QUALITY = {
+    "gpt-4o": 3,
+    "gpt-4-0125-preview": 3,
+    "gpt-4-turbo": 3,
+    "gpt-4": 3,
+    "gpt-4o-mini": 2,
+    "gpt-3.5-turbo-16k": 1,
+    "gpt-3.5-turbo": 1,
+}
+
+# 段階ごとの候補モデル（優先順）、品質の下限、レイテンシの目標（秒、直近のp90）
+DEFAULT_ROUTES = {
+    "content": {"models": ["gpt-4-0125-preview", "gpt-4o"], "min_quality": 3, "max_latency": 90},
+    "content_repair": {"models": ["gpt-4-0125-preview", "gpt-4o"], "min_quality": 3, "max_latency": 30},
+    "content_slide": {"models": ["gpt-4-0125-preview", "gpt-4o"], "min_quality": 3, "max_latency": 20},
+    "chart": {"models": ["gpt-4o", "gpt-4-0125-preview"], "min_quality": 3, "max_latency": 20},
+    # mermaid.jsの修正や短い説明には最上位のモデルは必要ない
+    "chart_fix": {"models": ["gpt-4o-mini", "gpt-3.5-turbo", "gpt-4o"], "min_quality": 1, "max_latency": 8},
+    "describe": {"models": ["gpt-4o-mini", "gpt-4o"], "min_quality": 2, "max_latency": 10},
+    "lida_summary_columns": {"models": ["gpt-4o-mini", "gpt-4o"], "min_quality": 2, "max_latency": 15},
+    "lida_goals": {"models": ["gpt-4o", "gpt-4"], "min_quality": 3, "max_latency": 30},
+    "lida_visualize": {"models": ["gpt-4o", "gpt-4"], "min_quality": 3, "max_latency": 30},
+    "lida_edit": {"models": ["gpt-4o", "gpt-4"], "min_quality": 3, "max_latency": 30},
+}
+
+# 他のモデルに切り替えるエラー（レート制限、タイムアウト、接続エラー、サーバーエラー、モデルが使えない）
+FALLBACK_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError, openai.NotFoundError)
+
+
+def _percentile(values: list, percentile: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+class ModelRouter:
+    def __init__(
+        self,
+        routes: dict = None,
+        enabled: bool = True,
+        window: int = 50,
+        min_samples: int = 5,
+        max_failure_rate: float = 0.5,
+        cooldown: float = 30.0,
+        explore_every: int = 20,
+    ) -> None:
+        """段階ごとに、目標を満たす最も速いモデルへリクエストを振り分ける
+
+        段階とモデルごとに直近のレイテンシを、モデルごとに失敗率を記録し、レート制限やタイムアウトの場合は次の候補に切り替える。
+        無効な場合は呼び出し元が指定したモデルだけを使う（従来の動作）。
+
+        Args:
+            routes (dict): 段階ごとの候補（models, min_quality, max_latency）
+            enabled (bool): 振り分けを行うか
+            window (int): レイテンシと失敗率の計算に使う直近の呼び出し数
+            min_samples (int): 実測のレイテンシを使い始める呼び出し数（それまでは目標値とみなす）
+            max_failure_rate (float): これを超えたモデルは他の候補がない場合だけ使う
+            cooldown (float): レート制限やタイムアウトの後にモデルを避ける時間（秒）
+            explore_every (int): レイテンシを実測していない候補を試す間隔（段階ごとの呼び出し数）
+
+        """
+        self.routes = routes if routes is not None else DEFAULT_ROUTES
+        self.enabled = enabled
+        self.min_samples = min_samples
+        self.max_failure_rate = max_failure_rate
+        self.cooldown = cooldown
+        self.explore_every = explore_every
+
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+        self._outcomes = defaultdict(lambda: deque(maxlen=window))
+        self._cooling_until = {}
+        self._routed = defaultdict(lambda: defaultdict(int))
+        self.stats = {"calls": 0, "fallbacks": 0, "exhausted": 0}
+
+    def _latency(self, stage: str, model: str, percentile: float):
+        latencies = list(self._latencies[(stage, model)])
+        if len(latencies) < self.min_samples:
+            return None
+        return _percentile(latencies, percentile)
+
+    def _failure_rate(self, model: str) -> float:
+        outcomes = self._outcomes[model]
+        if len(outcomes) < self.min_samples:
+            return 0.0
+        return outcomes.count(False) / len(outcomes)
+
+    def candidates(self, stage: str, default: str) -> list:
+        """リクエストするモデルを試す順に取得
+
+        Args:
+            stage (str): 処理段階
+            default (str): 呼び出し元が指定したモデル（候補にない場合は先頭に加え、品質の下限に関わらず使う）
+
+        Returns:
+            list: モデル名のリスト
+
+        """
+        route = self.routes.get(stage)
+        if not self.enabled or route is None:
+            return [default]
+        models = route["models"] if default in route["models"] else [default] + route["models"]
+        models = [model for model in models if model == default or MODEL_QUALITY.get(model, 0) >= route.get("min_quality", 0)]
+        max_latency = route.get("max_latency", float("inf"))
+
+        now = time.time()
+        with self._lock:
+            def rank(model):
+                p90 = self._latency(stage, model, 0.9)
+                p50 = self._latency(stage, model, 0.5)
+                meets = p90 is None or p90 <= max_latency
+                return (not meets, p50 if p50 is not None else max_latency, models.index(model))
+
+            healthy = [model for model in models if self._cooling_until.get(model, 0) <= now and self._failure_rate(model) <= self.max_failure_rate]
+            ranked = sorted(healthy, key=rank)
+            # 実測していない候補もときどき試し、より速いモデルを見つけられるようにする
+            unmeasured = [model for model in ranked[1:] if len(self._latencies[(stage, model)]) < self.min_samples]
+            if unmeasured and sum(self._routed[stage].values()) % self.explore_every == self.explore_every - 1:
+                ranked.remove(unmeasured[0])
+                ranked.insert(0, unmeasured[0])
+            # 休止中や失敗の多いモデルは、他の候補がすべて失敗した場合だけ使う
+            ranked += sorted((model for model in models if model not in healthy), key=lambda model: self._cooling_until.get(model, 0))
+        return ranked
+
+    def record(self, stage: str, model: str, latency: float = None, error: Exception = None) -> None:
+        """呼び出しの結果を記録
+
+        Args:
+            stage (str): 処理段階
+            model (str): モデル名
+            latency (float): レイテンシ（秒）
+            error (Exception): 失敗した場合のエラー
+
+        """
+        with self._lock:
+            self._outcomes[model].append(error is None)
+            if latency is not None and not isinstance(error, openai.RateLimitError):
+                self._latencies[(stage, model)].append(latency)
+            if isinstance(error, (openai.RateLimitError, openai.APITimeoutError)):
+                retry_after = getattr(getattr(error, "response", None), "headers", {}).get("retry-after")
+                try:
+                    cooldown = float(retry_after)
+                except (TypeError, ValueError):
+                    cooldown = self.cooldown
+                self._cooling_until[model] = time.time() + cooldown
+
+    def _routed_call(self, stage: str, model: str) -> None:
+        with self._lock:
+            self.stats["calls"] += 1
+            self._routed[stage][model] += 1
+
+    def _fallback(self, stage: str, model: str, error: Exception, last: bool) -> None:
+        with self._lock:
+            self.stats["exhausted" if last else "fallbacks"] += 1
+        logging.warning(f"Model {model} failed for {stage}: {type(error).__name__}. {'No more candidates.' if last else 'Falling back.'}")
+
+    def run_sync(self, stage: str, default: str, request):
+        """候補のモデルを順に試してリクエストを実行
+
+        Args:
+            stage (str): 処理段階
+            default (str): 呼び出し元が指定したモデル
+            request (callable): モデル名を受け取ってレスポンスを返す関数
+
+        Returns:
+            最初に成功したレスポンス
+
+        """
+        models = self.candidates(stage, default)
+        for i, model in enumerate(models):
+            self._routed_call(stage, model)
+            start = time.time()
+            try:
+                response = request(model)
+            except FALLBACK_ERRORS as e:
+                self.record(stage, model, time.time() - start, e)
+                self._fallback(stage, model, e, last=i == len(models) - 1)
+                if i == len(models) - 1:
+                    raise
+                continue
+            self.record(stage, model, time.time() - start)
+            return response
+
+    async def run(self, stage: str, default: str, request):
+        """run_syncの非同期版
+
+        Args:
+            stage (str): 処理段階
+            default (str): 呼び出し元が指定したモデル
+            request (callable): モデル名を受け取ってコルーチンを返す関数
+
+        Returns:
+            最初に成功したレスポンス
+
+        """
+        models = self.candidates(stage, default)
+        for i, model in enumerate(models):
+            self._routed_call(stage, model)
+            start = time.time()
+            try:
+                response = await request(model)
+            except FALLBACK_ERRORS as e:
+                self.record(stage, model, time.time() - start, e)
+                self._fallback(stage, model, e, last=i == len(models) - 1)
+                if i == len(models) - 1:
+                    raise
+                continue
+            self.record(stage, model, time.time() - start)
+            return response
+
+    def metrics(self) -> dict:
+        now = time.time()
+        with self._lock:
+            stats = dict(self.stats)
+            stats["enabled"] = self.enabled
+            stats["routed"] = {stage: dict(models) for stage, models in self._routed.items()}
+            stats["models"] = {
+                model: {
+                    "calls": len(self._outcomes[model]),
+                    "failure_rate": round(self._failure_rate(model), 3),
+                    "cooling": max(0.0, round(self._cooling_until.get(model, 0) - now, 1)),
+                }
+                for model in list(self._outcomes)
+            }
+            stats["latency"] = {
+                f"{stage}/{model}": {"p50": self._latency(stage, model, 0.5), "p90": self._latency(stage, model, 0.9)}
+                for stage, model in list(self._latencies)
+            }
+        return stats
+
+
+_default_router = None
+_default_lock = threading.Lock()
+
+
+def router_from_env() -> ModelRouter:
+    """プロセス共通のModelRouterを取得
+
+    環境変数MODEL_ROUTINGが有効な場合に振り分けを行う。MODEL_ROUTESにJSONで段階ごとの候補を上書きできる
+    （例: {"chart_fix": {"models": ["gpt-3.5-turbo"], "min_quality": 1, "max_latency": 5}}）。
+
+    Returns:
+        ModelRouter: 共通のルーター（無効な場合も呼び出し元のモデルをそのまま使うルーターを返す）
+
+    """
+    global _default_router
+    with _default_lock:
+        if _default_router is None:
+            routes = dict(DEFAULT_ROUTES)
+            routes.update(json.loads(os.getenv("MODEL_ROUTES", "{}")))
+            _default_router = ModelRouter(
+                routes=routes,
+                enabled=os.getenv("MODEL_ROUTING", "").lower() in ("1", "true", "yes"),
+                cooldown=float(os.getenv("MODEL_ROUTING_COOLDOWN", "30")),
+            )
+            metrics.register("model_routing", _default_router.metrics)
+    return _default_router
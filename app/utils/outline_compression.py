@@ -0,0 +1,184 @@
+import logging
+import os
+import re
+import time
+from collections import Counter
+import networkx as nx
+import numpy as np
+from scipy import sparse
+from utils.prompts import count_tokens
+
+# 文の区切り（句点・感嘆符・疑問符の後、または改行）
+SENTENCE_PATTERN = re.compile(r"[^。！？!?\n]+[。！？!?]*|[。！？!?]+")
+# 見出しとみなす行（Markdownの見出し、「第1章」、「1.」「(1)」「■」などで始まる短い行）
+HEADING_PATTERN = re.compile(r"^\s*(#{1,6}\s+|第[0-9０-９一二三四五六七八九十]+[章節部]|[0-9０-９]+[.．、)）]\s*|[(（][0-9０-９]+[)）]|[■□●◆◇【])")
+HEADING_MAX_CHARS = 40
+NGRAM_SIZES = (2, 3)
+NEIGHBORS = 10
+
+# compress_outlineの既定の上限（環境変数OUTLINE_TOKEN_BUDGETの既定は0で、圧縮しない）
+DEFAULT_TOKEN_BUDGET = 3000
+
+
+def is_heading(line: str) -> bool:
+    line = line.strip()
+    return bool(line) and len(line) <= HEADING_MAX_CHARS and bool(HEADING_PATTERN.match(line))
+
+
+def split_sections(text: str) -> list:
+    """テキストを見出しと空行で節に分割
+
+    Args:
+        text (str): テキスト
+
+    Returns:
+        list: 節ごとの(見出し, 本文の文のリスト)。見出しがない場合はNone
+
+    """
+    sections = []
+    heading, lines = None, []
+
+    def flush():
+        body = "\n".join(lines)
+        sentences = [sentence.strip() for sentence in SENTENCE_PATTERN.findall(body) if sentence.strip()]
+        if heading is not None or sentences:
+            sections.append((heading, sentences))
+
+    for line in text.splitlines():
+        if is_heading(line):
+            flush()
+            heading, lines = line.strip(), []
+        elif not line.strip() and lines:
+            # 空行は段落の区切りとして扱う（見出しは引き継がない）
+            flush()
+            heading, lines = None, []
+        elif line.strip():
+            lines.append(line)
+    flush()
+    return sections
+
+
+def char_ngrams(sentence: str) -> Counter:
+    sentence = re.sub(r"\s+", "", sentence)
+    return Counter(sentence[i:i + n] for n in NGRAM_SIZES for i in range(len(sentence) - n + 1))
+
+
+def rank_sentences(sentences: list) -> np.ndarray:
+    """文字n-gramのTF-IDFで文同士の類似度グラフを作り、PageRank（TextRank）で文の重要度を計算
+
+    日本語は単語の区切りがないため、形態素解析の代わりに文字n-gramを使う。
+
+    Args:
+        sentences (list): 文のリスト
+
+    Returns:
+        np.ndarray: 文ごとの重要度
+
+    """
+    if len(sentences) <= 2:
+        return np.ones(len(sentences))
+
+    counts = [char_ngrams(sentence) for sentence in sentences]
+    vocabulary = {}
+    rows, cols, values = [], [], []
+    for row, counter in enumerate(counts):
+        for gram, count in counter.items():
+            rows.append(row)
+            cols.append(vocabulary.setdefault(gram, len(vocabulary)))
+            values.append(count)
+    tf = sparse.csr_matrix((values, (rows, cols)), shape=(len(sentences), len(vocabulary)), dtype=np.float64)
+
+    document_frequency = np.bincount(tf.indices, minlength=len(vocabulary))
+    idf = np.log((1 + len(sentences)) / (1 + document_frequency)) + 1
+    tfidf = tf.multiply(idf).tocsr()
+    norms = np.sqrt(tfidf.multiply(tfidf).sum(axis=1)).A1
+    norms[norms == 0] = 1
+    tfidf = sparse.diags(1 / norms) @ tfidf
+
+    # 文が多い場合でもグラフが大きくなりすぎないよう、各文の類似度上位NEIGHBORS件だけを辺にする
+    similarity = (tfidf @ tfidf.T).tocsr()
+    similarity.setdiag(0)
+    similarity.eliminate_zeros()
+    graph = nx.Graph()
+    graph.add_nodes_from(range(len(sentences)))
+    for i in range(len(sentences)):
+        start, end = similarity.indptr[i], similarity.indptr[i + 1]
+        columns, weights = similarity.indices[start:end], similarity.data[start:end]
+        for k in np.argsort(-weights)[:NEIGHBORS]:
+            graph.add_edge(i, int(columns[k]), weight=float(weights[k]))
+    scores = nx.pagerank(graph, weight="weight")
+    return np.array([scores[i] for i in range(len(sentences))])
+
+
+def _join(sentences: list) -> str:
+    # 英文の場合のみ文の間に空白を入れる
+    text = ""
+    for sentence in sentences:
+        if text and ord(text[-1]) < 128 and ord(sentence[0]) < 128:
+            text += " "
+        text += sentence
+    return text
+
+
+def compress_outline(text: str, token_budget: int = DEFAULT_TOKEN_BUDGET) -> str:
+    """長いテキストを重要な文だけに絞り、トークン数を上限以内に収める（節の構成と文の順序は保持）
+
+    Args:
+        text (str): テキスト
+        token_budget (int): トークン数の上限
+
+    Returns:
+        str: 圧縮したテキスト（上限以内の場合はそのまま）
+
+    """
+    original_tokens = count_tokens(text)
+    if not text or original_tokens <= token_budget:
+        return text
+
+    start = time.time()
+    sections = split_sections(text)
+    sentences = [(index, position, sentence) for index, (_, body) in enumerate(sections) for position, sentence in enumerate(body)]
+    scores = rank_sentences([sentence for _, _, sentence in sentences])
+
+    # 見出しは必ず残し、各節で最も重要な文を1つ残してから、残りを重要度順に追加
+    used = sum(count_tokens(heading) for heading, _ in sections if heading) + 2 * len(sections)
+    order = sorted(range(len(sentences)), key=lambda i: -scores[i])
+    selected = set()
+    covered = set()
+    for i in order:
+        index = sentences[i][0]
+        if index not in covered:
+            cost = count_tokens(sentences[i][2])
+            if used + cost <= token_budget:
+                selected.add(i)
+                covered.add(index)
+                used += cost
+    for i in order:
+        if i not in selected:
+            cost = count_tokens(sentences[i][2])
+            if used + cost <= token_budget:
+                selected.add(i)
+                used += cost
+
+    blocks = []
+    for index, (heading, _) in enumerate(sections):
+        body = _join([sentence for i, (section, _, sentence) in enumerate(sentences) if section == index and i in selected])
+        block = "\n".join(part for part in (heading, body) if part)
+        if block:
+            blocks.append(block)
+    compressed = "\n\n".join(blocks)
+
+    logging.info(f"Outline compressed: {original_tokens} -> {count_tokens(compressed)} tokens ({len(selected)}/{len(sentences)} sentences)")
+    logging.info(f"Time Taken: {time.time() - start}")
+    return compressed
+
+
+def outline_budget_from_env() -> int:
+    """環境変数OUTLINE_TOKEN_BUDGETからテキストのトークン上限を取得（未設定または0の場合は圧縮しない）
+
+    Returns:
+        int: トークン数の上限。圧縮しない場合はNone
+
+    """
+    budget = int(os.getenv("OUTLINE_TOKEN_BUDGET", "0"))
+    return budget or None
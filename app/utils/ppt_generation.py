@@ -1,41 +1,41 @@
 from pptx import Presentation
 from pptx.util import Inches, Pt
 import logging
-import os
 import time
 from io import BytesIO
 from pptx.enum.text import PP_ALIGN
 from PIL import Image
 import base64
-import tempfile
 
-def generate_ppt(title: str, content: dict, num_of_slides: int, img_path: list, generated_graphs: list) -> Presentation:
-    """タイトルと内容からPPTを生成
+TEMPLATE_PATH = "app/utils/template.pptx"
+COVER_IMAGE = "app/template/cover.png"
+CONTENT_IMAGE = "app/template/title_content.png"
+FINAL_IMAGE = "app/template/final_page.png"
+
+
+def new_presentation() -> Presentation:
+    """テンプレートから空のPPTを作成
     
-    Args:
-        title (str): タイトル
-        content (dict): 内容
-        num_of_slides (int): スライド数
-        img_path (list): 画像のパス
-        
-    Returns: 
-        Presentation: 生成されたPPT
+    Returns:
+        Presentation: スライドサイズを設定したPPT
         
-    """ 
-    
-    start = time.time()
-    
-    # Create Presentation
-    prs = Presentation("app/utils/template.pptx")
+    """
+    prs = Presentation(TEMPLATE_PATH)
     prs.slide_width = Inches(13.333)
     prs.slide_height = Inches(7.5)
+    return prs
 
-    # Title Slide
-    title_slide = prs.slide_layouts[0]
-    slide = prs.slides.add_slide(title_slide)
-    bg = slide.shapes.add_picture('app/template/cover.png', 0, 0, height = prs.slide_height)
+
+def add_background(slide, prs: Presentation, image: str) -> None:
+    bg = slide.shapes.add_picture(image, 0, 0, height = prs.slide_height)
     slide.shapes._spTree.remove(bg._element)
     slide.shapes._spTree.insert(2, bg._element)
+
+
+def add_title_slide(prs: Presentation, title: str):
+    title_slide = prs.slide_layouts[0]
+    slide = prs.slides.add_slide(title_slide)
+    add_background(slide, prs, COVER_IMAGE)
     ppt_title = slide.shapes.title
     ppt_title.top = Inches(3)
     ppt_title.left = Inches(0.6)
@@ -44,89 +44,141 @@ def generate_ppt(title: str, content: dict, num_of_slides: int, img_path: list,
     ppt_title.text = title
     ppt_title.text_frame.paragraphs[0].alignment = PP_ALIGN.LEFT
     ppt_title.text_frame.paragraphs[0].font.name = 'Meiryo'
+    return slide
+
+
+def add_final_slide(prs: Presentation):
+    final_slide = prs.slide_layouts[6]
+    slide = prs.slides.add_slide(final_slide)
+    slide.shapes.add_picture(FINAL_IMAGE, 0, 0, height = prs.slide_height)
+    return slide
+
+
+def compute_layout(image_ratio: float = None, text_only: bool = False) -> dict:
+    """画像の縦横比からテキストと画像の配置を決定
     
-    # Content Slides
-    for i in range(num_of_slides):
-        content_slide = prs.slide_layouts[5]
-        slide = prs.slides.add_slide(content_slide)
+    Args:
+        image_ratio (float): 画像の幅/高さ（画像がない場合はNone）
+        text_only (bool): 画像を置かず、テキストを全幅に配置
+        
+    Returns:
+        dict: "text"と"image"それぞれの(left, top, width, height)
+        
+    """
+    # Set default layout (text on left, image/graph on right)
+    layout = {
+        "text": (Inches(0.6), Inches(1), Inches(6), Inches(5.5)),
+        "image": (Inches(7), Inches(1), Inches(6), Inches(5.5)),
+    }
+    
+    if text_only:
+        layout["text"] = (Inches(0.6), Inches(1), Inches(12), Inches(5.5))
+    elif image_ratio is not None and image_ratio > 2:  # Wide image, place it at the bottom
+        layout["image"] = (Inches(0.6), Inches(4), Inches(12), Inches(3))
+        layout["text"] = (Inches(0.6), Inches(1), Inches(6), Inches(3))  # Adjust text box height
+    
+    return layout
+
+
+def decode_graph(graph_data) -> bytes:
+    if isinstance(graph_data, dict) and 'base64_image' in graph_data:
+        return base64.b64decode(graph_data['base64_image'])
+    return base64.b64decode(graph_data)
+
+
+def add_content_slide(prs: Presentation, slide_content: dict, image_path: str = None, graph_data = None, text_only: bool = False):
+    """内容スライドを1枚追加
+    
+    Args:
+        prs (Presentation): 追加先のPPT
+        slide_content (dict): スライドの内容（title, content）
+        image_path (str): 図の画像のパス
+        graph_data: 生成されたグラフ（base64画像、またはbase64_imageを持つdict）
+        text_only (bool): 図とグラフを入れず、テキストだけのレイアウトにする
         
-        # Add background image
-        bg = slide.shapes.add_picture('app/template/title_content.png', 0, 0, height = prs.slide_height)
-        slide.shapes._spTree.remove(bg._element)
-        slide.shapes._spTree.insert(2, bg._element)
+    Returns:
+        Slide: 追加されたスライド
         
-        # Insert slide title
-        slide_title = slide.shapes.title
-        slide_title.text = content[f'slide{i+1}']['title']
-        slide_title.top = Inches(0.2)
-        slide_title.left = Inches(0.6)
-        slide_title.width = Inches(12)
-        slide_title.height = Inches(0.5)
-        slide_title.text_frame.paragraphs[0].font.name = 'Meiryo'
-        slide_title.text_frame.paragraphs[0].font.size = Pt(24)
-        slide_title.text_frame.paragraphs[0].font.bold = True
-
-
-        # Set default layout (text on left, image/graph on right)
-        tb_left = Inches(0.6)
-        tb_top = Inches(1)
-        tb_width = Inches(6)
-        tb_height = Inches(5.5)
+    """
+    content_slide = prs.slide_layouts[5]
+    slide = prs.slides.add_slide(content_slide)
+    
+    # Add background image
+    add_background(slide, prs, CONTENT_IMAGE)
+    
+    # Insert slide title
+    slide_title = slide.shapes.title
+    slide_title.text = slide_content['title']
+    slide_title.top = Inches(0.2)
+    slide_title.left = Inches(0.6)
+    slide_title.width = Inches(12)
+    slide_title.height = Inches(0.5)
+    slide_title.text_frame.paragraphs[0].font.name = 'Meiryo'
+    slide_title.text_frame.paragraphs[0].font.size = Pt(24)
+    slide_title.text_frame.paragraphs[0].font.bold = True
+
+    layout = compute_layout(text_only=text_only)
+
+    # Check if image exists and add it
+    if text_only:
+        pass
+    elif image_path is not None:
+        with Image.open(image_path) as image:
+            layout = compute_layout(image.width / image.height)
+        slide.shapes.add_picture(image_path, *layout["image"])
+    
+    # Check if graph exists and add it
+    elif graph_data is not None:
+        slide.shapes.add_picture(BytesIO(decode_graph(graph_data)), *layout["image"])
+    
+    # Insert content into textbox
+    tb = slide.shapes.add_textbox(*layout["text"])
+    tf = tb.text_frame
+    tf.word_wrap = True
+    for points in slide_content['content']:
+        p = tf.add_paragraph()
+        p.text = f'・{points}'
+        p.font.size = Pt(18)
+        p.font.name = 'Meiryo'
+        p = tf.add_paragraph()
+        p.text = ''
+    
+    return slide
+
+
+def generate_ppt(title: str, content: dict, num_of_slides: int, img_path: list, generated_graphs: list = None, text_only: bool = False) -> BytesIO:
+    """タイトルと内容からPPTを生成
+    
+    Args:
+        title (str): タイトル
+        content (dict): 内容
+        num_of_slides (int): スライド数
+        img_path (list): 画像のパス
+        generated_graphs (list): 生成されたグラフ
+        text_only (bool): 図とグラフを入れず、テキストだけのレイアウトにする（時間が足りない場合）
         
-        img_left = Inches(7)
-        img_top = Inches(1)
-        img_width = Inches(6)
-        img_height = Inches(5.5)
-
-        # Check if image exists and add it
-        if i < len(img_path) and img_path[i] is not None:
-            image = Image.open(img_path[i])
-            image_ratio = image.width / image.height
-            
-            if image_ratio > 2:  # Wide image, place it at the bottom
-                img_left = Inches(0.6)
-                img_top = Inches(4)
-                img_width = Inches(12)
-                img_height = Inches(3)
-                
-                tb_height = Inches(3)  # Adjust text box height
-            
-            picture = slide.shapes.add_picture(img_path[i], img_left, img_top, width=img_width, height=img_height)
+    Returns: 
+        BytesIO: 生成されたPPT
         
-        # Check if graph exists and add it
-        elif i < len(generated_graphs):
-            graph_data = generated_graphs[i]
-            
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as temp_file:
-                if isinstance(graph_data, dict) and 'base64_image' in graph_data:
-                    temp_file.write(base64.b64decode(graph_data['base64_image']))
-                else:
-                    temp_file.write(base64.b64decode(graph_data))
-                temp_file_path = temp_file.name
-
-            try:
-                slide.shapes.add_picture(temp_file_path, img_left, img_top, width=img_width, height=img_height)
-            finally:
-                os.unlink(temp_file_path)
-            
-            
-            # Insert content into textbox
-            tb = slide.shapes.add_textbox(tb_left, tb_top, tb_width, tb_height)
-            tf = tb.text_frame
-            tf.word_wrap = True
-            for points in content[f'slide{i+1}']['content']:
-                p = tf.add_paragraph()
-                p.text = f'・{points}'
-                p.font.size = Pt(18)
-                p.font.name = 'Meiryo'
-                p = tf.add_paragraph()
-                p.text = ''
+    """ 
+    
+    start = time.time()
+    generated_graphs = generated_graphs or []
     
+    # Create Presentation
+    prs = new_presentation()
+
+    # Title Slide
+    add_title_slide(prs, title)
+    
+    # Content Slides
+    for i in range(num_of_slides):
+        image_path = img_path[i] if i < len(img_path) else None
+        graph_data = generated_graphs[i] if i < len(generated_graphs) else None
+        add_content_slide(prs, content[f'slide{i+1}'], image_path=image_path, graph_data=graph_data, text_only=text_only)
   
     # Add final slides
-    final_slide = prs.slide_layouts[6]
-    slide = prs.slides.add_slide(final_slide)
-    bg = slide.shapes.add_picture('app/template/final_page.png', 0, 0, height = prs.slide_height)
+    add_final_slide(prs)
     
     # Save ppt in binary format
     binary_file = BytesIO()
@@ -134,7 +186,7 @@ def generate_ppt(title: str, content: dict, num_of_slides: int, img_path: list,
     
     time_taken = time.time() - start
     
-    logging.info(f"PPT Generated")
+    logging.info("PPT Generated")
     logging.info(f"Time taken: {time_taken}")
     
     return binary_file
@@ -147,4 +199,4 @@ if __name__ == "__main__":
     # Save binary ppt to pptx
     with open(f"../output/{title}.pptx", "wb") as f:
         f.write(binary_ppt.getbuffer())
-    logging.info(f"Saved ppt")
+    logging.info("Saved ppt")
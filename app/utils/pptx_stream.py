@@ -0,0 +1,363 @@
+import hashlib
+import logging
+import math
+import multiprocessing
+import os
+import posixpath
+import re
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from lxml import etree
+from pptx.opc.constants import RELATIONSHIP_TYPE as RT
+import utils.ppt_generation as ppt_gen
+
+NS_P = "http://schemas.openxmlformats.org/presentationml/2006/main"
+NS_R = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+NS_RELS = "http://schemas.openxmlformats.org/package/2006/relationships"
+NS_CT = "http://schemas.openxmlformats.org/package/2006/content-types"
+SLIDE_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.presentationml.slide+xml"
+
+PRESENTATION = "ppt/presentation.xml"
+PRESENTATION_RELS = "ppt/_rels/presentation.xml.rels"
+CONTENT_TYPES = "[Content_Types].xml"
+APP_PROPS = "docProps/app.xml"
+# 1つのワーカーで作成する最小のスライド数（テンプレートの読み込みとプロセス間の受け渡しの分）
+MIN_CHUNK = 4
+
+
+def build_slide_parts(slides: list, text_only: bool = False) -> list:
+    """内容スライドを作成し、パッケージに書き込むためのパーツを取り出す
+
+    Args:
+        slides (list): (slide_content, image_path, graph_data)のリスト
+        text_only (bool): 図とグラフを入れず、テキストだけのレイアウトにする
+
+    Returns:
+        list: スライドごとのdict（xml: スライドのXML, rels: リレーションのリスト）
+
+    """
+    prs = ppt_gen.new_presentation()
+    parts = []
+    for slide_content, image_path, graph_data in slides:
+        slide = ppt_gen.add_content_slide(prs, slide_content, image_path=image_path, graph_data=graph_data, text_only=text_only)
+        rels = []
+        for rId, rel in slide.part.rels.items():
+            if rel.is_external:
+                rels.append({"id": rId, "type": rel.reltype, "target": rel.target_ref, "external": True})
+            elif rel.reltype == RT.IMAGE:
+                ext = posixpath.splitext(rel.target_part.partname)[1].lstrip(".")
+                rels.append({"id": rId, "type": rel.reltype, "media": (ext, rel.target_part.blob)})
+            else:
+                target = posixpath.relpath(rel.target_part.partname, "/ppt/slides")
+                rels.append({"id": rId, "type": rel.reltype, "target": target})
+        parts.append({"xml": slide.part.blob, "rels": rels})
+    return parts
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def slide_workers_from_env() -> int:
+    """環境変数PPT_WORKERS（スライドを作成するプロセス数、0または1の場合は並列化しない）"""
+    return int(os.getenv("PPT_WORKERS", "0"))
+
+
+def _slide_pool(workers: int) -> ProcessPoolExecutor:
+    # 全資料で共通のプロセスプール（Streamlitのスレッドをforkしないようspawnで起動）
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+
+def iter_slide_parts(slides: list, text_only: bool = False, workers: int = 0, max_chunk: int = None):
+    """内容スライドのパーツを順に作成（workersが2以上の場合はスライドを分けて複数のプロセスで作成）
+
+    python-pptxでのスライドの作成（背景の配置、テキストの流し込み、画像の縦横比の取得）を並列に行い、
+    パッケージへの書き込み（StreamedDeckWriter）だけを呼び出し元で順に行う。
+
+    Args:
+        slides (list): (slide_content, image_path, graph_data)のリスト
+        text_only (bool): 図とグラフを入れず、テキストだけのレイアウトにする
+        workers (int): プロセス数
+        max_chunk (int): 1つのワーカーで作成するスライド数の上限（メモリ使用量を抑える場合）
+
+    Yields:
+        dict: build_slide_partsで作成したパーツ
+
+    """
+    if workers <= 1 or len(slides) <= MIN_CHUNK:
+        yield from build_slide_parts(slides, text_only=text_only)
+        return
+
+    chunk_size = max(MIN_CHUNK, math.ceil(len(slides) / workers))
+    if max_chunk is not None:
+        chunk_size = min(chunk_size, max_chunk)
+    chunks = [slides[i:i + chunk_size] for i in range(0, len(slides), chunk_size)]
+
+    done = 0
+    try:
+        pool = _slide_pool(workers)
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(build_slide_parts, chunk, text_only))
+            # 先に作成したパーツから書き込み、プロセス間で受け渡し中のパーツを一定数に抑える
+            if len(pending) >= workers:
+                yield from pending.popleft().result()
+                done += 1
+        while pending:
+            yield from pending.popleft().result()
+            done += 1
+    except BrokenProcessPool as e:
+        logging.warning(f"Slide worker pool failed ({e}). Building remaining slides serially.")
+        _reset_pool()
+        for chunk in chunks[done:]:
+            yield from build_slide_parts(chunk, text_only=text_only)
+
+
+def generate_ppt_parallel(title: str, content: dict, num_of_slides: int, img_path: list, generated_graphs: list = None, text_only: bool = False, workers: int = None) -> BytesIO:
+    """内容スライドを複数のプロセスで作成してPPTを生成（generate_pptと同じ内容）
+
+    Args:
+        title (str): タイトル
+        content (dict): 内容
+        num_of_slides (int): スライド数
+        img_path (list): 画像のパス
+        generated_graphs (list): 生成されたグラフ
+        text_only (bool): 図とグラフを入れず、テキストだけのレイアウトにする
+        workers (int): プロセス数。未指定の場合は環境変数PPT_WORKERS
+
+    Returns:
+        BytesIO: 生成されたPPT
+
+    """
+    start = time.time()
+    workers = slide_workers_from_env() if workers is None else workers
+    generated_graphs = generated_graphs or []
+    slides = [
+        (content[f'slide{i+1}'], img_path[i] if i < len(img_path) else None, generated_graphs[i] if i < len(generated_graphs) else None)
+        for i in range(num_of_slides)
+    ]
+
+    output = BytesIO()
+    writer = StreamedDeckWriter(title, output)
+    for part in iter_slide_parts(slides, text_only=text_only, workers=workers):
+        writer.add_slide(part)
+    writer.close()
+    output.seek(0)
+
+    logging.info(f"PPT Generated ({workers} workers)")
+    logging.info(f"Time taken: {time.time() - start}")
+    return output
+
+
+class StreamedDeckWriter:
+    def __init__(self, title: str, fileobj) -> None:
+        """表紙と最終ページのパッケージに内容スライドを順に書き込む
+
+        Args:
+            title (str): タイトル
+            fileobj: 書き込み先（シーク可能なファイル）
+
+        """
+        prs = ppt_gen.new_presentation()
+        ppt_gen.add_title_slide(prs, title)
+        ppt_gen.add_final_slide(prs)
+        skeleton = BytesIO()
+        prs.save(skeleton)
+
+        self._zin = zipfile.ZipFile(skeleton)
+        self._zout = zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED)
+        self._slides = []
+        self._media = {}
+        self._media_index = 0
+        self._extensions = set()
+
+        for name in self._zin.namelist():
+            if name.startswith("ppt/media/"):
+                self._media[hashlib.sha1(self._zin.read(name)).hexdigest()] = name
+                index = re.search(r"(\d+)", posixpath.basename(name))
+                if index:
+                    self._media_index = max(self._media_index, int(index.group(1)))
+            if name not in (PRESENTATION, PRESENTATION_RELS, CONTENT_TYPES, APP_PROPS):
+                self._zout.writestr(self._zin.getinfo(name), self._zin.read(name))
+
+    def _add_media(self, ext: str, blob: bytes) -> str:
+        digest = hashlib.sha1(blob).hexdigest()
+        if digest not in self._media:
+            self._media_index += 1
+            name = f"ppt/media/image{self._media_index}.{ext}"
+            self._zout.writestr(name, blob)
+            self._media[digest] = name
+            self._extensions.add(ext)
+        return self._media[digest]
+
+    def add_slide(self, part: dict) -> None:
+        """内容スライドを1枚書き込み
+
+        Args:
+            part (dict): build_slide_partsで作成したパーツ
+
+        """
+        # skeletonのslide1.xml（表紙）とslide2.xml（最終ページ）の後に続ける
+        number = len(self._slides) + 3
+        name = f"ppt/slides/slide{number}.xml"
+
+        rels = etree.Element(f"{{{NS_RELS}}}Relationships", nsmap={None: NS_RELS})
+        for rel in part["rels"]:
+            element = etree.SubElement(rels, f"{{{NS_RELS}}}Relationship", Id=rel["id"], Type=rel["type"])
+            if "media" in rel:
+                element.set("Target", "../media/" + posixpath.basename(self._add_media(*rel["media"])))
+            else:
+                element.set("Target", rel["target"])
+                if rel.get("external"):
+                    element.set("TargetMode", "External")
+
+        self._zout.writestr(name, part["xml"])
+        self._zout.writestr(f"ppt/slides/_rels/slide{number}.xml.rels", etree.tostring(rels, xml_declaration=True, encoding="UTF-8", standalone=True))
+        self._slides.append(name)
+
+    def close(self) -> None:
+        # presentation.xmlのスライド一覧に内容スライドを追加（表紙の直後）
+        presentation = etree.fromstring(self._zin.read(PRESENTATION))
+        presentation_rels = etree.fromstring(self._zin.read(PRESENTATION_RELS))
+        slide_list = presentation.find(f"{{{NS_P}}}sldIdLst")
+
+        rel_ids = [int(rel.get("Id")[3:]) for rel in presentation_rels if rel.get("Id", "").startswith("rId")]
+        slide_ids = [int(slide.get("id")) for slide in slide_list]
+        next_rel = max(rel_ids) + 1
+        next_id = max(slide_ids) + 1
+
+        for i, name in enumerate(self._slides):
+            rId = f"rId{next_rel + i}"
+            etree.SubElement(presentation_rels, f"{{{NS_RELS}}}Relationship", Id=rId, Type=RT.SLIDE, Target=posixpath.relpath(name, "ppt"))
+            slide_id = etree.Element(f"{{{NS_P}}}sldId", id=str(next_id + i))
+            slide_id.set(f"{{{NS_R}}}id", rId)
+            slide_list.insert(i + 1, slide_id)
+
+        content_types = etree.fromstring(self._zin.read(CONTENT_TYPES))
+        defaults = {element.get("Extension") for element in content_types if element.get("Extension")}
+        for ext in self._extensions - defaults:
+            etree.SubElement(content_types, f"{{{NS_CT}}}Default", Extension=ext, ContentType=f"image/{'jpeg' if ext == 'jpg' else ext}")
+        for name in self._slides:
+            etree.SubElement(content_types, f"{{{NS_CT}}}Override", PartName=f"/{name}", ContentType=SLIDE_CONTENT_TYPE)
+
+        app_props = self._zin.read(APP_PROPS).decode("utf-8")
+        app_props = re.sub(r"<Slides>\d+</Slides>", f"<Slides>{len(self._slides) + 2}</Slides>", app_props)
+
+        for name, element in ((PRESENTATION, presentation), (PRESENTATION_RELS, presentation_rels), (CONTENT_TYPES, content_types)):
+            self._zout.writestr(name, etree.tostring(element, xml_declaration=True, encoding="UTF-8", standalone=True))
+        self._zout.writestr(APP_PROPS, app_props)
+        self._zout.close()
+        self._zin.close()
+
+
+def generate_ppt_streamed(title: str, content: dict, num_of_slides: int, img_path: list, generated_graphs: list = None, batch_size: int = 20, spool_size: int = 32 * 1024 * 1024, text_only: bool = False, workers: int = None):
+    """大規模な資料向けに、一定枚数ずつスライドを作成してファイルに書き出す
+
+    Args:
+        title (str): タイトル
+        content (dict): 内容
+        num_of_slides (int): スライド数
+        img_path (list): 画像のパス
+        generated_graphs (list): 生成されたグラフ
+        batch_size (int): 一度にメモリ上で作成するスライド数
+        spool_size (int): このサイズを超えたらディスクに書き出す（バイト）
+        text_only (bool): 図とグラフを入れず、テキストだけのレイアウトにする
+        workers (int): スライドを作成するプロセス数。未指定の場合は環境変数PPT_WORKERS
+
+    Returns:
+        SpooledTemporaryFile: 生成されたPPT（先頭にシーク済み）
+
+    """
+    start = time.time()
+    workers = slide_workers_from_env() if workers is None else workers
+    generated_graphs = generated_graphs or []
+    output = tempfile.SpooledTemporaryFile(max_size=spool_size, suffix=".pptx")
+    writer = StreamedDeckWriter(title, output)
+
+    slides = [
+        (content[f'slide{i+1}'], img_path[i] if i < len(img_path) else None, generated_graphs[i] if i < len(generated_graphs) else None)
+        for i in range(num_of_slides)
+    ]
+    # 並列の場合もワーカーごとのスライド数はbatch_size以下にして、メモリ上のスライド数を抑える
+    for batch_start in range(0, num_of_slides, batch_size * max(workers, 1)):
+        batch = slides[batch_start:batch_start + batch_size * max(workers, 1)]
+        for part in iter_slide_parts(batch, text_only=text_only, workers=workers, max_chunk=batch_size):
+            writer.add_slide(part)
+
+    writer.close()
+    output.seek(0)
+
+    logging.info("PPT Generated (streamed)")
+    logging.info(f"Time taken: {time.time() - start}")
+    return output
+
+
+def iter_chunks(fileobj, chunk_size: int = 1024 * 1024):
+    fileobj.seek(0)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _benchmark(mode: str, num_of_slides: int, image_path: str, queue) -> None:
+    # resourceはUnixのみ（ベンチマークだけで使い、アプリの読み込みでは使わない）
+    import resource
+
+    content = {
+        f"slide{i+1}": {"title": f"スライド {i+1}", "content": ["箇条書きのテキストです。" * 3] * 4}
+        for i in range(num_of_slides)
+    }
+    img_path = [image_path.format(i) for i in range(num_of_slides)]
+    start = time.time()
+    if mode == "memory":
+        size = len(ppt_gen.generate_ppt("benchmark", content, num_of_slides, img_path).getbuffer())
+    elif mode == "parallel":
+        size = len(generate_ppt_parallel("benchmark", content, num_of_slides, img_path, workers=os.cpu_count()).getbuffer())
+    else:
+        output = generate_ppt_streamed("benchmark", content, num_of_slides, img_path)
+        size = output.seek(0, 2)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak *= 1024
+    queue.put((time.time() - start, peak, size))
+
+
+if __name__ == "__main__":
+    # PYTHONPATH=app python app/utils/pptx_stream.py （リポジトリのルートで実行）
+    from PIL import Image
+
+    logging.getLogger().setLevel(logging.WARNING)
+    tempdir = tempfile.mkdtemp()
+    # スライドごとに異なる図（圧縮の効かない画像）
+    for i in range(300):
+        Image.frombytes("RGB", (300, 200), os.urandom(300 * 200 * 3)).save(os.path.join(tempdir, f"chart_{i}.png"))
+
+    context = multiprocessing.get_context("spawn")
+    print(f"{'slides':>6} {'mode':>8} {'time (s)':>9} {'peak RSS (MB)':>14} {'size (MB)':>10}")
+    for num_of_slides in (20, 100, 300):
+        for mode in ("memory", "streamed", "parallel"):
+            queue = context.Queue()
+            process = context.Process(target=_benchmark, args=(mode, num_of_slides, os.path.join(tempdir, "chart_{}.png"), queue))
+            process.start()
+            elapsed, peak, size = queue.get()
+            process.join()
+            print(f"{num_of_slides:>6} {mode:>8} {elapsed:>9.2f} {peak / 1024 / 1024:>14.1f} {size / 1024 / 1024:>10.1f}")
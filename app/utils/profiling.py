@@ -0,0 +1,305 @@
+import argparse
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, nullcontext
+
+MODES = ("sample", "cprofile")
+DEFAULT_INTERVAL = 0.005
+TOP_N = 30
+# appディレクトリのコードを実行しているスレッドだけを記録する（待機中のワーカーやStreamlitのサーバーを除く）
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SUBPROCESS_FILES = ("subprocess.py",)
+WAIT_FILES = ("threading.py", "queue.py", "_base.py")
+NETWORK_FILES = ("socket.py", "ssl.py", "selectors.py", "httpx", "httpcore", "urllib3", "requests", "anyio", "base_events.py")
+PROFILE_SUFFIXES = (".collapsed", ".prof", ".top.txt")
+DEFAULT_MAX_FILES = 60
+
+
+def request_allowed(token: str) -> bool:
+    """リクエストごとのプロファイル（URLの?profile=）を許可するか
+
+    Args:
+        token (str): リクエストで渡されたトークン（URLの?profile_token=）
+
+    Returns:
+        bool: 環境変数PROFILE_TOKENS（カンマ区切り）のいずれかと一致する場合True。未設定の場合は常にFalse
+
+    """
+    allowed = {item.strip() for item in os.getenv("PROFILE_TOKENS", "").split(",") if item.strip()}
+    return bool(token) and token in allowed
+
+
+class ProfileLimiter:
+    def __init__(self, max_files: int = DEFAULT_MAX_FILES, max_requests: int = 10000) -> None:
+        """リクエストごとのプロファイルを1回に限り、出力先のファイル数を制限する
+
+        Args:
+            max_files (int): 出力先に残すプロファイルのファイル数（古いものから削除）
+            max_requests (int): プロファイル済みとして覚えておくリクエストIDの数
+
+        """
+        self.max_files = max_files
+        self.max_requests = max_requests
+        self._lock = threading.Lock()
+        self._claimed = OrderedDict()
+
+    def claim(self, request_id: str) -> bool:
+        """リクエストIDを初めてプロファイルする場合にTrue（Streamlitの再実行やジョブの再実行では再度プロファイルしない）
+
+        Args:
+            request_id (str): リクエストID
+
+        Returns:
+            bool: プロファイルしてよい場合True
+
+        """
+        with self._lock:
+            if request_id in self._claimed:
+                return False
+            self._claimed[request_id] = True
+            while len(self._claimed) > self.max_requests:
+                self._claimed.popitem(last=False)
+        return True
+
+    def prune(self, output_dir: str) -> None:
+        # 資料などと同じディレクトリに出力するため、プロファイルの拡張子のファイルだけを対象にする
+        with self._lock:
+            paths = [os.path.join(output_dir, name) for name in os.listdir(output_dir) if name.endswith(PROFILE_SUFFIXES)]
+            paths.sort(key=lambda path: os.path.getmtime(path))
+            for path in paths[:max(len(paths) - self.max_files, 0)]:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logging.debug(f"Failed to remove profile {path}: {e}")
+
+
+limiter = ProfileLimiter(max_files=int(os.getenv("PROFILE_MAX_FILES", DEFAULT_MAX_FILES)))
+
+
+def resolve_mode(requested: str = None) -> str:
+    """プロファイルの方法を決定（クエリパラメータなどの指定 > コマンドラインの--profile > 環境変数PROFILE）
+
+    Args:
+        requested (str): リクエストごとの指定（例: URLの?profile=sample）
+
+    Returns:
+        str: "sample"または"cprofile"。プロファイルしない場合はNone
+
+    """
+    mode = requested
+    if not mode and "--profile" in sys.argv:
+        index = sys.argv.index("--profile")
+        mode = sys.argv[index + 1] if index + 1 < len(sys.argv) else "sample"
+    if not mode:
+        mode = os.getenv("PROFILE")
+    if not mode or mode in ("0", "off", "false"):
+        return None
+    if mode in ("1", "on", "true"):
+        return "sample"
+    if mode not in MODES:
+        logging.warning(f"Unknown profile mode: {mode}. Choose from {MODES}")
+        return None
+    return mode
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _category(label: str) -> str:
+    filename = label[label.rindex("(") + 1:].split(":")[0]
+    if filename in SUBPROCESS_FILES:
+        return "subprocess"
+    if filename in WAIT_FILES:
+        return "thread wait"
+    if any(name in filename for name in NETWORK_FILES):
+        return "network"
+    return "python"
+
+
+class StackSampler:
+    def __init__(self, interval: float = DEFAULT_INTERVAL) -> None:
+        """一定間隔でスレッドのスタックを記録する（flamegraph.plやspeedscopeで読める形式に出力）
+
+        Args:
+            interval (float): 記録する間隔（秒）
+
+        """
+        self.interval = interval
+        self.samples = Counter()
+        self._target = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _include(self, thread_id: int, name: str, stack: list) -> bool:
+        if thread_id == self._target:
+            return True
+        # 他のセッションのスクリプト実行は除く
+        if name.startswith("ScriptRunner"):
+            return False
+        return any(frame.f_code.co_filename.startswith(APP_DIR) for frame in stack)
+
+    def _sample(self) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self._thread.ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame)
+                frame = frame.f_back
+            name = names.get(thread_id, str(thread_id))
+            if not self._include(thread_id, name, stack):
+                continue
+            labels = [name] + [_frame_label(frame) for frame in reversed(stack)]
+            self.samples[";".join(labels)] += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self._sample()
+            except Exception as e:
+                logging.debug(f"Sampling failed: {e}")
+
+    def start(self) -> None:
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def top(self, n: int = TOP_N) -> str:
+        total = sum(self.samples.values())
+        if not total:
+            return "No samples.\n"
+        own, inclusive, categories = Counter(), Counter(), Counter()
+        for stack, count in self.samples.items():
+            frames = stack.split(";")[1:]
+            own[frames[-1]] += count
+            categories[_category(frames[-1])] += count
+            for label in set(frames):
+                inclusive[label] += count
+
+        def rows(counter):
+            return "".join(f"{count / total:7.1%} {count * self.interval:8.2f}s  {label}\n" for label, count in counter.most_common(n))
+
+        by_category = "".join(f"{count / total:7.1%} {count * self.interval:8.2f}s  {name}\n" for name, count in categories.most_common())
+        return (f"{total} samples every {self.interval * 1000:.0f}ms\n\n"
+                f"# By category (leaf frame)\n{by_category}\n"
+                f"# Top {n} by self time\n{rows(own)}\n"
+                f"# Top {n} by total time\n{rows(inclusive)}")
+
+
+def _write(path: str, text: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+@contextmanager
+def profile_run(name: str, mode: str = None, output_dir: str = "profiles", interval: float = None, top_n: int = TOP_N):
+    """処理を1回プロファイルし、結果をoutput_dirに書き出す（modeがNoneの場合は何もしない）
+
+    sampleは呼び出したスレッドとappのコードを実行中のスレッド（ヘッジなど）のスタックを記録し、
+    {name}.collapsed（flamegraph形式）と{name}.top.txtを出力する。
+    cprofileは呼び出したスレッドだけを計測し、{name}.prof（pstats形式）と{name}.top.txtを出力する。
+
+    Args:
+        name (str): 出力ファイル名（拡張子なし）
+        mode (str): "sample"または"cprofile"
+        output_dir (str): 出力先
+        interval (float): sampleの記録間隔（秒）。未指定の場合は環境変数PROFILE_INTERVAL
+        top_n (int): 集計に出す関数の数
+
+    """
+    if mode is None:
+        yield None
+        return
+
+    os.makedirs(output_dir, exist_ok=True)
+    base = os.path.join(output_dir, name)
+    start = time.time()
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # 他のスレッドでcProfileが動いている場合（Python 3.12以降）はサンプリングで代用
+            logging.warning(f"cProfile unavailable ({e}). Falling back to sampling.")
+            mode = "sample"
+    if mode == "sample":
+        profiler = StackSampler(interval or float(os.getenv("PROFILE_INTERVAL", DEFAULT_INTERVAL)))
+        profiler.start()
+    try:
+        yield profiler
+    finally:
+        elapsed = time.time() - start
+        if mode == "cprofile":
+            profiler.disable()
+            profiler.dump_stats(f"{base}.prof")
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(top_n)
+            _write(f"{base}.top.txt", f"{name}: {elapsed:.2f}s\n{stream.getvalue()}")
+            outputs = (f"{base}.prof", f"{base}.top.txt")
+        else:
+            profiler.stop()
+            _write(f"{base}.collapsed", profiler.collapsed())
+            _write(f"{base}.top.txt", f"{name}: {elapsed:.2f}s\n{profiler.top(top_n)}")
+            outputs = (f"{base}.collapsed", f"{base}.top.txt")
+        limiter.prune(output_dir)
+        logging.info(f"Profile written: {outputs}. Time Taken: {elapsed}")
+
+
+def maybe_profile(name: str, requested: str = None, output_dir: str = "profiles", request_id: str = None):
+    """resolve_modeで有効な場合だけprofile_runを返す（無効な場合のオーバーヘッドはnullcontextのみ）
+
+    Args:
+        name (str): 出力ファイル名（拡張子なし）
+        requested (str): リクエストごとの指定（request_allowedで確認済みの値）
+        output_dir (str): 出力先
+        request_id (str): リクエストID（requestedによるプロファイルは同じIDで1回だけ）
+
+    """
+    if requested and not limiter.claim(request_id or name):
+        requested = None
+    mode = resolve_mode(requested)
+    if mode is None:
+        return nullcontext()
+    return profile_run(name, mode, output_dir)
+
+
+def main() -> None:
+    # PYTHONPATH=app python app/utils/profiling.py --profile sample --outline-file outline.txt （リポジトリのルートで実行）
+    parser = argparse.ArgumentParser(description="資料の生成を1回プロファイルする")
+    parser.add_argument("--profile", choices=MODES, default="sample", help="プロファイルの方法")
+    parser.add_argument("--title", default="プロファイル", help="タイトル")
+    parser.add_argument("--outline-file", required=True, help="アウトラインのテキストファイル")
+    parser.add_argument("--slides", type=int, default=5, help="内容スライド数")
+    parser.add_argument("--large", action="store_true", help="大規模モード")
+    parser.add_argument("--output-dir", default="profiles", help="資料とプロファイルの保存先")
+    args = parser.parse_args()
+
+    from utils.deck_pipeline import generate_deck
+
+    with open(args.outline_file, encoding="utf-8") as f:
+        outline = f.read()
+    name = f"deck_{int(time.time())}"
+    with profile_run(name, args.profile, args.output_dir):
+        deck = generate_deck(args.title, outline, args.slides, large=args.large)
+        deck.write_to(os.path.join(args.output_dir, f"{name}.pptx"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import functools
+import hashlib
+import logging
+import math
+import textwrap
+from utils import metrics
+
+# プロンプトはすべてここで管理する。systemは変数を含まない固定の文字列（バイト単位で同じ先頭部分）にして、
+# プロバイダー側のプロンプトキャッシュで再利用できるようにし、リクエストごとに変わる内容はuserに後置する。
+# 文言を変えた場合はversionを上げる（メトリクスのprefix_hashと合わせて、どの版が使われているかを確認できる）。
+# OpenAIのプロンプトキャッシュは先頭部分がMIN_CACHED_PREFIX_TOKENS以上の場合だけ効くため、
+# それより短いsystemは揃えてもキャッシュされない（メトリクスのprefix_tokensとcacheableで確認できる）。
+MIN_CACHED_PREFIX_TOKENS = 1024
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding():
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model("gpt-4o")
+    except Exception as e:
+        logging.info(f"tiktoken unavailable ({e}). Estimating prompt tokens from characters.")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """テキストのトークン数を取得（tiktokenがない場合や語彙を取得できない場合は文字数から見積もる）
+
+    Args:
+        text (str): テキスト
+
+    Returns:
+        int: トークン数
+
+    """
+    encoding = _encoding()
+    if encoding is None:
+        # 英数字は約4文字、それ以外（日本語など）は約1文字で1トークンとして見積もる
+        ascii_chars = sum(1 for char in text if ord(char) < 128)
+        return math.ceil(ascii_chars / 4) + len(text) - ascii_chars
+    return len(encoding.encode(text))
+
+
+def _text(text: str) -> str:
+    return textwrap.dedent(text).strip()
+
+
+class PromptTemplate:
+    def __init__(self, name: str, version: int, system: str, user: str) -> None:
+        """固定のsystemと、変数を埋め込むuserからなるプロンプト
+
+        Args:
+            name (str): 名前
+            version (int): 版
+            system (str): 固定の指示と例（str.formatは適用しない）
+            user (str): リクエストごとの内容（str.formatの書式）
+
+        """
+        self.name = name
+        self.version = version
+        self.system = _text(system)
+        self.user = _text(user)
+        self.prefix_hash = hashlib.sha256(self.system.encode("utf-8")).hexdigest()[:12]
+
+    @functools.cached_property
+    def prefix_tokens(self) -> int:
+        return count_tokens(self.system)
+
+    def messages(self, **variables) -> list:
+        """リクエストのmessagesを作成
+
+        Args:
+            **variables: userに埋め込む値
+
+        Returns:
+            list: system, userのmessages
+
+        """
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.user.format(**variables)},
+        ]
+
+
+SLIDE_EXAMPLE = """
+{
+    "slide1": {
+        "title": "生成型AI(ジェネラティブAI)とは",
+        "content": [
+            "生成型AIは学習データから新しいコンテンツを生成する人工知能の一種です。",
+            "自然言語処理、画像生成、音声合成など多岐にわたる応用が可能です。",
+            "代表的な技術にはGAN(Generative Adversarial Networks)や変分オートエンコーダーがあります。",
+            "データの内在するパターンを理解し、それに基づいて新しいデータを創出します。"
+        ],
+        "graphic_prompt": "AIのシンボル(人工知能の脳)がデジタル情報(0と1)を吸収している様子"
+    },
+    "slide2": {
+        "title": "ジェネラティブAIの応用例",
+        "content": [
+            "テキスト：チャットボット、物語や記事の自動生成、プログラムコードの作成補助。",
+            "画像：アート作品の生成、写真リアルなイメージの作成、顔写真の年齢変化シミュレーション。",
+            "音声：バーチャルアシスタントの応答音声生成、オーディオブック読み上げ、音楽作成。",
+            "予測分析：商品需要予測や金融市場予測などビジネスでの意思決定支援。"
+        ],
+        "graphic_prompt": "様々な応用分野（記事、ゲーム、音楽、教育）が回転する歯車として描かれるイメージ"
+    }
+}
+"""
+
+CHART_EXAMPLES = {
+    "er_diagram": """
+        erDiagram
+            CUSTOMER }|..|{ DELIVERY-ADDRESS : has
+            CUSTOMER ||--o{ ORDER : places
+            CUSTOMER ||--o{ INVOICE : "liable for"
+            DELIVERY-ADDRESS ||--o{ ORDER : receives
+            INVOICE ||--|{ ORDER : covers
+            ORDER ||--|{ ORDER-ITEM : includes
+            PRODUCT-CATEGORY ||--|{ PRODUCT : contains
+            PRODUCT ||--o{ ORDER-ITEM : "ordered in"
+        """,
+    "flowchart": """
+        flowchart TD
+            Start --> Stop
+        """,
+    "mindmap": """
+        mindmap
+          root((mindmap))
+            Origins
+              Long history
+              ::icon(fa fa-book)
+              Popularisation
+                British popular psychology author Tony Buzan
+            Research
+              On effectivness<br/>and features
+              On Automatic creation
+                Uses
+                    Creative techniques
+                    Strategic planning
+                    Argument mapping
+            Tools
+              Pen and paper
+              Mermaid
+        """,
+    "timeline": """
+        timeline
+            title History of Social Media Platform
+            2002 : LinkedIn
+            2004 : Facebook
+                 : Google
+            2005 : Youtube
+            2006 : Twitter
+        """,
+}
+
+# 資料全体の生成、足りないスライドの再生成、1枚の書き直しで同じsystemを使う
+PRESENTER_SYSTEM = """
+You will act as a business presenter that speaks and writes fluently in Japanese.
+I will give you the title and materials, and you will summarize them into an easy to understand presentation, or rewrite one slide of it.
+The presentation should be written in Japanese. Summarize into 2 to 5 bullet points for each slide. Do not generate any escape sequence.
+Suggest a graphic to help provide a visual to reinforce each slide. Label the graphic as a prompt to be used with DALL-E 3 to generate the graphic.
+Response should be in JSON format like the example below. When asked to rewrite one slide, return only the slide as a JSON object with the keys title, content and graphic_prompt.
+Example:
+""" + _text(SLIDE_EXAMPLE)
+
+CONTENT = PromptTemplate(
+    "content",
+    version=2,
+    system=PRESENTER_SYSTEM,
+    user="""
+        You will provide content for a presentation on {title} based on the text provided.
+        Split the text into {num_of_slides} slides. {part}
+        Text: {outline}
+        """,
+)
+
+SLIDE = PromptTemplate(
+    "slide",
+    version=2,
+    system=PRESENTER_SYSTEM,
+    user="""
+        You will rewrite one slide of a presentation on {title} based on the text provided.
+        Instruction: {instruction}
+        Current slide: {slide}
+        Text: {outline}
+        """,
+)
+
+
+def chart_example(chart_type: str) -> str:
+    return _text(CHART_EXAMPLES[chart_type])
+
+
+# すべての例をsystemに含めても先頭部分がMIN_CACHED_PREFIX_TOKENSに届かずキャッシュされないため、
+# 例は指定された種類の1つだけをuserに含める（systemは種類によらず同じ）
+CHART = PromptTemplate(
+    "chart",
+    version=3,
+    system="""
+        You will act as a engineer fluent in making chart, mindmaps, timelines, ER diagrams etc. in mermaid.js.
+        I will give you the content, type of chart, an example of that type of chart, and a customization prompt. You will generate a mermaid.js chart of that type that follow the customization prompt.
+        Start from the example and make necesssary changes based on customization prompt. Do not use theme as it is not supported with CLI.
+        Only return the mermaid.js code.
+        """,
+    user="""
+        Type of chart: {chart_type}
+        Example:
+        {example}
+        Customization prompt: {custom_prompt}
+        Content: {content}
+        """,
+)
+
+CHART_FIX = PromptTemplate(
+    "chart_fix",
+    version=2,
+    system="""
+        You are a software engineer who is fluent in fixing mermaid.js code errors. I will give you a code snippet and an error message.
+        You will fix the code to remove the error. Only return the fixed mermaid.js code
+        """,
+    user="""
+        #Error: {error}
+        #Code: {code}
+        """,
+)
+
+FEATURE_DESCRIPTION = PromptTemplate(
+    "feature_description",
+    version=2,
+    system="""
+        あなたは、経験豊富なデータアナリストです。与えられた目的に沿ったデータを説明してください。
+        必ず日本語で出力してください。体言止めにしてください。説明には改行などのフォーマットやラベルを絶対に含まないでください。
+        以下の項目について説明してください。
+        1. データセットの目的: データセットの目的を説明する文章は末尾に〜データセットとなるようにしてください。要点を簡潔に表現してください。
+        2. グラフの解釈: グラフが何を示しているのか、視覚的な観点から説明してください。要点を簡潔に表現してください。
+        3. 主要なインサイト: データセットやグラフから得られる具体的な発見やトレンドを詳細に説明してください。具体的な数値や変化に触れて事実を述べてください。
+
+        それぞれの項目で説明する内容が重複しないように注意してください。以下の形式に従ってください：
+        {
+            "dataset_purpose": "データセットの目的",
+            "graph_interpretation": "グラフの解釈",
+            "key_insights": "主要なインサイト"
+        }
+        """,
+    user="""
+        目的: {goal}
+        フィールドの情報: {fields}
+        以下の画像は作成したグラフを示しています。参考にしてください：
+        data:image/png;base64,{base64_image}
+        """,
+)
+
+COLUMN_ANNOTATION = PromptTemplate(
+    "column_annotation",
+    version=1,
+    system="""
+        You are an experienced data analyst that can annotate datasets. Your instructions are as follows:
+        i) ALWAYS generate a field description for each field.
+        ii) ALWAYS generate a semantic_type (a single word) for each field given its values e.g. company, city, number, supplier, location, gender, longitude, latitude, url, ip address, zip code, email, etc
+        iii) Annotate every field in the list, even if the list is part of a larger dataset.
+        You must return a JSON object {"fields": [{"column": ..., "semantic_type": ..., "description": ...}]} without any preamble or explanation.
+        """,
+    user="{content}",
+)
+
+DATASET_DESCRIPTION = PromptTemplate(
+    "dataset_description",
+    version=1,
+    system="""
+        You are an experienced data analyst that can annotate datasets.
+        Given the file name and the column names of a dataset, generate the name of the dataset and the dataset_description.
+        You must return a JSON object {"name": ..., "dataset_description": ...} without any preamble or explanation.
+        """,
+    user="{content}",
+)
+
+TEMPLATES = (CONTENT, SLIDE, CHART, CHART_FIX, FEATURE_DESCRIPTION, COLUMN_ANNOTATION, DATASET_DESCRIPTION)
+
+
+def report() -> dict:
+    return {
+        template.name: {
+            "version": template.version,
+            "prefix_hash": template.prefix_hash,
+            "prefix_tokens": template.prefix_tokens,
+            "cacheable": template.prefix_tokens >= MIN_CACHED_PREFIX_TOKENS,
+        }
+        for template in TEMPLATES
+    }
+
+
+metrics.register("prompts", report)
@@ -0,0 +1,253 @@
+import base64
+import logging
+import time
+import warnings
+from io import BytesIO
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from utils.fonts import cjk_font_properties
+from utils.graphic.native_renderer import PALETTE
+
+# 値の種類がこれ以下の列はカテゴリとして扱う（アンケートの5段階評価など）
+MAX_CATEGORIES = 10
+MAX_SERIES = 5
+FIGURE_SIZE = (8, 4.5)
+DPI = 100
+GRID_COLOR = "#E0E0E0"
+TEXT_COLOR = "#333333"
+
+CODE_HEADER = """import matplotlib.pyplot as plt
+import pandas as pd
+
+# quick chart ({kind})
+def plot(data: pd.DataFrame):
+"""
+CODE_FOOTER = """    plt.title({title!r})
+    return plt
+
+chart = plot(data)"""
+
+
+def _is_date(series: pd.Series) -> bool:
+    sample = series.dropna().head(20)
+    if sample.empty:
+        return False
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return pd.to_datetime(sample, errors="coerce").notna().all()
+
+
+def _infer_fields(data: pd.DataFrame) -> list:
+    fields = []
+    for column in data.columns:
+        series = data[column]
+        if pd.api.types.is_bool_dtype(series):
+            dtype = "boolean"
+        elif pd.api.types.is_numeric_dtype(series):
+            dtype = "number"
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            dtype = "date"
+        elif _is_date(series):
+            dtype = "date"
+        else:
+            dtype = "category" if series.nunique() / max(len(series), 1) < 0.5 else "string"
+        fields.append({"column": column, "properties": {"dtype": dtype, "num_unique_values": int(series.nunique())}})
+    return fields
+
+
+def recommend_charts(summary: dict, data: pd.DataFrame = None, max_charts: int = 4) -> list:
+    """列の型と値の種類数から、LLMを使わずにグラフの種類を選ぶ
+
+    Args:
+        summary (dict): LIDAの要約（fieldsがない場合はdataから判定）
+        data (pd.DataFrame): データ
+        max_charts (int): グラフ数の上限
+
+    Returns:
+        list: グラフの仕様（kind, columns, title）のリスト
+
+    """
+    fields = summary.get("fields") if summary else None
+    if not fields:
+        fields = _infer_fields(data) if data is not None else []
+    if data is not None:
+        fields = [field for field in fields if field["column"] in data.columns]
+
+    def columns(*dtypes):
+        return [field["column"] for field in fields if field["properties"].get("dtype") in dtypes]
+
+    def unique(column):
+        return next(field["properties"].get("num_unique_values", 0) for field in fields if field["column"] == column)
+
+    numbers = columns("number")
+    dates = columns("date")
+    categories = [column for column in columns("category", "boolean", "string") if unique(column) <= MAX_CATEGORIES * 3]
+    discrete = [column for column in numbers if unique(column) <= MAX_CATEGORIES]
+    continuous = [column for column in numbers if column not in discrete]
+
+    specs = []
+    if dates and numbers:
+        specs.append({"kind": "time_series", "columns": [dates[0]] + numbers[:MAX_SERIES],
+                      "title": f"{'・'.join(numbers[:MAX_SERIES])}の推移"})
+    if len(discrete) >= 2:
+        specs.append({"kind": "paired_bar", "columns": discrete[:MAX_SERIES],
+                      "title": f"{'と'.join(discrete[:MAX_SERIES])}の回答分布"})
+    if len(continuous) >= 2:
+        specs.append({"kind": "scatter", "columns": continuous[:2],
+                      "title": f"{continuous[0]}と{continuous[1]}の関係"})
+    if len(numbers) >= 2:
+        specs.append({"kind": "box", "columns": numbers[:MAX_SERIES],
+                      "title": f"{'・'.join(numbers[:MAX_SERIES])}の比較"})
+    if categories and numbers:
+        specs.append({"kind": "category_bar", "columns": [categories[0], numbers[0]],
+                      "title": f"{categories[0]}別の{numbers[0]}の平均"})
+    for column in numbers[:2]:
+        specs.append({"kind": "distribution", "columns": [column], "title": f"{column}の分布"})
+    for column in categories[:2]:
+        specs.append({"kind": "count_bar", "columns": [column], "title": f"{column}の件数"})
+    return specs[:max_charts]
+
+
+def _value_counts(data: pd.DataFrame, columns: list) -> pd.DataFrame:
+    return pd.DataFrame({column: data[column].value_counts() for column in columns}).sort_index().fillna(0)
+
+
+def _top_categories(data: pd.DataFrame, category: str) -> list:
+    return data[category].value_counts().index[:MAX_CATEGORIES].tolist()
+
+
+def _draw(ax, data: pd.DataFrame, spec: dict, font) -> None:
+    kind, columns = spec["kind"], spec["columns"]
+    if kind == "paired_bar":
+        counts = _value_counts(data, columns)
+        width = 0.8 / len(columns)
+        x = np.arange(len(counts.index))
+        for i, column in enumerate(columns):
+            ax.bar(x + (i - (len(columns) - 1) / 2) * width, counts[column], width=width,
+                   color=PALETTE[i % len(PALETTE)], label=column)
+        ax.set_xticks(x)
+        ax.set_xticklabels([f"{value:g}" if isinstance(value, float) else str(value) for value in counts.index])
+        ax.set_xlabel("値", fontproperties=font)
+        ax.set_ylabel("件数", fontproperties=font)
+        ax.legend(prop=font, frameon=False)
+    elif kind == "distribution":
+        series = data[columns[0]].dropna()
+        if series.nunique() <= MAX_CATEGORIES:
+            counts = series.value_counts().sort_index()
+            ax.bar([str(value) for value in counts.index], counts.values, color=PALETTE[0])
+        else:
+            ax.hist(series, bins=min(30, max(10, int(np.sqrt(len(series))))), color=PALETTE[0], edgecolor="white")
+        ax.set_xlabel(columns[0], fontproperties=font)
+        ax.set_ylabel("件数", fontproperties=font)
+    elif kind == "scatter":
+        ax.scatter(data[columns[0]], data[columns[1]], s=18, alpha=0.6, color=PALETTE[0])
+        ax.set_xlabel(columns[0], fontproperties=font)
+        ax.set_ylabel(columns[1], fontproperties=font)
+    elif kind == "box":
+        ax.boxplot([data[column].dropna() for column in columns], patch_artist=True,
+                   boxprops={"facecolor": PALETTE[0], "alpha": 0.6}, medianprops={"color": TEXT_COLOR})
+        ax.set_xticks(range(1, len(columns) + 1))
+        ax.set_xticklabels(columns)
+    elif kind == "time_series":
+        dates = pd.to_datetime(data[columns[0]], errors="coerce")
+        ordered = data.assign(**{columns[0]: dates}).dropna(subset=[columns[0]]).sort_values(columns[0])
+        for i, column in enumerate(columns[1:]):
+            ax.plot(ordered[columns[0]], ordered[column], color=PALETTE[i % len(PALETTE)], label=column, linewidth=2)
+        ax.set_xlabel(columns[0], fontproperties=font)
+        ax.legend(prop=font, frameon=False)
+    elif kind == "category_bar":
+        category, value = columns
+        means = data[data[category].isin(_top_categories(data, category))].groupby(category)[value].mean().sort_values(ascending=False)
+        ax.bar([str(name) for name in means.index], means.values, color=PALETTE[0])
+        ax.set_xlabel(category, fontproperties=font)
+        ax.set_ylabel(f"{value}（平均）", fontproperties=font)
+    elif kind == "count_bar":
+        counts = data[columns[0]].value_counts().iloc[:MAX_CATEGORIES]
+        ax.bar([str(name) for name in counts.index], counts.values, color=PALETTE[0])
+        ax.set_xlabel(columns[0], fontproperties=font)
+        ax.set_ylabel("件数", fontproperties=font)
+    else:
+        raise ValueError(f"Unknown chart kind: {kind}")
+
+
+def _code(spec: dict) -> str:
+    """LIDAで編集できるよう、同じグラフを描くLIDA形式のコードを作成"""
+    kind, columns = spec["kind"], spec["columns"]
+    if kind == "paired_bar":
+        body = (f"    counts = pd.DataFrame({{column: data[column].value_counts() for column in {columns!r}}}).sort_index().fillna(0)\n"
+                "    counts.plot(kind='bar', ax=plt.gca(), width=0.8)\n"
+                "    plt.xlabel('値')\n    plt.ylabel('件数')\n")
+    elif kind == "distribution":
+        body = f"    data[{columns[0]!r}].plot(kind='hist', ax=plt.gca(), bins=20)\n    plt.xlabel({columns[0]!r})\n    plt.ylabel('件数')\n"
+    elif kind == "scatter":
+        body = f"    plt.scatter(data[{columns[0]!r}], data[{columns[1]!r}], alpha=0.6)\n    plt.xlabel({columns[0]!r})\n    plt.ylabel({columns[1]!r})\n"
+    elif kind == "box":
+        body = f"    data[{columns!r}].plot(kind='box', ax=plt.gca())\n"
+    elif kind == "time_series":
+        body = (f"    data[{columns[0]!r}] = pd.to_datetime(data[{columns[0]!r}], errors='coerce')\n"
+                f"    data.sort_values({columns[0]!r}).plot(x={columns[0]!r}, y={columns[1:]!r}, ax=plt.gca())\n")
+    elif kind == "category_bar":
+        body = (f"    top = data[{columns[0]!r}].value_counts().index[:{MAX_CATEGORIES}]\n"
+                f"    data[data[{columns[0]!r}].isin(top)].groupby({columns[0]!r})[{columns[1]!r}].mean().sort_values(ascending=False).plot(kind='bar', ax=plt.gca())\n")
+    else:
+        body = f"    data[{columns[0]!r}].value_counts().iloc[:{MAX_CATEGORIES}].plot(kind='bar', ax=plt.gca())\n"
+    return CODE_HEADER.format(kind=kind) + body + CODE_FOOTER.format(title=spec["title"])
+
+
+def render_chart(data: pd.DataFrame, spec: dict) -> str:
+    """グラフを共通のスタイルで描画
+
+    Args:
+        data (pd.DataFrame): データ
+        spec (dict): recommend_chartsで選んだグラフの仕様
+
+    Returns:
+        str: base64でエンコードしたPNG
+
+    """
+    font = cjk_font_properties(10)
+    figure = Figure(figsize=FIGURE_SIZE, dpi=DPI)
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot(1, 1, 1)
+    _draw(ax, data, spec, font)
+
+    ax.set_title(spec["title"], fontproperties=cjk_font_properties(14), color=TEXT_COLOR, loc="left", pad=12)
+    for side in ("top", "right"):
+        ax.spines[side].set_visible(False)
+    ax.grid(axis="y", color=GRID_COLOR, linewidth=0.8)
+    ax.set_axisbelow(True)
+    ax.tick_params(colors=TEXT_COLOR, labelsize=9)
+    for label in ax.get_xticklabels() + ax.get_yticklabels():
+        label.set_fontproperties(font)
+    figure.tight_layout()
+
+    buffer = BytesIO()
+    figure.savefig(buffer, format="png", dpi=DPI)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def quick_charts(data: pd.DataFrame, summary: dict = None, max_charts: int = 4) -> list:
+    """LLMを使わずに、データから直接グラフを作成
+
+    Args:
+        data (pd.DataFrame): データ
+        summary (dict): LIDAの要約
+        max_charts (int): グラフ数の上限
+
+    Returns:
+        list: グラフごとの(仕様, base64のPNGまたはNone, LIDA形式のコード, エラー)
+
+    """
+    start = time.time()
+    charts = []
+    for spec in recommend_charts(summary, data, max_charts):
+        try:
+            charts.append((spec, render_chart(data, spec), _code(spec), None))
+        except Exception as e:
+            logging.warning(f"Quick chart {spec['kind']} failed: {e}")
+            charts.append((spec, None, _code(spec), e))
+    logging.info(f"Quick charts: {[spec['kind'] for spec, *_ in charts]}")
+    logging.info(f"Time Taken: {time.time() - start}")
+    return charts
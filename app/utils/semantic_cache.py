@@ -0,0 +1,192 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter
+import numpy as np
+from scipy import sparse
+from utils import metrics
+from utils.outline_compression import char_ngrams
+
+DEFAULT_THRESHOLD = 0.9
+DEFAULT_MAX_ENTRIES = 500
+
+
+class SemanticDeckCache:
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        """タイトルとアウトラインがほぼ同じ依頼に、前回の資料の内容と図を再利用するキャッシュ
+
+        タイトルとアウトラインを文字n-gramのTF-IDFでベクトル化し、プロセス内の索引から最も近い資料を探す（外部の埋め込みは使わない）。
+
+        Args:
+            threshold (float): 再利用するコサイン類似度の下限
+            max_entries (int): 保持する資料数の上限（古いものから削除）
+
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = []
+        self._vocabulary = {}
+        self._document_frequency = Counter()
+        # 削除したエントリにしか出てこない語の数（語彙の半分を超えたら語彙を作り直す）
+        self._unused = 0
+        self._matrix = None
+        self._idf = None
+        self._counts = {"lookups": 0, "hits": 0, "misses": 0}
+        self._hit_similarity = 0.0
+        self._best_similarity = None
+
+    @staticmethod
+    def _text(title: str, outline: str) -> str:
+        return f"{title}\n{outline}"
+
+    def _vector(self, grams: Counter, add: bool = False):
+        cols, values = [], []
+        for gram, count in grams.items():
+            col = self._vocabulary.get(gram)
+            if col is None:
+                if not add:
+                    continue
+                col = self._vocabulary[gram] = len(self._vocabulary)
+            cols.append(col)
+            values.append(1 + np.log(count))
+        return cols, values
+
+    def _reindex(self) -> None:
+        # 残っているエントリの語だけで語彙を作り直し、列番号を振り直す
+        self._vocabulary = {}
+        self._document_frequency = Counter()
+        for entry in self._entries:
+            entry["cols"] = [self._vocabulary.setdefault(gram, len(self._vocabulary)) for gram in entry["grams"]]
+            self._document_frequency.update(entry["cols"])
+        self._unused = 0
+
+    def _build(self):
+        # 索引はエントリの追加・削除の後、最初の検索でまとめて作り直す
+        if self._matrix is None:
+            rows, cols, values = [], [], []
+            for row, entry in enumerate(self._entries):
+                rows.extend([row] * len(entry["cols"]))
+                cols.extend(entry["cols"])
+                values.extend(entry["values"])
+            shape = (len(self._entries), len(self._vocabulary))
+            self._idf = np.log((1 + len(self._entries)) / (1 + self._df_array())) + 1
+            matrix = sparse.csr_matrix((values, (rows, cols)), shape=shape, dtype=np.float64).multiply(self._idf).tocsr()
+            norms = np.sqrt(matrix.multiply(matrix).sum(axis=1)).A1
+            norms[norms == 0] = 1
+            self._matrix = sparse.diags(1 / norms) @ matrix
+        return self._matrix
+
+    def _df_array(self) -> np.ndarray:
+        df = np.zeros(len(self._vocabulary))
+        for col, count in self._document_frequency.items():
+            df[col] = count
+        return df
+
+    def lookup(self, title: str, outline: str, num_of_slides: int, large: bool = False) -> dict:
+        """最も近い資料を探す
+
+        Args:
+            title (str): タイトル
+            outline (str): アウトライン
+            num_of_slides (int): スライド数（同じスライド数の資料だけを対象にする）
+            large (bool): 大規模モード
+
+        Returns:
+            dict: 類似度がthreshold以上の場合は保存した資料（content, chart_codes, similarity）。ない場合はNone
+
+        """
+        start = time.time()
+        grams = char_ngrams(self._text(title, outline))
+        with self._lock:
+            self._counts["lookups"] += 1
+            best, best_similarity = None, 0.0
+            if self._entries:
+                cols, values = self._vector(grams)
+                matrix = self._build()
+                query = sparse.csr_matrix((values, ([0] * len(cols), cols)), shape=(1, matrix.shape[1])).multiply(self._idf)
+                norm = np.sqrt(query.multiply(query).sum())
+                if norm > 0:
+                    similarities = (matrix @ query.T).toarray().ravel() / norm
+                    for row in np.argsort(-similarities):
+                        entry = self._entries[row]
+                        if entry["num_of_slides"] == num_of_slides and entry["large"] == large:
+                            best, best_similarity = entry, float(similarities[row])
+                            break
+            self._best_similarity = round(best_similarity, 3)
+            hit = best is not None and best_similarity >= self.threshold
+            if hit:
+                self._counts["hits"] += 1
+                self._hit_similarity += best_similarity
+            else:
+                self._counts["misses"] += 1
+
+        logging.info(f"Semantic cache {'hit' if hit else 'miss'} (similarity {best_similarity:.3f}). Time Taken: {time.time() - start}")
+        if not hit:
+            return None
+        return {"content": best["content"], "chart_codes": best["chart_codes"], "title": best["title"], "similarity": best_similarity}
+
+    def add(self, title: str, outline: str, num_of_slides: int, content: dict, chart_codes: list, large: bool = False) -> None:
+        """生成した資料を索引に追加
+
+        Args:
+            title (str): タイトル
+            outline (str): アウトライン（圧縮前のユーザーの入力）
+            num_of_slides (int): スライド数
+            content (dict): 生成された内容（slide1, slide2, ...）
+            chart_codes (list): スライドごとのmermaid.jsコード（生成できなかった図はNone）
+            large (bool): 大規模モード
+
+        """
+        grams = char_ngrams(self._text(title, outline))
+        with self._lock:
+            cols, values = self._vector(grams, add=True)
+            self._entries.append({
+                "title": title, "num_of_slides": num_of_slides, "large": large,
+                "content": content, "chart_codes": chart_codes, "grams": list(grams), "cols": cols, "values": values,
+            })
+            self._document_frequency.update(cols)
+            while len(self._entries) > self.max_entries:
+                removed = self._entries.pop(0)
+                self._document_frequency.subtract(removed["cols"])
+                self._unused += sum(1 for col in removed["cols"] if self._document_frequency[col] == 0)
+            if self._unused > len(self._vocabulary) // 2:
+                self._reindex()
+            self._matrix = None
+
+    def metrics(self) -> dict:
+        with self._lock:
+            result = dict(self._counts)
+            result["threshold"] = self.threshold
+            result["entries"] = len(self._entries)
+            result["vocabulary"] = len(self._vocabulary)
+            result["hit_rate"] = round(result["hits"] / result["lookups"], 3) if result["lookups"] else None
+            result["avg_hit_similarity"] = round(self._hit_similarity / result["hits"], 3) if result["hits"] else None
+            result["last_best_similarity"] = self._best_similarity
+        return result
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def semantic_cache_from_env() -> SemanticDeckCache:
+    """プロセス共通のSemanticDeckCacheを取得（環境変数SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_SIZE）
+
+    Returns:
+        SemanticDeckCache: 共通のキャッシュ。SEMANTIC_CACHE_THRESHOLDが未設定または0の場合はNone
+
+    """
+    global _default_cache
+    threshold = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0"))
+    if not threshold:
+        return None
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = SemanticDeckCache(
+                threshold=threshold,
+                max_entries=int(os.getenv("SEMANTIC_CACHE_SIZE", DEFAULT_MAX_ENTRIES)),
+            )
+            metrics.register("semantic_cache", _default_cache.metrics)
+    return _default_cache
@@ -0,0 +1,666 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import pickle
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from utils import metrics
+
+# シリアライズ形式のバージョン（形式を変えた場合に古いエントリを読まないようにする）
+FORMAT_VERSION = 2
+MAGIC = b"DGC"
+TAG_SIZE = hashlib.sha256().digest_size
+
+DEFAULT_TTL = 24 * 60 * 60
+
+
+def _tag(payload: bytes, secret: bytes = None) -> bytes:
+    return hmac.new(secret or b"", payload, hashlib.sha256).digest()
+
+
+def dumps(value, secret: bytes = None) -> bytes:
+    """キャッシュに保存する値をシリアライズ（pickleに署名を付ける）
+
+    Args:
+        value: 値
+        secret (bytes): 署名の鍵。Noneの場合は改ざんではなく破損だけを検出する（同じホストのSQLite用）
+
+    Returns:
+        bytes: 保存するバイト列
+
+    """
+    payload = pickle.dumps(value, protocol=4)
+    return MAGIC + bytes([FORMAT_VERSION]) + _tag(payload, secret) + payload
+
+
+def loads(data: bytes, secret: bytes = None):
+    """キャッシュの値を復元（署名を確かめてからunpickleする）
+
+    Args:
+        data (bytes): dumpsで作成したバイト列
+        secret (bytes): dumpsと同じ署名の鍵
+
+    Returns:
+        復元した値
+
+    Raises:
+        ValueError: 形式・バージョンが異なる場合、または署名が一致しない場合
+
+    """
+    header = len(MAGIC) + 1 + TAG_SIZE
+    if data[:len(MAGIC)] != MAGIC or len(data) <= header:
+        raise ValueError("Unknown cache entry format")
+    version = data[len(MAGIC)]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported cache entry version: {version}")
+    payload = data[header:]
+    if not hmac.compare_digest(data[len(MAGIC) + 1:header], _tag(payload, secret)):
+        raise ValueError("Cache entry signature mismatch")
+    return pickle.loads(payload)
+
+
+def fingerprint(*values) -> str:
+    payload = json.dumps(values, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def file_fingerprint(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SQLiteBackend:
+    def __init__(self, path: str = "cache/shared_cache.sqlite3") -> None:
+        """同じホストの複数プロセスで共有するSQLiteのキャッシュ
+
+        Args:
+            path (str): SQLiteファイルのパス
+
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> bytes:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: bytes, ttl: float = None) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at))
+
+    def add(self, key: str, value: bytes, ttl: float = None) -> bool:
+        # キーが存在しない（または期限切れの）場合のみ保存。ロックに使用
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache WHERE key = ? AND expires_at IS NOT NULL AND expires_at <= ?", (key, now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (key, value, now + ttl if ttl else None)
+            )
+        return cursor.rowcount == 1
+
+    def delete(self, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def delete_if(self, key: str, value: bytes) -> bool:
+        # 値が一致する場合のみ削除（期限切れの後に他のプロセスが取ったロックを消さない）
+        with self._connect() as conn:
+            cursor = conn.execute("DELETE FROM cache WHERE key = ? AND value = ?", (key, value))
+        return cursor.rowcount == 1
+
+
+class RespError(Exception):
+    pass
+
+
+# 値が一致する場合のみ削除するスクリプト（GETとDELの間に他のクライアントが書き込まないよう、Redis側で一括して実行）
+DELETE_IF_SCRIPT = 'if redis.call("GET", KEYS[1]) == ARGV[1] then return redis.call("DEL", KEYS[1]) else return 0 end'
+
+
+def _encode_command(*args) -> bytes:
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        elif not isinstance(arg, bytes):
+            arg = str(arg).encode("utf-8")
+        parts.append(f"${len(arg)}\r\n".encode() + arg + b"\r\n")
+    return b"".join(parts)
+
+
+def _read_reply(reader):
+    line = reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    prefix, body = line[:1], line[1:-2]
+    if prefix == b"+":
+        return body.decode("utf-8")
+    if prefix == b"-":
+        raise RespError(body.decode("utf-8"))
+    if prefix == b":":
+        return int(body)
+    if prefix == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2]
+    if prefix == b"*":
+        length = int(body)
+        if length < 0:
+            return None
+        return [_read_reply(reader) for _ in range(length)]
+    raise RespError(f"Unknown reply: {line!r}")
+
+
+class RedisBackend:
+    def __init__(self, url: str = "redis://localhost:6379/0", timeout: float = 5) -> None:
+        """RESP（Redisプロトコル）で接続するキャッシュ。複数のホストのレプリカで共有
+
+        Args:
+            url (str): 接続先（redis://[:password@]host:port/db）
+            timeout (float): ソケットのタイムアウト（秒）
+
+        """
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        # スレッドごとに接続を保持
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            conn = (sock, sock.makefile("rb"))
+            self._local.conn = conn
+            if self.password:
+                self._send(conn, "AUTH", self.password)
+            if self.db:
+                self._send(conn, "SELECT", self.db)
+        return conn
+
+    def _send(self, conn, *args):
+        sock, reader = conn
+        sock.sendall(_encode_command(*args))
+        return _read_reply(reader)
+
+    def _close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    def execute(self, *args):
+        # 接続が切れていた場合は1回だけ再接続
+        for attempt in range(2):
+            try:
+                return self._send(self._connection(), *args)
+            except (ConnectionError, OSError):
+                self._close()
+                if attempt == 1:
+                    raise
+
+    def get(self, key: str) -> bytes:
+        return self.execute("GET", key)
+
+    def set(self, key: str, value: bytes, ttl: float = None) -> None:
+        if ttl:
+            self.execute("SET", key, value, "PX", int(ttl * 1000))
+        else:
+            self.execute("SET", key, value)
+
+    def add(self, key: str, value: bytes, ttl: float = None) -> bool:
+        if ttl:
+            return self.execute("SET", key, value, "NX", "PX", int(ttl * 1000)) is not None
+        return self.execute("SET", key, value, "NX") is not None
+
+    def delete(self, key: str) -> None:
+        self.execute("DEL", key)
+
+    def delete_if(self, key: str, value: bytes) -> bool:
+        return self.execute("EVAL", DELETE_IF_SCRIPT, 1, key, value) == 1
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        while True:
+            try:
+                command = _read_reply(self.rfile)
+            except (ConnectionError, OSError):
+                return
+            if not isinstance(command, list) or not command:
+                return
+            try:
+                reply = self.server.store.execute(command)
+            except RespError as e:
+                self.wfile.write(f"-ERR {e}\r\n".encode())
+                continue
+            self.wfile.write(self._encode(reply))
+
+    @staticmethod
+    def _encode(reply) -> bytes:
+        if reply is None:
+            return b"$-1\r\n"
+        if reply == "OK" or reply == "PONG":
+            return f"+{reply}\r\n".encode()
+        if isinstance(reply, int):
+            return f":{reply}\r\n".encode()
+        return f"${len(reply)}\r\n".encode() + reply + b"\r\n"
+
+
+class _MemoryStore:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def _alive(self, key: bytes):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self._data[key]
+            entry = None
+        return entry
+
+    def execute(self, command: list):
+        # commandはbytesのリスト（キーと値はbytesのまま保持）
+        name = command[0].decode("utf-8").upper()
+        with self._lock:
+            if name in ("PING", "AUTH", "SELECT"):
+                return "PONG" if name == "PING" else "OK"
+            if name == "GET":
+                entry = self._alive(command[1])
+                return entry[0] if entry else None
+            if name == "DEL":
+                return sum(1 for key in command[1:] if self._alive(key) and self._data.pop(key))
+            if name == "EVAL" and command[1] == DELETE_IF_SCRIPT.encode("utf-8"):
+                # 任意のLuaは実行できないため、DELETE_IF_SCRIPTのみ同じ処理をする
+                key, value = command[3], command[4]
+                entry = self._alive(key)
+                if entry is None or entry[0] != value:
+                    return 0
+                del self._data[key]
+                return 1
+            if name == "FLUSHDB":
+                self._data.clear()
+                return "OK"
+            if name == "SET":
+                key, value = command[1], command[2]
+                options = [option.decode("utf-8").upper() for option in command[3:]]
+                expires_at = None
+                if "PX" in options:
+                    expires_at = time.time() + int(options[options.index("PX") + 1]) / 1000
+                if "EX" in options:
+                    expires_at = time.time() + int(options[options.index("EX") + 1])
+                if "NX" in options and self._alive(key):
+                    return None
+                self._data[key] = (value, expires_at)
+                return "OK"
+        raise RespError(f"unknown command '{name}'")
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class LocalRespServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        """Redisの代わりに使えるプロセス内のRESPサーバー（GET, SET NX/PX/EX, DEL, PING, DELETE_IF_SCRIPTのEVALのみ）
+
+        開発環境や動作確認で、Redisを立てずにRedisBackendを使うためのもの。
+
+        Args:
+            host (str): 待ち受けるホスト
+            port (int): 待ち受けるポート（0の場合は空いているポート）
+
+        """
+        self._server = _ThreadingTCPServer((host, port), _RespHandler)
+        self._server.store = _MemoryStore()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def start(self) -> "LocalRespServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name="resp-server")
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class SharedCache:
+    def __init__(self, backend=None, namespace: str = "deckgen", ttl: float = DEFAULT_TTL, lock_ttl: float = 120, poll_interval: float = 0.2,
+                 secret: bytes = None) -> None:
+        """レプリカ間で共有するキャッシュ（同じリクエストは1回だけ上流に送る）
+
+        Args:
+            backend: SQLiteBackendまたはRedisBackend。Noneの場合はキャッシュしない
+            namespace (str): キーの接頭辞
+            ttl (float): 既定の有効期限（秒）
+            lock_ttl (float): 計算中ロックの有効期限（秒）。ロックを持つプロセスが落ちた場合もこの時間で解放
+            poll_interval (float): 他のプロセスの計算結果を待つ間隔（秒）
+            secret (bytes): 値の署名の鍵。値はpickleで保存するため、他のホストから書き込めるRedisでは必須
+                （署名が一致しない値はunpickleせずに無視する）
+
+        Raises:
+            ValueError: RedisBackendでsecretを指定しない場合
+
+        """
+        if isinstance(backend, RedisBackend) and not secret:
+            raise ValueError("A secret is required to share pickled cache values through Redis (set CACHE_SECRET)")
+        self.backend = backend
+        self.secret = secret
+        self.namespace = namespace
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._counts = {"hits": 0, "misses": 0, "coalesced": 0, "remote_waits": 0, "stale": 0, "errors": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def key(self, stage: str, *parts) -> str:
+        return f"{self.namespace}:v{FORMAT_VERSION}:{stage}:{fingerprint(*parts)}"
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+
+    def get(self, key: str):
+        """キャッシュから値を取得
+
+        Args:
+            key (str): キー
+
+        Returns:
+            tuple: (見つかったか, 値)
+
+        """
+        if self.backend is None:
+            return False, None
+        try:
+            data = self.backend.get(key)
+        except Exception as e:
+            logging.warning(f"Cache get failed: {e}")
+            self._count("errors")
+            return False, None
+        if data is None:
+            return False, None
+        try:
+            return True, loads(data, self.secret)
+        except Exception as e:
+            # 古い形式や署名が一致しないエントリは無視して作り直す
+            logging.info(f"Ignore cache entry {key}: {e}")
+            self._count("stale")
+            return False, None
+
+    def set(self, key: str, value, ttl: float = None) -> None:
+        if self.backend is None:
+            return
+        try:
+            self.backend.set(key, dumps(value, self.secret), ttl or self.ttl)
+        except Exception as e:
+            logging.warning(f"Cache set failed: {e}")
+            self._count("errors")
+
+    def _acquire(self, key: str, token: bytes) -> bool:
+        try:
+            return self.backend.add(f"{key}:lock", token, self.lock_ttl)
+        except Exception as e:
+            logging.warning(f"Cache lock failed: {e}")
+            self._count("errors")
+            return True
+
+    def _release(self, key: str, token: bytes) -> None:
+        # 自分のトークンの場合のみ外す（計算がlock_ttlより長引き、他のプロセスがロックを取り直した場合）
+        try:
+            self.backend.delete_if(f"{key}:lock", token)
+        except Exception as e:
+            logging.warning(f"Cache unlock failed: {e}")
+
+    def _locked(self, key: str) -> bool:
+        try:
+            return self.backend.get(f"{key}:lock") is not None
+        except Exception:
+            return False
+
+    def _join(self, key: str):
+        # 同じプロセス内で同じキーを計算中の場合は、その結果を待つ
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self._counts["coalesced"] += 1
+                return future, False
+            future = Future()
+            self._inflight[key] = future
+            return future, True
+
+    def _finish(self, key: str, future: Future, value=None, error: Exception = None) -> None:
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+
+    def get_or_compute(self, key: str, compute, ttl: float = None, cacheable=None):
+        """キャッシュにあれば返し、なければ計算して保存
+
+        同じキーの同時リクエストは、プロセス内ではFutureで、プロセス間ではロックキーで1回の計算にまとめる。
+
+        Args:
+            key (str): キー（key()で作成）
+            compute (callable): 値を計算する関数
+            ttl (float): 有効期限（秒）
+            cacheable (callable): 計算した値を保存するかの判定 cacheable(value) -> bool（検証に失敗した値や途中で切れた応答を保存しない）
+
+        Returns:
+            計算またはキャッシュされた値
+
+        """
+        if self.backend is None:
+            return compute()
+
+        found, value = self.get(key)
+        if found:
+            self._count("hits")
+            return value
+
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+
+        try:
+            token = uuid.uuid4().hex.encode()
+            acquired = self._acquire(key, token)
+            if not acquired:
+                # 他のプロセスが計算中。結果が保存されるかロックが外れるまで待つ
+                self._count("remote_waits")
+                deadline = time.time() + self.lock_ttl
+                while time.time() < deadline:
+                    time.sleep(self.poll_interval)
+                    found, value = self.get(key)
+                    if found:
+                        self._count("hits")
+                        self._finish(key, future, value)
+                        return value
+                    if not self._locked(key):
+                        break
+                acquired = self._acquire(key, token)
+
+            self._count("misses")
+            try:
+                value = compute()
+                if cacheable is None or cacheable(value):
+                    self.set(key, value, ttl)
+            finally:
+                if acquired:
+                    self._release(key, token)
+        except BaseException as e:
+            # 取り消し（asyncio.CancelledErrorなど）でも待っている呼び出し元に伝える
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, value)
+        return value
+
+    async def aget_or_compute(self, key: str, compute, ttl: float = None, cacheable=None):
+        """get_or_computeの非同期版
+
+        Args:
+            key (str): キー（key()で作成）
+            compute (callable): 値を計算するコルーチンを返す関数
+            ttl (float): 有効期限（秒）
+            cacheable (callable): 計算した値を保存するかの判定 cacheable(value) -> bool（検証に失敗した値や途中で切れた応答を保存しない）
+
+        Returns:
+            計算またはキャッシュされた値
+
+        """
+        if self.backend is None:
+            return await compute()
+
+        found, value = await asyncio.to_thread(self.get, key)
+        if found:
+            self._count("hits")
+            return value
+
+        future, leader = self._join(key)
+        if not leader:
+            # 別のイベントループ（別スレッド）で計算中の場合もあるため、concurrent.futures.Futureを待つ
+            return await asyncio.wrap_future(future)
+
+        try:
+            token = uuid.uuid4().hex.encode()
+            acquired = await asyncio.to_thread(self._acquire, key, token)
+            if not acquired:
+                self._count("remote_waits")
+                deadline = time.time() + self.lock_ttl
+                while time.time() < deadline:
+                    await asyncio.sleep(self.poll_interval)
+                    found, value = await asyncio.to_thread(self.get, key)
+                    if found:
+                        self._count("hits")
+                        self._finish(key, future, value)
+                        return value
+                    if not await asyncio.to_thread(self._locked, key):
+                        break
+                acquired = await asyncio.to_thread(self._acquire, key, token)
+
+            self._count("misses")
+            try:
+                value = await compute()
+                if cacheable is None or cacheable(value):
+                    await asyncio.to_thread(self.set, key, value, ttl)
+            finally:
+                if acquired:
+                    await asyncio.to_thread(self._release, key, token)
+        except BaseException as e:
+            # 取り消し（asyncio.CancelledErrorなど）でも待っている呼び出し元に伝える
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, value)
+        return value
+
+    def metrics(self) -> dict:
+        with self._lock:
+            result = dict(self._counts)
+        result["backend"] = type(self.backend).__name__ if self.backend is not None else None
+        lookups = result["hits"] + result["misses"]
+        result["hit_rate"] = round(result["hits"] / lookups, 3) if lookups else None
+        return result
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def cache_from_env() -> SharedCache:
+    """プロセス共通のSharedCacheを取得
+
+    環境変数CACHE_BACKEND（none, sqlite, redis）、CACHE_PATH（sqliteのファイル）、
+    CACHE_URL（redisの接続先）、CACHE_SECRET（値の署名の鍵。redisでは必須）、CACHE_TTL（有効期限の秒数）に従う。
+
+    Returns:
+        SharedCache: 共通のキャッシュ（CACHE_BACKENDが未指定の場合はキャッシュしない）
+
+    """
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            name = os.getenv("CACHE_BACKEND", "none").lower()
+            if name == "sqlite":
+                backend = SQLiteBackend(os.getenv("CACHE_PATH", "cache/shared_cache.sqlite3"))
+            elif name == "redis":
+                backend = RedisBackend(os.getenv("CACHE_URL", "redis://localhost:6379/0"))
+            elif name in ("", "none"):
+                backend = None
+            else:
+                raise ValueError(f"Unknown cache backend: {name}. Choose from none, sqlite, redis")
+            secret = os.getenv("CACHE_SECRET")
+            _default_cache = SharedCache(backend, ttl=float(os.getenv("CACHE_TTL", DEFAULT_TTL)), secret=secret.encode("utf-8") if secret else None)
+            metrics.register("cache", _default_cache.metrics)
+    return _default_cache
+
+
+if __name__ == "__main__":
+    # PYTHONPATH=app python app/utils/shared_cache.py
+    # 2つのレプリカ（別々のSharedCache）から同じリクエストを同時に送り、上流の呼び出しが1回になることを確認
+    from concurrent.futures import ThreadPoolExecutor
+
+    logging.basicConfig(level=logging.INFO)
+    server = LocalRespServer().start()
+    calls = []
+
+    def upstream():
+        calls.append(1)
+        time.sleep(0.5)
+        return {"summary": "ok"}
+
+    replicas = [SharedCache(RedisBackend(server.url), poll_interval=0.05, secret=b"local-demo") for _ in range(2)]
+    key = replicas[0].key("summary", "same input")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda i: replicas[i % 2].get_or_compute(key, upstream), range(8)))
+    print(f"upstream calls: {len(calls)}, results: {len(results)}, equal: {all(result == results[0] for result in results)}")
+    print([replica.metrics() for replica in replicas])
+    server.stop()
@@ -0,0 +1,203 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageFont
+from pptx.util import Inches
+import utils.ppt_generation as ppt_gen
+from utils.fonts import find_cjk_font_path
+
+THUMBNAIL_WIDTH = 320
+SLIDE_WIDTH = Inches(13.333)
+SLIDE_HEIGHT = Inches(7.5)
+
+
+@lru_cache(maxsize=16)
+def _font(size: int):
+    font_path = find_cjk_font_path()
+    if font_path is None:
+        return ImageFont.load_default()
+    return ImageFont.truetype(font_path, size)
+
+
+@lru_cache(maxsize=8)
+def _background(image: str, width: int, height: int) -> Image.Image:
+    with Image.open(image) as bg:
+        # PPTと同様にスライドの高さに合わせて配置
+        scaled_width = round(bg.width * height / bg.height)
+        background = Image.new("RGBA", (width, height), "white")
+        background.alpha_composite(bg.convert("RGBA").resize((scaled_width, height)))
+    return background
+
+
+def _scale(width: int):
+    return lambda emu: round(emu * width / SLIDE_WIDTH)
+
+
+def _pt(points: float, width: int) -> int:
+    # 1pt = 1/72インチ
+    return max(1, round(points / 72 * 914400 * width / SLIDE_WIDTH))
+
+
+@lru_cache(maxsize=8192)
+def _char_width(size: int, char: str) -> float:
+    return _font(size).getlength(char)
+
+
+def _wrap(text: str, size: int, max_width: int) -> list:
+    # 日本語は単語の区切りがないため、1文字ずつ幅を足して折り返す（文字幅はキャッシュ）
+    lines = []
+    line = ""
+    line_width = 0
+    for char in text:
+        width = _char_width(size, char)
+        if line and line_width + width > max_width:
+            lines.append(line)
+            line = char
+            line_width = width
+        else:
+            line += char
+            line_width += width
+    lines.append(line)
+    return lines
+
+
+def _shrink(picture: Image.Image, width: int, height: int) -> Image.Image:
+    # 縮小してから変換する（元画像のままRGBAに変換すると遅い）
+    return picture.resize((width, height), Image.BILINEAR, reducing_gap=3.0).convert("RGBA")
+
+
+def _to_png(image: Image.Image) -> bytes:
+    buffer = BytesIO()
+    # サムネイルは小さいため、圧縮率より速度を優先
+    image.convert("RGB").save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def render_title_thumbnail(title: str, width: int = THUMBNAIL_WIDTH) -> bytes:
+    """表紙のサムネイルを作成
+
+    Args:
+        title (str): タイトル
+        width (int): サムネイルの幅（px）
+
+    Returns:
+        bytes: PNG画像
+
+    """
+    scale = _scale(width)
+    height = scale(SLIDE_HEIGHT)
+    image = _background(ppt_gen.COVER_IMAGE, width, height).copy()
+    draw = ImageDraw.Draw(image)
+    draw.text((scale(Inches(0.6)), scale(Inches(3))), title, font=_font(_pt(40, width)), fill="black")
+    return _to_png(image)
+
+
+def render_slide_thumbnail(slide_content: dict, image_path: str = None, graph_data=None, width: int = THUMBNAIL_WIDTH, text_only: bool = False) -> bytes:
+    """generate_pptと同じ入力と配置から内容スライドのサムネイルを作成
+
+    Args:
+        slide_content (dict): スライドの内容（title, content）
+        image_path (str): 図の画像のパス
+        graph_data: 生成されたグラフ
+        width (int): サムネイルの幅（px）
+        text_only (bool): 図とグラフを入れず、テキストだけのレイアウトにする
+
+    Returns:
+        bytes: PNG画像
+
+    """
+    scale = _scale(width)
+    height = scale(SLIDE_HEIGHT)
+    image = _background(ppt_gen.CONTENT_IMAGE, width, height).copy()
+    draw = ImageDraw.Draw(image)
+
+    draw.text((scale(Inches(0.6)), scale(Inches(0.2))), slide_content['title'], font=_font(_pt(24, width)), fill="black")
+
+    picture = None
+    if text_only:
+        pass
+    elif image_path is not None:
+        picture = Image.open(image_path)
+    elif graph_data is not None:
+        picture = Image.open(BytesIO(ppt_gen.decode_graph(graph_data)))
+
+    layout = ppt_gen.compute_layout(picture.width / picture.height if picture is not None else None, text_only=text_only)
+    if picture is not None:
+        left, top, box_width, box_height = (scale(value) for value in layout["image"])
+        with picture:
+            image.alpha_composite(_shrink(picture, box_width, box_height), (left, top))
+
+    # テキストボックス（先頭の空段落と、箇条書きごとの空段落もPPTと同じ）
+    left, top, box_width, box_height = (scale(value) for value in layout["text"])
+    size = _pt(18, width)
+    font = _font(size)
+    line_height = round(size * 1.2)
+    y = top + line_height
+    for point in slide_content['content']:
+        for line in _wrap(f'・{point}', size, box_width):
+            if y + line_height > top + box_height:
+                break
+            draw.text((left, y), line, font=font, fill="black")
+            y += line_height
+        y += line_height
+
+    return _to_png(image)
+
+
+class PreviewCache:
+    def __init__(self, max_entries: int = 512) -> None:
+        """スライドのハッシュごとにサムネイルを保持するLRUキャッシュ
+
+        Args:
+            max_entries (int): 保持するサムネイル数の上限
+
+        """
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get_or_render(self, key: str, render) -> bytes:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        png = render()
+        with self._lock:
+            self._entries[key] = png
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return png
+
+
+_cache = PreviewCache()
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="preview")
+
+
+def deck_thumbnails(deck, width: int = THUMBNAIL_WIDTH) -> list:
+    """資料のすべてのスライドのサムネイルを取得（変更のないスライドはキャッシュを使用）
+
+    Args:
+        deck (Deck): 資料モデル
+        width (int): サムネイルの幅（px）
+
+    Returns:
+        list: PNG画像のリスト（表紙、内容スライドの順）
+
+    """
+    start = time.time()
+    title_key = hashlib.sha1(f"title:{deck.title}:{width}".encode("utf-8")).hexdigest()
+    jobs = [(title_key, lambda: render_title_thumbnail(deck.title, width))]
+    for slide in deck.slides:
+        jobs.append((
+            f"{slide.render_hash}:{width}:{deck.text_only}",
+            lambda slide=slide: render_slide_thumbnail(slide.to_content(), slide.image_path, slide.graph, width, deck.text_only),
+        ))
+    # 画像のデコードと縮小はGILを解放するため、スレッドで並列に処理
+    thumbnails = list(_executor.map(lambda job: _cache.get_or_render(*job), jobs))
+    logging.info(f"Thumbnails rendered. Time taken: {time.time() - start}")
+    return thumbnails
@@ -0,0 +1,222 @@
+import json
+import logging
+import re
+import threading
+from utils import metrics
+
+# LLMの応答に期待する形式（JSON Schemaのtype, properties, required, items, minItemsのみ使用）
+SLIDE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string", "minLength": 1},
+        "content": {"type": "array", "items": {"type": "string"}, "minItems": 1},
+        "graphic_prompt": {"type": "string"},
+    },
+    "required": ["title", "content"],
+}
+
+FEATURE_DESCRIPTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "dataset_purpose": {"type": "string", "minLength": 1},
+        "graph_interpretation": {"type": "string", "minLength": 1},
+        "key_insights": {"type": "string", "minLength": 1},
+    },
+    "required": ["dataset_purpose", "graph_interpretation", "key_insights"],
+}
+
+TYPES = {"object": dict, "array": list, "string": str, "number": (int, float), "integer": int, "boolean": bool}
+CONTROL_CHARACTERS = re.compile(r"[\n\r\t\f\v]")
+CODE_FENCE = re.compile(r"```(?:json)?", re.IGNORECASE)
+CLOSERS = {"{": "}", "[": "]"}
+
+
+class StructuredOutputStats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counts = {"responses": 0, "repaired": 0, "unparsable": 0, "schema_errors": 0, "invalid_fragments": 0, "rerequests": 0, "failures": 0}
+
+    def add(self, **counts) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                self._counts[name] += value
+
+    def report(self) -> dict:
+        with self._lock:
+            result = dict(self._counts)
+        result["repair_rate"] = round(result["repaired"] / result["responses"], 3) if result["responses"] else None
+        return result
+
+
+stats = StructuredOutputStats()
+metrics.register("structured_output", stats.report)
+
+
+def validate(value, schema: dict, path: str = "$") -> list:
+    """値がスキーマに合っているか確認
+
+    Args:
+        value: JSONから読み込んだ値
+        schema (dict): スキーマ
+        path (str): エラーに表示する位置
+
+    Returns:
+        list: エラーのリスト（問題がない場合は空）
+
+    """
+    expected = TYPES[schema["type"]]
+    if not isinstance(value, expected) or (schema["type"] in ("number", "integer") and isinstance(value, bool)):
+        return [f"{path}: expected {schema['type']}, got {type(value).__name__}"]
+    errors = []
+    if schema["type"] == "object":
+        for name in schema.get("required", []):
+            if name not in value:
+                errors.append(f"{path}.{name}: missing")
+        for name, child in schema.get("properties", {}).items():
+            if name in value:
+                errors.extend(validate(value[name], child, f"{path}.{name}"))
+    elif schema["type"] == "array":
+        if len(value) < schema.get("minItems", 0):
+            errors.append(f"{path}: expected at least {schema['minItems']} items")
+        for i, item in enumerate(value):
+            errors.extend(validate(item, schema.get("items", {"type": "string"}), f"{path}[{i}]"))
+    elif schema["type"] == "string" and len(value.strip()) < schema.get("minLength", 0):
+        errors.append(f"{path}: empty")
+    return errors
+
+
+def _closes_string(text: str, i: int) -> bool:
+    # 引用符の後に区切り文字が続く場合だけ文字列の終わりとみなす（それ以外はエスケープ漏れの引用符）
+    rest = text[i + 1:].lstrip()
+    return not rest or rest[0] in ",:}]"
+
+
+def _scan(text: str):
+    """文字列の中の引用符をエスケープし、括弧の外の末尾のカンマを除きながら、切り詰める候補位置を記録"""
+    out = []
+    stack = []
+    cuts = []
+    in_string = False
+    escaped = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                if not _closes_string(text, i):
+                    out.append("\\")
+                else:
+                    in_string = False
+            out.append(char)
+            continue
+        if char == '"':
+            in_string = True
+        elif char in CLOSERS:
+            stack.append(char)
+        elif char in "}]":
+            # 閉じ括弧の直前のカンマを除く
+            while out and out[-1] in " ,":
+                out.pop()
+            if stack:
+                stack.pop()
+            out.append(char)
+            if stack:
+                cuts.append(("".join(out), list(stack)))
+            continue
+        elif char == ",":
+            cuts.append(("".join(out), list(stack)))
+        out.append(char)
+    return "".join(out), stack, in_string, cuts
+
+
+def _close(text: str, stack: list) -> str:
+    return text.rstrip().rstrip(",") + "".join(CLOSERS[bracket] for bracket in reversed(stack))
+
+
+def repair_json(text: str):
+    """LLMの応答をJSONとして読み込み、よくある崩れは手元で修正する
+
+    コードブロックや前置き、制御文字、末尾のカンマ、文字列中のエスケープされていない引用符、
+    途中で切れた配列やオブジェクト（最後の完全な要素までを残して閉じる）を修正する。
+
+    Args:
+        text (str): LLMの応答
+
+    Returns:
+        tuple: (読み込んだ値, 修正したかどうか)
+
+    Raises:
+        ValueError: 修正しても読み込めない場合
+
+    """
+    cleaned = CONTROL_CHARACTERS.sub("", CODE_FENCE.sub("", text)).strip()
+    starts = [i for i in (cleaned.find("{"), cleaned.find("[")) if i >= 0]
+    if not starts:
+        raise ValueError(f"No JSON in response: {text[:200]}")
+    cleaned = cleaned[min(starts):]
+    try:
+        return json.loads(cleaned), False
+    except json.JSONDecodeError:
+        pass
+
+    scanned, stack, in_string, cuts = _scan(cleaned)
+    # 途中で切れている場合は、最後の完全な要素から順に遡って閉じる
+    candidates = [_close(prefix, prefix_stack) for prefix, prefix_stack in reversed(cuts)]
+    if in_string:
+        # 文字列の途中で切れた場合は、途中までの文字列を残すより完全な要素までで閉じる方を優先する
+        candidates.append(_close(scanned + '"', stack))
+    else:
+        candidates.insert(0, _close(scanned, stack))
+    for candidate in candidates:
+        try:
+            value, _ = json.JSONDecoder().raw_decode(candidate)
+        except json.JSONDecodeError:
+            continue
+        logging.info(f"Repaired JSON response ({len(text)} chars)")
+        return value, True
+    raise ValueError(f"Could not repair JSON response: {text[:200]}")
+
+
+def parse_response(text: str, schema: dict = None):
+    """応答を読み込んでスキーマで確認し、結果をメトリクスに記録
+
+    Args:
+        text (str): LLMの応答
+        schema (dict): スキーマ（未指定の場合は読み込みのみ）
+
+    Returns:
+        tuple: (読み込んだ値, エラーのリスト)。読み込めない場合は(None, エラー)
+
+    """
+    try:
+        value, repaired = repair_json(text)
+    except ValueError as e:
+        stats.add(responses=1, unparsable=1)
+        logging.warning(str(e))
+        return None, [str(e)]
+    errors = validate(value, schema) if schema is not None else []
+    stats.add(responses=1, repaired=int(repaired), schema_errors=int(bool(errors)))
+    return value, errors
+
+
+def unwrap_slides(value) -> list:
+    """資料の応答からスライドを順に取り出す（{"slide1": ...}, {"slides": [...]}, [...] のいずれも可）
+
+    Args:
+        value: 読み込んだ応答
+
+    Returns:
+        list: スライドの候補（形式の確認はしない）
+
+    """
+    if isinstance(value, list):
+        return value
+    if not isinstance(value, dict):
+        return []
+    if len(value) == 1:
+        inner = next(iter(value.values()))
+        if isinstance(inner, list) or (isinstance(inner, dict) and all(isinstance(item, dict) for item in inner.values())):
+            return unwrap_slides(inner)
+    return list(value.values())
@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from utils import metrics
+from utils.shared_cache import cache_from_env, fingerprint
+from utils.structured_output import repair_json
+from utils import prompts
+from utils.graph_tasks import propagate
+
+STAGE = "lida_summary_columns"
+# 1回のリクエストで注釈を付ける列数
+DEFAULT_BATCH_SIZE = 25
+
+
+def _parse_json(text: str) -> dict:
+    # コードブロックや前置き、途中で切れた応答は手元で修正する（切れた後の列は応答に含まれなかった列として扱う）
+    value, _ = repair_json(text)
+    if not isinstance(value, dict):
+        raise ValueError(f"No JSON object in response: {text[:200]}")
+    return value
+
+
+def column_fingerprint(field: dict) -> str:
+    """列名と列の統計（型・最小値・最大値・サンプルなど）から注釈のキャッシュキーを計算
+
+    Args:
+        field (dict): LIDAの要約のfieldsの要素
+
+    Returns:
+        str: ハッシュ値
+
+    """
+    properties = {
+        name: value for name, value in field.get("properties", {}).items()
+        if name not in ("semantic_type", "description")
+    }
+    return fingerprint(field.get("column"), properties)
+
+
+class ColumnEnricher:
+    def __init__(self, cache=None, batch_size: int = DEFAULT_BATCH_SIZE, max_workers: int = 4, max_entries: int = 20000) -> None:
+        """列の多いデータセットの要約に、列をまとめて並列にLLMで注釈を付ける
+
+        注釈は列ごとに統計のハッシュでキャッシュするため、列を1つ追加したファイルでは新しい列だけにリクエストする。
+
+        Args:
+            cache (SharedCache): レプリカ間で共有するキャッシュ
+            batch_size (int): 1回のリクエストで注釈を付ける列数
+            max_workers (int): 同時に送るリクエスト数（全セッション共通）
+            max_entries (int): プロセス内に保持する注釈数の上限
+
+        """
+        self.cache = cache or cache_from_env()
+        self.batch_size = batch_size
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summary-enrich")
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._counts = {"summaries": 0, "columns": 0, "cached_columns": 0, "annotated_columns": 0, "failed_columns": 0, "batches": 0}
+
+    def _count(self, **counts) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                self._counts[name] += value
+
+    def _get(self, key: str):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        found, value = self.cache.get(key)
+        if found:
+            self._remember(key, value)
+            return value
+        return None
+
+    def _set(self, key: str, value) -> None:
+        self._remember(key, value)
+        self.cache.set(key, value)
+
+    def _remember(self, key: str, value) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _generate(self, text_gen, textgen_config, template, content) -> dict:
+        messages = template.messages(content=json.dumps(content, ensure_ascii=False, default=str))
+        with text_gen.stage(STAGE):
+            response = text_gen.generate(messages=messages, config=textgen_config)
+        return _parse_json(response.text[0]["content"])
+
+    def _annotate_batch(self, fields: list, text_gen, textgen_config) -> dict:
+        start = time.time()
+        try:
+            result = self._generate(text_gen, textgen_config, prompts.COLUMN_ANNOTATION, fields)
+        except Exception as e:
+            logging.warning(f"Column annotation failed for {len(fields)} columns: {e}")
+            return {}
+        annotations = {}
+        for item in result.get("fields", []):
+            if isinstance(item, dict) and "column" in item:
+                annotations[str(item["column"])] = {
+                    "semantic_type": item.get("semantic_type", ""),
+                    "description": item.get("description", ""),
+                }
+        logging.info(f"Annotated {len(annotations)}/{len(fields)} columns. Time Taken: {time.time() - start}")
+        return annotations
+
+    def _describe_dataset(self, summary: dict, text_gen, textgen_config, use_cache: bool) -> dict:
+        columns = [field["column"] for field in summary["fields"]]
+        key = self.cache.key(STAGE, "dataset", summary.get("file_name"), columns, textgen_config.model)
+        described = self._get(key) if use_cache else None
+        if described is None:
+            try:
+                result = self._generate(text_gen, textgen_config, prompts.DATASET_DESCRIPTION, {"file_name": summary.get("file_name"), "columns": columns})
+            except Exception as e:
+                logging.warning(f"Dataset description failed: {e}")
+                return {}
+            described = {"name": result.get("name") or summary.get("name"), "dataset_description": result.get("dataset_description", "")}
+            self._set(key, described)
+        return described
+
+    def enrich(self, summary: dict, text_gen, textgen_config, use_cache: bool = True) -> dict:
+        """LIDAのdefaultの要約に、列ごとのsemantic_typeとdescription、データセットの説明を追加
+
+        Args:
+            summary (dict): summary_method="default"で作成した要約
+            text_gen (LedgerTextGenerator): テキスト生成（ステージごとに使用量を記録）
+            textgen_config (TextGenerationConfig): テキスト生成の設定
+            use_cache (bool): キャッシュした注釈を使うか（Falseの場合もキャッシュは更新する）
+
+        Returns:
+            dict: 注釈を付けた要約（llmの要約と同じ形式）
+
+        """
+        start = time.time()
+        fields = summary.get("fields", [])
+        keys = [self.cache.key(STAGE, column_fingerprint(field), textgen_config.model) for field in fields]
+        annotations = [self._get(key) if use_cache else None for key in keys]
+        missing = [i for i, annotation in enumerate(annotations) if annotation is None]
+
+        dataset = self._executor.submit(propagate(self._describe_dataset), summary, text_gen, textgen_config, use_cache)
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        futures = [
+            (batch, self._executor.submit(propagate(self._annotate_batch), [fields[i] for i in batch], text_gen, textgen_config))
+            for batch in batches
+        ]
+        failed = 0
+        for batch, future in futures:
+            result = future.result()
+            for i in batch:
+                annotation = result.get(str(fields[i]["column"]))
+                if annotation is None:
+                    # 応答に含まれなかった列はキャッシュせず、次回もう一度リクエストする
+                    failed += 1
+                    continue
+                annotations[i] = annotation
+                self._set(keys[i], annotation)
+
+        enriched = dict(summary)
+        enriched["fields"] = []
+        for field, annotation in zip(fields, annotations):
+            properties = dict(field.get("properties", {}))
+            if annotation is not None:
+                properties.update(annotation)
+            enriched["fields"].append({**field, "properties": properties})
+        enriched.update(dataset.result())
+
+        self._count(summaries=1, columns=len(fields), cached_columns=len(fields) - len(missing),
+                    annotated_columns=len(missing) - failed, failed_columns=failed, batches=len(batches))
+        logging.info(f"Summary enriched: {len(fields) - len(missing)} cached, {len(missing) - failed} annotated, {failed} failed columns in {len(batches)} batches")
+        logging.info(f"Time Taken: {time.time() - start}")
+        return enriched
+
+    def metrics(self) -> dict:
+        with self._lock:
+            result = dict(self._counts)
+            result["entries"] = len(self._entries)
+        result["cache_hit_rate"] = round(result["cached_columns"] / result["columns"], 3) if result["columns"] else None
+        return result
+
+
+_default_enricher = None
+_default_lock = threading.Lock()
+
+
+def enricher_from_env() -> ColumnEnricher:
+    """プロセス共通のColumnEnricherを取得（環境変数SUMMARY_ENRICH_BATCH, SUMMARY_ENRICH_WORKERS）
+
+    Returns:
+        ColumnEnricher: 共通の注釈付け
+
+    """
+    global _default_enricher
+    with _default_lock:
+        if _default_enricher is None:
+            _default_enricher = ColumnEnricher(
+                batch_size=int(os.getenv("SUMMARY_ENRICH_BATCH", DEFAULT_BATCH_SIZE)),
+                max_workers=int(os.getenv("SUMMARY_ENRICH_WORKERS", "4")),
+            )
+            metrics.register("summary_enrichment", _default_enricher.metrics)
+    return _default_enricher
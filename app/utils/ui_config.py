@@ -1,6 +1,10 @@
 import streamlit as st
+import html
 import os
+import uuid
+from concurrent.futures import CancelledError, TimeoutError
 import pandas as pd
+from utils.memory_accounting import memory_tracker_from_env
 
 def configure_sidebar():
     st.sidebar.write("## モデルの選択")
@@ -76,6 +80,9 @@ def configure_sidebar():
         {"label": "llm",
          "description":
          "LLMを使用してデフォルトの要約に注釈を付けて生成（データセットのセマンティックタイプや説明などの詳細を追加）"},
+        {"label": "llm_columns",
+         "description":
+         "列をまとめて並列にLLMで注釈を付けて生成（列の多いデータセット向け。列ごとの注釈を再利用）"},
         {"label": "default",
          "description": 
          "データセットの列統計と列名を要約として使用"},
@@ -114,4 +121,173 @@ def configure_sidebar():
                         max_value=10,
                         value=2)
 
-    return selected_model, temperature, use_cache, uploaded_file_path,selected_method,selected_library,num_visualizations
\ No newline at end of file
+    return selected_model, temperature, use_cache, uploaded_file_path,selected_method,selected_library,num_visualizations
+
+
+def configure_slide_editor(deck):
+    st.write("## スライドの編集")
+    index = st.selectbox(
+        'スライドを選択',
+        options=list(range(len(deck.slides))),
+        format_func=lambda i: f"{i+1}. {deck.slides[i].title}")
+    slide = deck.slides[index]
+
+    slide_title = st.text_input("スライドタイトル", value=slide.title, key=f"slide_title_{index}")
+    slide_content = st.text_area("箇条書き（1行に1項目）", value="\n".join(slide.content), key=f"slide_content_{index}")
+    instruction = st.text_input("再生成の指示（任意）", key=f"slide_instruction_{index}")
+
+    action = None
+    L, C, R = st.columns(3)
+    with L:
+        if st.button("テキストを反映"):
+            action = "edit"
+    with C:
+        if st.button("テキストを再生成"):
+            action = "regenerate_text"
+    with R:
+        if st.button("図を再生成"):
+            action = "regenerate_chart"
+
+    values = {
+        "title": slide_title,
+        "content": [line for line in slide_content.splitlines() if line.strip()],
+        "instruction": instruction
+    }
+    return index, action, values
+
+
+def show_thumbnails(deck, columns: int = 4):
+    from utils.slide_preview import deck_thumbnails
+    st.write("## プレビュー")
+    thumbnails = deck_thumbnails(deck)
+    captions = ["表紙"] + [f"{i+1}. {slide.title}" for i, slide in enumerate(deck.slides)]
+    for row in range(0, len(thumbnails), columns):
+        for col, thumbnail, caption in zip(st.columns(columns), thumbnails[row:row + columns], captions[row:row + columns]):
+            with col:
+                st.image(thumbnail, caption=caption, use_column_width=True)
+
+
+def wait_for_task(tasks, session_id, stage, message, poll_interval: float = 0.2):
+    """セッションの最新のバックグラウンド処理（GraphGenerationの*_async）を待って結果を受け取る
+
+    待っている間も表示を更新し、ユーザーが別のウィジェットを操作した場合はStreamlitの再実行で待機だけを中断する。
+    処理は取り消さず、次の実行で同じ処理の結果を受け取る（取り消すのは新しいリクエストに置き換えられた場合のみ）。
+
+    Args:
+        tasks (GraphTaskManager): 処理のマネージャー
+        session_id (str): セッションID
+        stage (str): 処理段階
+        message (str): スピナーに表示する文言
+        poll_interval (float): 表示を更新する間隔（秒）
+
+    Returns:
+        処理の結果。待っている処理がない場合や取り消された場合はNone
+
+    """
+    task = tasks.latest(session_id, stage)
+    if task is None:
+        return None
+    with st.spinner(message):
+        placeholder = st.empty()
+        try:
+            while True:
+                try:
+                    return task.result(timeout=poll_interval)
+                except TimeoutError:
+                    # 要素の更新のたびにStreamlitが再実行の要求を確認する
+                    placeholder.empty()
+        except CancelledError:
+            return None
+        finally:
+            # 結果を受け取った（または失敗した）処理はマネージャーから外す。再実行で中断された場合は実行中なので残る
+            tasks.release(task)
+
+
+def get_client_id():
+    # ブラウザを更新してもジョブを追えるようにURLにIDを保持
+    params = st.experimental_get_query_params()
+    if "client" not in params:
+        st.experimental_set_query_params(**params, client=str(uuid.uuid4()))
+        params = st.experimental_get_query_params()
+    return params["client"][0]
+
+
+STAGE_LABELS = {
+    "queued": "待機中",
+    "content": "内容生成中",
+    "charts": "図を生成中",
+    "assembly": "資料作成中",
+    "done": "完了",
+}
+
+
+DEGRADATION_LABELS = {
+    "truncate_slides": "スライド数を減らしました",
+    "outline_only": "内容を生成できなかったため、アウトラインの文をそのまま使いました",
+    "drop_chart": "図を省きました",
+    "skip_fix_retry": "図の修正を省きました",
+    "text_only": "図を入れずにテキストだけで作成しました",
+    "skip_thumbnails": "サムネイルの作成を省きました",
+    "skip_goals": "分析の目的の提案を省きました",
+    "skip_graphs": "グラフの作成を省きました",
+    "skip_refill": "重複したグラフの作り直しを省きました",
+    "skip_description": "グラフの説明を省きました",
+}
+
+
+def show_degradations(title, degradations):
+    if not degradations:
+        return
+    counts = {}
+    for item in degradations:
+        counts[item['action']] = counts.get(item['action'], 0) + 1
+    messages = [f"{DEGRADATION_LABELS.get(action, action)}（{count}件）" for action, count in counts.items()]
+    st.warning(f"{title}: 制限時間内に完成させるため、" + "、".join(messages))
+
+
+def show_jobs(queue, owner):
+    st.write("## 生成ジョブ")
+    jobs = queue.list_jobs(owner)
+    if not jobs:
+        st.caption("ジョブはありません。")
+
+    active = False
+    for job in jobs:
+        title = job['params'].get('title') or '(無題)'
+        progress = job['progress']
+        if job['status'] in ("queued", "running"):
+            active = True
+            total = progress.get('total') or 0
+            ratio = progress.get('done', 0) / total if total else 0.0
+            st.progress(ratio, text=f"{title}: {STAGE_LABELS.get(progress.get('stage'), progress.get('stage'))}")
+        elif job['status'] == "failed":
+            st.error(f"{title}: 生成に失敗しました（{job['error']}）")
+        elif job['params'].get('large'):
+            show_degradations(title, progress.get('degradations'))
+            # 大規模な資料はメモリに読み込まず、静的ファイルとしてディスクから配信（推測できない名前で、期限が過ぎたら削除）
+            path = queue.download_path(job)
+            if path is None:
+                st.caption(f"{title}: ダウンロードの期限が切れました。もう一度生成してください。")
+            else:
+                # タイトルはユーザーの入力なので、HTMLに埋め込む前にエスケープ
+                escaped = html.escape(title, quote=True)
+                st.markdown(f'<a href="app/static/decks/{os.path.basename(path)}" download="{escaped}.pptx">{escaped} をダウンロード</a>',
+                            unsafe_allow_html=True)
+        else:
+            show_degradations(title, progress.get('degradations'))
+            L, R = st.columns(2)
+            with L:
+                with open(queue.result_path(job['id']), "rb") as f:
+                    st.download_button(label=f"{title} をダウンロード",
+                                       data=f.read(),
+                                       file_name=f'{title}.pptx',
+                                       key=f"download_{job['id']}")
+            with R:
+                if st.button("編集", key=f"edit_{job['id']}"):
+                    deck = queue.load_deck(job['id'])
+                    st.session_state['deck'] = deck
+                    st.session_state['binary_ppt'] = deck.render()
+                    memory = memory_tracker_from_env()
+                    memory.watch(st.session_state.get('session_id'), deck, "deck")
+                    memory.watch(st.session_state.get('session_id'), st.session_state['binary_ppt'], "deck_bytes")
+    return active
@@ -0,0 +1,363 @@
+import copy
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from dataclasses import replace
+from utils import metrics
+from utils.graph_tasks import raise_if_cancelled
+
+# USD / 1K tokens (prompt, completion)
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-4o": (0.005, 0.015),
+    "gpt-4-0125-preview": (0.01, 0.03),
+    "gpt-4-turbo": (0.01, 0.03),
+    "gpt-4": (0.03, 0.06),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+}
+# プロバイダー側のプロンプトキャッシュから読まれた入力トークンの料金（通常の入力料金に対する割合）
+CACHED_PROMPT_RATE = 0.5
+# 集計に使う値（1回ごとの記録は直近の分だけ保持し、合計は加算していく）
+_TOTAL_KEYS = ("calls", "prompt_tokens", "cached_tokens", "completion_tokens", "total_tokens", "cost", "latency")
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> float:
+    """モデルとトークン数から料金を概算
+
+    Args:
+        model (str): モデル名（日付付きのスナップショット名も可）
+        prompt_tokens (int): 入力トークン数（キャッシュから読まれた分を含む）
+        completion_tokens (int): 出力トークン数
+        cached_tokens (int): 入力のうちプロンプトキャッシュから読まれたトークン数
+
+    Returns:
+        float: 料金（USD）。料金表にないモデルは0
+
+    """
+    matches = [name for name in MODEL_PRICES if model and model.startswith(name)]
+    if not matches:
+        return 0.0
+    prompt_price, completion_price = MODEL_PRICES[max(matches, key=len)]
+    prompt_cost = (prompt_tokens - cached_tokens + cached_tokens * CACHED_PROMPT_RATE) * prompt_price
+    return (prompt_cost + completion_tokens * completion_price) / 1000
+
+
+def _usage_value(usage, key: str) -> int:
+    if usage is None:
+        return 0
+    if isinstance(usage, dict):
+        return usage.get(key) or 0
+    return getattr(usage, key, None) or 0
+
+
+def _cached_tokens(usage) -> int:
+    # usage.prompt_tokens_details.cached_tokens（SDKのオブジェクト、llmxのdict、カセットのどれでも読めるようにする）
+    if usage is None:
+        return 0
+    details = usage.get("prompt_tokens_details") if isinstance(usage, dict) else getattr(usage, "prompt_tokens_details", None)
+    return _usage_value(details, "cached_tokens")
+
+
+class _Totals:
+    def __init__(self) -> None:
+        # 合計、段階別、モデル別の集計（記録ごとに加算する）
+        self.total = dict.fromkeys(_TOTAL_KEYS, 0)
+        self.by_stage = defaultdict(lambda: dict.fromkeys(_TOTAL_KEYS, 0))
+        self.by_model = defaultdict(lambda: dict.fromkeys(_TOTAL_KEYS, 0))
+
+    def add(self, entry: dict) -> None:
+        for totals in (self.total, self.by_stage[entry["stage"]], self.by_model[entry["model"]]):
+            totals["calls"] += 1
+            for key in _TOTAL_KEYS[1:]:
+                totals[key] += entry[key]
+
+    def summary(self) -> dict:
+        def view(totals):
+            result = dict(totals)
+            # 入力トークンのうちプロンプトキャッシュから読まれた割合
+            result["cached_ratio"] = round(totals["cached_tokens"] / totals["prompt_tokens"], 3) if totals["prompt_tokens"] else None
+            result["cost"] = round(totals["cost"], 6)
+            result["latency"] = round(totals["latency"], 3)
+            return result
+
+        return {
+            "total": view(self.total),
+            "by_stage": {stage: view(totals) for stage, totals in self.by_stage.items()},
+            "by_model": {model: view(totals) for model, totals in self.by_model.items()},
+        }
+
+
+class UsageLedger:
+    def __init__(self, token_budget: int = None, max_recent: int = 200, max_decks: int = 1000) -> None:
+        """OpenAIのusageを資料・段階・モデルごとに記録する台帳
+
+        合計は記録ごとに加算し、1回ごとの記録は直近max_recent件だけ保持する。資料ごとの集計はfinish_deck()で破棄する。
+
+        Args:
+            token_budget (int): 資料1件あたりのトークン上限（Noneの場合は無制限）
+            max_recent (int): 保持する直近の記録数
+            max_decks (int): 集計を保持する資料数の上限（finish_deck()を呼ばないセッションIDなどは古いものから破棄）
+
+        """
+        self.token_budget = token_budget
+        self.max_decks = max_decks
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=max_recent)
+        self._totals = _Totals()
+        self._decks = OrderedDict()
+        self._finished = 0
+        self._budgets = {}
+
+    def record(self, deck_id: str, stage: str, model: str, usage, latency: float) -> None:
+        """1回分のレスポンスを記録
+
+        Args:
+            deck_id (str): 資料ID（またはセッションID）
+            stage (str): 処理段階（例: content, chart, lida_summary）
+            model (str): モデル名
+            usage: レスポンスのusage（オブジェクトまたはdict）
+            latency (float): レイテンシ（秒）
+
+        """
+        prompt_tokens = _usage_value(usage, "prompt_tokens")
+        completion_tokens = _usage_value(usage, "completion_tokens")
+        cached_tokens = _cached_tokens(usage)
+        entry = {
+            "deck_id": deck_id,
+            "stage": stage,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_tokens": cached_tokens,
+            "total_tokens": _usage_value(usage, "total_tokens") or prompt_tokens + completion_tokens,
+            "cost": estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens),
+            "latency": latency,
+            "timestamp": time.time(),
+        }
+        with self._lock:
+            self._recent.append(entry)
+            self._totals.add(entry)
+            if deck_id not in self._decks:
+                self._decks[deck_id] = _Totals()
+                while len(self._decks) > self.max_decks:
+                    expired, _ = self._decks.popitem(last=False)
+                    self._budgets.pop(expired, None)
+                    self._finished += 1
+            self._decks.move_to_end(deck_id)
+            self._decks[deck_id].add(entry)
+        logging.info(f"Usage [{stage}/{model}]: {entry['total_tokens']} tokens ({cached_tokens} cached), {latency:.2f}s")
+
+    def set_budget(self, deck_id: str, tokens: int) -> None:
+        with self._lock:
+            self._budgets[deck_id] = tokens
+
+    def used_tokens(self, deck_id: str) -> int:
+        with self._lock:
+            totals = self._decks.get(deck_id)
+            return totals.total["total_tokens"] if totals is not None else 0
+
+    def remaining(self, deck_id: str) -> int:
+        """資料の残りトークン数を取得
+
+        Args:
+            deck_id (str): 資料ID
+
+        Returns:
+            int: 残りトークン数（上限がない場合はNone）
+
+        """
+        with self._lock:
+            budget = self._budgets.get(deck_id, self.token_budget)
+        if budget is None:
+            return None
+        return budget - self.used_tokens(deck_id)
+
+    def within_budget(self, deck_id: str, reserve: int = 0) -> bool:
+        """資料のトークン上限に余裕があるか
+
+        Args:
+            deck_id (str): 資料ID
+            reserve (int): 次の処理に見込むトークン数
+
+        Returns:
+            bool: 余裕がある場合True
+
+        """
+        remaining = self.remaining(deck_id)
+        return remaining is None or remaining > reserve
+
+    def report(self) -> dict:
+        """全体の集計
+
+        Returns:
+            dict: 合計、段階別、モデル別、資料数、直近の記録数
+
+        """
+        with self._lock:
+            summary = self._totals.summary()
+            summary["decks"] = self._finished + len(self._decks)
+            summary["recent"] = len(self._recent)
+        return summary
+
+    def recent(self) -> list:
+        """直近の記録を取得（古い順）
+
+        Returns:
+            list: 1回ごとの記録
+
+        """
+        with self._lock:
+            return list(self._recent)
+
+    def deck_report(self, deck_id: str) -> dict:
+        """資料1件分の集計
+
+        Args:
+            deck_id (str): 資料ID
+
+        Returns:
+            dict: 合計、段階別、モデル別、上限と残りトークン数
+
+        """
+        with self._lock:
+            totals = self._decks.get(deck_id) or _Totals()
+            summary = totals.summary()
+            budget = self._budgets.get(deck_id, self.token_budget)
+        summary["budget"] = budget
+        summary["remaining"] = None if budget is None else budget - summary["total"]["total_tokens"]
+        return summary
+
+    def finish_deck(self, deck_id: str) -> dict:
+        """資料の生成が終わったときに呼び、資料1件分の集計を返して台帳から破棄
+
+        Args:
+            deck_id (str): 資料ID
+
+        Returns:
+            dict: deck_report()と同じ集計
+
+        """
+        summary = self.deck_report(deck_id)
+        with self._lock:
+            if self._decks.pop(deck_id, None) is not None:
+                self._finished += 1
+            self._budgets.pop(deck_id, None)
+        return summary
+
+
+def _with_timeout(text_gen, timeout: float):
+    """タイムアウトを設定したOpenAIクライアントで呼び出すTextGeneratorのコピーを作成
+
+    llmxのTextGeneratorはリクエストごとのタイムアウトを受け取らないため、共有のクライアントは変えずに
+    コピーのクライアントだけを差し替える（ラップしたTextGeneratorは内側まで辿る）。
+
+    Args:
+        text_gen (TextGenerator): TextGenerator（CassetteTextGeneratorなどのラッパーも可）
+        timeout (float): タイムアウト（秒）
+
+    Returns:
+        TextGenerator: コピー。クライアントを持たない場合は元のTextGenerator
+
+    """
+    attributes = vars(text_gen)
+    if "text_gen" in attributes:
+        bounded = copy.copy(text_gen)
+        bounded.text_gen = _with_timeout(attributes["text_gen"], timeout)
+        return bounded
+    if hasattr(attributes.get("client"), "with_options"):
+        bounded = copy.copy(text_gen)
+        bounded.client = attributes["client"].with_options(timeout=timeout, max_retries=0)
+        return bounded
+    return text_gen
+
+
+class LedgerTextGenerator:
+    def __init__(self, text_gen, ledger: UsageLedger, deck_id: str = None, router=None) -> None:
+        """llmxのTextGeneratorをラップしてusageを記録する
+
+        Args:
+            text_gen (TextGenerator): ラップするTextGenerator
+            ledger (UsageLedger): 記録先の台帳
+            deck_id (str): 資料ID（またはセッションID）
+            router (ModelRouter): 段階ごとのモデルの振り分け（未指定の場合はconfigのモデルを使う）
+
+        """
+        self.text_gen = text_gen
+        self.ledger = ledger
+        self.deck_id = deck_id
+        self.router = router
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.text_gen, name)
+
+    @contextmanager
+    def stage(self, name: str, deadline=None):
+        """このスレッドの呼び出しを処理段階として記録する
+
+        Args:
+            name (str): 処理段階
+            deadline (Deadline): 呼び出しのタイムアウトに使う制限時間（未指定の場合はクライアントの設定のまま）
+
+        """
+        previous = getattr(self._local, "stage", None), getattr(self._local, "deadline", None)
+        self._local.stage, self._local.deadline = name, deadline
+        try:
+            yield self
+        finally:
+            self._local.stage, self._local.deadline = previous
+
+    def current_stage(self) -> str:
+        return getattr(self._local, "stage", None) or "lida"
+
+    def generate(self, messages, config, **kwargs):
+        stage = self.current_stage()
+        deadline = getattr(self._local, "deadline", None)
+
+        def call(model):
+            # 置き換えられたリクエストは、LLMを呼ぶ前と応答を受け取った後（LIDAがコードを実行する前）に止める
+            raise_if_cancelled()
+            routed = config if model == config.model else replace(config, model=model)
+            text_gen = self.text_gen
+            if deadline is not None and deadline.bounded:
+                # 制限時間の残りをタイムアウトにする（時間がない場合はDeadlineExceeded）
+                text_gen = _with_timeout(text_gen, deadline.timeout())
+            start = time.time()
+            response = text_gen.generate(messages=messages, config=routed, **kwargs)
+            self.ledger.record(
+                deck_id=self.deck_id,
+                stage=stage,
+                model=model,
+                usage=response.usage,
+                latency=time.time() - start,
+            )
+            raise_if_cancelled()
+            return response
+
+        if self.router is None:
+            return call(config.model)
+        return self.router.run_sync(stage, config.model, call)
+
+
+_default_ledger = None
+_default_lock = threading.Lock()
+
+
+def ledger_from_env() -> UsageLedger:
+    """プロセス共通のUsageLedgerを取得（上限は環境変数DECK_TOKEN_BUDGET）
+
+    Returns:
+        UsageLedger: 共通の台帳
+
+    """
+    global _default_ledger
+    with _default_lock:
+        if _default_ledger is None:
+            budget = os.getenv("DECK_TOKEN_BUDGET")
+            _default_ledger = UsageLedger(token_budget=int(budget) if budget else None)
+            metrics.register("usage", _default_ledger.report)
+    return _default_ledger
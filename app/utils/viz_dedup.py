@@ -0,0 +1,131 @@
+import base64
+import hashlib
+import io
+import logging
+import re
+import threading
+import tokenize
+from PIL import Image
+from utils import metrics
+
+HASH_SIZE = 8
+# dHash（64ビット）のハミング距離がこれ以下なら同じグラフとみなす
+MAX_DISTANCE = 6
+
+
+def dhash(raster: str, size: int = HASH_SIZE) -> int:
+    """base64のPNGから差分ハッシュ（dHash）を計算
+
+    Args:
+        raster (str): base64でエンコードされた画像
+        size (int): ハッシュの一辺（size * sizeビット）
+
+    Returns:
+        int: ハッシュ値
+
+    """
+    with Image.open(io.BytesIO(base64.b64decode(raster))) as image:
+        # PNGの透明部分は白として扱う
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, "white")
+        background.alpha_composite(image)
+        pixels = list(background.convert("L").resize((size + 1, size), Image.BILINEAR).getdata())
+
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left, right = pixels[row * (size + 1) + col], pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def code_fingerprint(code: str) -> str:
+    """コメント・空白・改行を除いて正規化したコードのハッシュ
+
+    Args:
+        code (str): グラフを生成したコード
+
+    Returns:
+        str: ハッシュ値
+
+    """
+    try:
+        tokens = [
+            token.string for token in tokenize.generate_tokens(io.StringIO(code).readline)
+            if token.type not in (tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER)
+        ]
+        normalized = " ".join(tokens)
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        normalized = re.sub(r"#.*", "", code)
+        normalized = re.sub(r"\s+", " ", normalized).strip()
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+class DedupStats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counts = {"candidates": 0, "duplicates_by_code": 0, "duplicates_by_image": 0, "replacements": 0}
+
+    def add(self, **counts) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                self._counts[name] += value
+
+    def report(self) -> dict:
+        with self._lock:
+            result = dict(self._counts)
+        duplicates = result["duplicates_by_code"] + result["duplicates_by_image"]
+        result["duplicate_rate"] = round(duplicates / result["candidates"], 3) if result["candidates"] else None
+        return result
+
+
+stats = DedupStats()
+metrics.register("viz_dedup", stats.report)
+
+
+def dedup_visualizations(visualizations: list, max_distance: int = MAX_DISTANCE, seen: list = None) -> list:
+    """ほぼ同じグラフを除く（最初に出てきたものを残す）
+
+    コードを正規化したハッシュが同じもの、または画像のdHashが近いものを重複とみなす。
+    画像がない（実行に失敗した）グラフはコードだけで判定する。
+
+    Args:
+        visualizations (list): LIDAのChartExecutorResponseのリスト
+        max_distance (int): 同じグラフとみなすdHashのハミング距離
+        seen (list): 既に採用したグラフ（補充分の判定に使用）
+
+    Returns:
+        list: 重複を除いたリスト
+
+    """
+    fingerprints = set()
+    hashes = []
+    for viz in seen or []:
+        fingerprints.add(code_fingerprint(viz.code or ""))
+        if viz.raster:
+            hashes.append(dhash(viz.raster))
+
+    unique = []
+    by_code = by_image = 0
+    for viz in visualizations:
+        fingerprint = code_fingerprint(viz.code or "")
+        if fingerprint in fingerprints:
+            by_code += 1
+            continue
+        if viz.raster:
+            value = dhash(viz.raster)
+            if any(hamming(value, other) <= max_distance for other in hashes):
+                by_image += 1
+                continue
+            hashes.append(value)
+        fingerprints.add(fingerprint)
+        unique.append(viz)
+
+    stats.add(candidates=len(visualizations), duplicates_by_code=by_code, duplicates_by_image=by_image)
+    if by_code or by_image:
+        logging.info(f"Removed duplicate visualizations: {by_code} by code, {by_image} by image ({len(unique)}/{len(visualizations)} kept)")
+    return unique
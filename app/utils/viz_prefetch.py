@@ -0,0 +1,188 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import metrics
+from utils.graph_tasks import GraphTask, TaskCancelled, running
+
+# 取りに来ないセッションの先読みを破棄するまでの時間（秒）
+DEFAULT_TTL = 600
+
+
+class PrefetchTask(GraphTask):
+    def __init__(self, session_id: str, goal, over_budget) -> None:
+        """ゴール1つ分の先読み。取り消された場合に加えて、先読みの予算を使い切った場合も次のLLMの呼び出しの前後で止まる
+
+        Args:
+            session_id (str): セッションID
+            goal: ゴール
+            over_budget (callable): 予算を使い切った場合にTrueを返す関数
+
+        """
+        super().__init__(session_id, "viz_prefetch", (goal,))
+        self.over_budget = over_budget
+
+    def cancel_requested(self) -> bool:
+        return super().cancel_requested() or self.over_budget()
+
+
+class VisualizationPrefetcher:
+    def __init__(self, max_workers: int = 2, token_budget: int = None, ttl: float = DEFAULT_TTL) -> None:
+        """ゴールが生成された時点で、すべてのゴールのグラフをバックグラウンドで先に生成する
+
+        Args:
+            max_workers (int): 同時に生成するゴール数（全セッション共通）
+            token_budget (int): 1回の先読みで使うトークン数の上限（Noneの場合は無制限）
+            ttl (float): 取りに来ないセッションの先読みを保持する時間（秒）
+
+        """
+        self.token_budget = token_budget
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="viz-prefetch")
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._counts = {"started": 0, "hits": 0, "misses": 0, "cancelled": 0, "stopped": 0, "skipped_budget": 0, "stopped_budget": 0, "expired": 0}
+
+    def _count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counts[name] += value
+
+    def _sweep(self) -> None:
+        # 先読みした結果（base64の画像を含む）が残り続けないように、古いセッションの分を破棄
+        now = time.time()
+        with self._lock:
+            expired = [session_id for session_id, (_, _, started_at) in self._sessions.items() if now - started_at > self.ttl]
+        for session_id in expired:
+            self.cancel(session_id)
+        if expired:
+            self._count("expired", len(expired))
+
+    def start(self, session_id: str, gg, manager, summary, goals: list, **params) -> None:
+        """ゴールごとのグラフ生成を開始（同じセッションの前回の先読みは取り消す）
+
+        Args:
+            session_id (str): セッションID
+            gg (GraphGeneration): グラフ生成
+            manager (Manager): LIDAのManager
+            summary (dict): データの要約
+            goals (list): ゴール（generate_visualizationsに渡すのと同じ値）
+            **params: generate_visualizationsのその他の引数（model, num_visualizations, temperature, use_cache, library, fill）
+
+        """
+        self._sweep()
+        self.cancel(session_id)
+        baseline = gg.ledger.used_tokens(session_id)
+        # 予算は開始時だけでなく、LLMを呼ぶたびに確認する（実行中の先読みも上限を超えない）
+        over_budget = lambda: self.token_budget is not None and gg.ledger.used_tokens(session_id) - baseline >= self.token_budget
+        jobs = {}
+        for goal in goals:
+            task = PrefetchTask(session_id, goal, over_budget)
+            jobs[goal] = (task, self._executor.submit(self._generate, task, gg, manager, summary, goal, params))
+        with self._lock:
+            self._sessions[session_id] = (params, jobs, time.time())
+        logging.info(f"Prefetching visualizations for {len(goals)} goals")
+
+    def _generate(self, task: PrefetchTask, gg, manager, summary, goal, params: dict):
+        if task.over_budget():
+            # 先読みの予算を使い切った場合は、ユーザーが選んだときに生成する
+            self._count("skipped_budget")
+            return None
+        self._count("started")
+        start = time.time()
+        try:
+            with running(task):
+                visualizations = gg.generate_visualizations(manager=manager, summary=summary, goal=goal, **params)
+        except TaskCancelled:
+            self._count("stopped_budget" if task.over_budget() else "stopped")
+            logging.info(f"Stopped prefetch for goal '{goal}'. Time taken: {time.time() - start}")
+            return None
+        logging.info(f"Prefetched visualizations for goal '{goal}'. Time taken: {time.time() - start}")
+        return visualizations
+
+    def take(self, session_id: str, goal, timeout: float = None, **params):
+        """先読みしたグラフを取得し、選ばれなかったゴールの生成を取り消す（取得後はセッションの先読みを破棄）
+
+        Args:
+            session_id (str): セッションID
+            goal: 選ばれたゴール
+            timeout (float): 生成中の場合に待つ時間（秒）
+            **params: generate_visualizationsのその他の引数（先読み時と異なる場合は使わない）
+
+        Returns:
+            list: 生成されたグラフ。先読みしていない場合はNone
+
+        """
+        self._sweep()
+        with self._lock:
+            prefetched, jobs, _ = self._sessions.get(session_id, (None, {}, None))
+        _, future = jobs.get(goal, (None, None))
+        self.cancel(session_id, keep=goal)
+
+        if future is None or prefetched != params:
+            self.cancel(session_id)
+            self._count("misses")
+            return None
+        try:
+            visualizations = future.result(timeout=timeout)
+        except Exception as e:
+            logging.warning(f"Prefetch failed for goal '{goal}': {e}")
+            visualizations = None
+        finally:
+            # 選ばれたゴールの結果は呼び出し元に渡したので、他のゴールの結果と合わせて破棄
+            self.cancel(session_id)
+        self._count("hits" if visualizations is not None else "misses")
+        return visualizations
+
+    def cancel(self, session_id: str, keep=None) -> None:
+        """先読みを取り消す（未開始のものは実行せず、実行中のものは次のLLMの呼び出しの前後で止める）
+
+        Args:
+            session_id (str): セッションID
+            keep: 取り消さないゴール。Noneの場合はセッションの先読みをすべて破棄
+
+        """
+        with self._lock:
+            if keep is None:
+                _, jobs, _ = self._sessions.pop(session_id, (None, {}, None))
+            else:
+                _, jobs, _ = self._sessions.get(session_id, (None, {}, None))
+            removed = {goal: jobs.pop(goal) for goal in list(jobs) if goal != keep}
+        cancelled = []
+        for goal, (task, future) in removed.items():
+            if not future.done():
+                task.cancel()
+                future.cancel()
+                cancelled.append(goal)
+        if cancelled:
+            self._count("cancelled", len(cancelled))
+
+    def metrics(self) -> dict:
+        with self._lock:
+            result = dict(self._counts)
+            result["sessions"] = len(self._sessions)
+        return result
+
+
+_default_prefetcher = None
+_default_lock = threading.Lock()
+
+
+def prefetcher_from_env() -> VisualizationPrefetcher:
+    """プロセス共通のVisualizationPrefetcherを取得（環境変数VIZ_PREFETCH_WORKERS, VIZ_PREFETCH_TOKEN_BUDGET, VIZ_PREFETCH_TTL）
+
+    Returns:
+        VisualizationPrefetcher: 共通の先読み
+
+    """
+    global _default_prefetcher
+    with _default_lock:
+        if _default_prefetcher is None:
+            budget = os.getenv("VIZ_PREFETCH_TOKEN_BUDGET")
+            _default_prefetcher = VisualizationPrefetcher(
+                max_workers=int(os.getenv("VIZ_PREFETCH_WORKERS", "2")),
+                token_budget=int(budget) if budget else None,
+                ttl=float(os.getenv("VIZ_PREFETCH_TTL", DEFAULT_TTL)),
+            )
+            metrics.register("viz_prefetch", _default_prefetcher.metrics)
+    return _default_prefetcher
@@ -0,0 +1,104 @@
+import asyncio
+import threading
+import time
+import pytest
+from utils.hedging import RequestHedger
+
+
+def slow_then_fast(latencies):
+    # 呼び出しごとにlatenciesの順で応答する（ヘッジした2回目を速くする）
+    calls = []
+    lock = threading.Lock()
+
+    def request():
+        with lock:
+            index = len(calls)
+            calls.append(index)
+        time.sleep(latencies[min(index, len(latencies) - 1)])
+        return index
+
+    return request, calls
+
+
+def test_slow_request_is_hedged_and_hedge_wins():
+    hedger = RequestHedger(initial_delay=0.05)
+    request, calls = slow_then_fast([0.5, 0.01])
+
+    assert hedger.run_sync(request, stage="content", deck_id="deck") == 1
+    assert len(calls) == 2
+    assert hedger.stats == {"calls": 1, "hedged": 1, "hedge_won": 1, "budget_exhausted": 0}
+
+
+def test_request_without_deck_id_is_not_hedged():
+    hedger = RequestHedger(initial_delay=0.05)
+    request, calls = slow_then_fast([0.2, 0.01])
+
+    assert hedger.run_sync(request, stage="content") == 0
+    assert len(calls) == 1
+    assert hedger.stats["hedged"] == 0
+
+
+def test_extra_requests_are_limited_per_deck_until_released():
+    hedger = RequestHedger(initial_delay=0.05, max_extra_requests=2)
+
+    assert [hedger._take_budget("deck") for _ in range(3)] == [True, True, False]
+    # 他の資料の上限は別に数える
+    assert hedger._take_budget("other")
+    assert hedger.stats["budget_exhausted"] == 1
+
+    hedger.release_deck("deck")
+    assert hedger._take_budget("deck")
+
+
+def test_exhausted_budget_waits_for_primary():
+    hedger = RequestHedger(initial_delay=0.05, max_extra_requests=1)
+    request, calls = slow_then_fast([0.2, 0.01, 0.2, 0.01])
+
+    hedger.run_sync(request, stage="content", deck_id="deck")
+    calls.clear()
+    assert hedger.run_sync(request, stage="content", deck_id="deck") == 0
+    assert len(calls) == 1
+    assert hedger.stats["budget_exhausted"] == 1
+
+
+def test_threshold_learns_from_end_to_end_latency():
+    hedger = RequestHedger(initial_delay=10, min_delay=0.01, min_samples=3)
+    for _ in range(3):
+        hedger.run_sync(lambda: time.sleep(0.05), stage="chart", deck_id="deck")
+
+    assert 0.05 <= hedger.threshold("chart") < 1
+    assert hedger.threshold("content") == 10
+
+
+def test_async_hedge_cancels_losing_request():
+    hedger = RequestHedger(initial_delay=0.05)
+    cancelled = []
+
+    async def request(latency):
+        try:
+            await asyncio.sleep(latency)
+            return latency
+        except asyncio.CancelledError:
+            cancelled.append(latency)
+            raise
+
+    latencies = iter([0.5, 0.01])
+
+    async def main():
+        result = await hedger.run(lambda: request(next(latencies)), stage="chart", deck_id="deck")
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(main()) == 0.01
+    assert cancelled == [0.5]
+
+
+def test_error_is_raised_when_every_attempt_fails():
+    hedger = RequestHedger(initial_delay=0.05)
+
+    def request():
+        time.sleep(0.1)
+        raise RuntimeError("upstream failed")
+
+    with pytest.raises(RuntimeError, match="upstream failed"):
+        hedger.run_sync(request, stage="content", deck_id="deck")
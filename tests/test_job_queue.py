@@ -0,0 +1,118 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import pytest
+from utils.job_queue import DONE, LEASE_TTL, QUEUED, RUNNING, JobQueue
+
+
+class FakeDeck:
+    def __init__(self, slides: int = 3, large: bool = False) -> None:
+        self.slides = [None] * slides
+        self.large = large
+        self.degradations = []
+
+    def write_to(self, path: str) -> None:
+        with open(path, "wb") as f:
+            f.write(b"pptx")
+
+    def persist_images(self, directory: str) -> None:
+        pass
+
+
+class Runner:
+    def __init__(self, release: threading.Event = None) -> None:
+        self.release = release
+        self.job_ids = []
+        self._lock = threading.Lock()
+
+    def __call__(self, params, job_id, progress, deadline):
+        with self._lock:
+            self.job_ids.append(job_id)
+        if self.release is not None:
+            self.release.wait(5)
+        return FakeDeck(large=params.get("large", False))
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return {"db_path": str(tmp_path / "jobs.sqlite3"), "output_dir": str(tmp_path / "jobs"), "static_dir": str(tmp_path / "static")}
+
+
+def wait_for(queue, job_id, status, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = queue.get(job_id)
+        if job["status"] == status:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"Job {job_id} is {queue.get(job_id)['status']}, expected {status}")
+
+
+def insert_job(db_path, job_id, status, updated_at):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, owner, status, params, progress, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, "owner", status, json.dumps({}), json.dumps({"stage": status}), updated_at, updated_at),
+        )
+
+
+def test_submitted_job_runs_once(paths):
+    runner = Runner()
+    queue = JobQueue(runner=runner, **paths)
+
+    job_id = queue.submit({"title": "t"}, owner="owner")
+    job = wait_for(queue, job_id, DONE)
+
+    assert runner.job_ids == [job_id]
+    assert job["progress"]["download"] is None
+    assert os.path.exists(queue.result_path(job_id))
+    assert [job["id"] for job in queue.list_jobs("owner")] == [job_id]
+
+
+def test_job_is_claimed_by_one_worker_only(paths):
+    release = threading.Event()
+    runner = Runner(release)
+    queue = JobQueue(runner=runner, **paths)
+    other = JobQueue(runner=runner, max_workers=1, **paths)
+
+    job_id = queue.submit({"title": "t"})
+    wait_for(queue, job_id, RUNNING)
+    # 別のワーカー（レプリカ）が同じジョブを取得しようとしても実行しない
+    assert not other._claim(job_id)
+    other._run(job_id)
+    release.set()
+    wait_for(queue, job_id, DONE)
+
+    assert runner.job_ids == [job_id]
+    assert not queue._claim(job_id)
+
+
+def test_stale_running_job_is_requeued_on_start(paths):
+    # 停止したプロセスで実行中のまま残ったジョブと、他のレプリカが実行中（ハートビートが新しい）のジョブ
+    JobQueue(runner=Runner(), **paths)
+    insert_job(paths["db_path"], "stale", RUNNING, time.time() - LEASE_TTL - 1)
+    insert_job(paths["db_path"], "alive", RUNNING, time.time())
+    insert_job(paths["db_path"], "queued", QUEUED, time.time())
+
+    runner = Runner()
+    queue = JobQueue(runner=runner, **paths)
+    wait_for(queue, "stale", DONE)
+    wait_for(queue, "queued", DONE)
+
+    assert sorted(runner.job_ids) == ["queued", "stale"]
+    assert queue.get("alive")["status"] == RUNNING
+
+
+def test_large_deck_is_published_under_random_name_and_expires(paths):
+    queue = JobQueue(runner=Runner(), static_ttl=0.2, **paths)
+
+    job = wait_for(queue, queue.submit({"large": True}, owner="owner"), DONE)
+    download = job["progress"]["download"]
+
+    assert job["id"] not in download
+    assert queue.download_path(job) == os.path.join(paths["static_dir"], download)
+    time.sleep(0.3)
+    queue.list_jobs("owner")
+    assert queue.download_path(job) is None
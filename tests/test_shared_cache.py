@@ -0,0 +1,140 @@
+import threading
+import time
+import pytest
+from utils.shared_cache import LocalRespServer, RedisBackend, SharedCache, SQLiteBackend
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return SQLiteBackend(str(tmp_path / "cache.sqlite3"))
+
+
+def slow_compute(calls, value="value", seconds=0.3):
+    def compute():
+        calls.append(threading.current_thread().name)
+        time.sleep(seconds)
+        return value
+    return compute
+
+
+def run_threads(targets):
+    results = [None] * len(targets)
+
+    def run(i, target):
+        results[i] = target()
+
+    threads = [threading.Thread(target=run, args=(i, target)) for i, target in enumerate(targets)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_requests_in_one_process_compute_once(backend):
+    cache = SharedCache(backend)
+    calls = []
+    key = cache.key("content", "request")
+
+    results = run_threads([lambda: cache.get_or_compute(key, slow_compute(calls))] * 4)
+
+    assert results == ["value"] * 4
+    assert len(calls) == 1
+    assert cache.metrics()["coalesced"] == 3
+    assert cache.get(key) == (True, "value")
+
+
+def test_concurrent_requests_across_replicas_compute_once(backend):
+    # 同じバックエンドを使う別々のSharedCacheは、別のレプリカのようにロックキーで待ち合わせる
+    replicas = [SharedCache(backend, poll_interval=0.05) for _ in range(3)]
+    calls = []
+    key = replicas[0].key("content", "request")
+
+    results = run_threads([lambda cache=cache: cache.get_or_compute(key, slow_compute(calls)) for cache in replicas])
+
+    assert results == ["value"] * 3
+    assert len(calls) == 1
+    assert sum(cache.metrics()["remote_waits"] for cache in replicas) == 2
+
+
+def test_expired_lock_of_crashed_replica_is_taken_over(backend):
+    cache = SharedCache(backend, lock_ttl=0.5, poll_interval=0.05)
+    key = cache.key("content", "request")
+    # 計算中に落ちたレプリカのロック（外されないまま残る）
+    assert backend.add(f"{key}:lock", b"crashed", 0.5)
+
+    start = time.time()
+    calls = []
+    assert cache.get_or_compute(key, slow_compute(calls, seconds=0)) == "value"
+
+    assert len(calls) == 1
+    assert 0.4 < time.time() - start < 2
+    # 自分のロックは外し、計算結果は保存する
+    assert backend.get(f"{key}:lock") is None
+    assert cache.get(key) == (True, "value")
+
+
+def test_uncacheable_value_is_computed_again(backend):
+    cache = SharedCache(backend)
+    calls = []
+    key = cache.key("content", "request")
+
+    for _ in range(2):
+        assert cache.get_or_compute(key, slow_compute(calls, "truncated", 0), cacheable=lambda value: value != "truncated") == "truncated"
+
+    assert len(calls) == 2
+    assert cache.get(key) == (False, None)
+
+
+def test_error_is_raised_to_waiting_callers_and_not_cached(backend):
+    cache = SharedCache(backend)
+    key = cache.key("content", "request")
+
+    def fail():
+        time.sleep(0.2)
+        raise RuntimeError("upstream failed")
+
+    def call():
+        try:
+            return cache.get_or_compute(key, fail)
+        except RuntimeError as e:
+            return str(e)
+
+    assert run_threads([call] * 3) == ["upstream failed"] * 3
+    assert cache.get(key) == (False, None)
+    assert backend.get(f"{key}:lock") is None
+
+
+def test_aget_or_compute_coalesces_concurrent_coroutines(backend):
+    import asyncio
+
+    cache = SharedCache(backend)
+    calls = []
+    key = cache.key("chart_code", "request")
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        return "graph TD"
+
+    async def main():
+        return await asyncio.gather(*(cache.aget_or_compute(key, compute) for _ in range(3)))
+
+    assert asyncio.run(main()) == ["graph TD"] * 3
+    assert len(calls) == 1
+
+
+def test_redis_values_are_signed():
+    server = LocalRespServer().start()
+    try:
+        with pytest.raises(ValueError):
+            SharedCache(RedisBackend(server.url))
+
+        writer = SharedCache(RedisBackend(server.url), secret=b"secret")
+        key = writer.key("content", "request")
+        writer.set(key, {"slide1": "title"})
+        assert SharedCache(RedisBackend(server.url), secret=b"secret").get(key) == (True, {"slide1": "title"})
+        # 鍵が異なる（他のホストが書き込んだ）値はunpickleせずに無視する
+        assert SharedCache(RedisBackend(server.url), secret=b"other").get(key) == (False, None)
+    finally:
+        server.stop()
@@ -0,0 +1,64 @@
+import pytest
+from utils.structured_output import SLIDE_SCHEMA, parse_response, repair_json, unwrap_slides, validate
+
+
+def test_valid_json_is_not_repaired():
+    assert repair_json('{"title": "a", "content": ["b"]}') == ({"title": "a", "content": ["b"]}, False)
+
+
+def test_code_fence_and_preamble_are_removed():
+    text = 'Here is the slide:\n```json\n{"title": "a", "content": ["b"]}\n```'
+    assert repair_json(text) == ({"title": "a", "content": ["b"]}, False)
+
+
+def test_trailing_commas_are_removed():
+    assert repair_json('{"content": ["a", "b",], "title": "c",}') == ({"content": ["a", "b"], "title": "c"}, True)
+
+
+def test_unescaped_quotes_in_strings_are_escaped():
+    value, repaired = repair_json('{"title": "「AI"とは", "content": ["a"]}')
+    assert repaired
+    assert value == {"title": '「AI"とは', "content": ["a"]}
+
+
+def test_control_characters_are_removed():
+    assert repair_json('{"title": "a\tb", "content": ["c\nd"]}')[0] == {"title": "ab", "content": ["cd"]}
+
+
+def test_truncated_array_keeps_complete_items():
+    value, repaired = repair_json('{"slide1": {"title": "a", "content": ["b", "c"]}, "slide2": {"title": "d", "content": ["e", "途中で')
+    assert repaired
+    assert value["slide1"] == {"title": "a", "content": ["b", "c"]}
+    assert value["slide2"]["content"][0] == "e"
+
+
+def test_truncated_object_is_closed():
+    assert repair_json('[{"title": "a"}, {"title": "b"') == ([{"title": "a"}, {"title": "b"}], True)
+
+
+@pytest.mark.parametrize("text", ["", "no json here", "{{{:"])
+def test_unrepairable_response_raises(text):
+    with pytest.raises(ValueError):
+        repair_json(text)
+
+
+def test_parse_response_reports_schema_errors():
+    value, errors = parse_response('{"title": "", "content": []}', SLIDE_SCHEMA)
+    assert value == {"title": "", "content": []}
+    assert errors == ["$.title: empty", "$.content: expected at least 1 items"]
+
+    assert parse_response("not json", SLIDE_SCHEMA)[0] is None
+
+
+def test_validate_rejects_wrong_types():
+    assert validate({"title": 1, "content": "a"}, SLIDE_SCHEMA) == ["$.title: expected string, got int", "$.content: expected array, got str"]
+    assert validate({"content": ["a"]}, SLIDE_SCHEMA) == ["$.title: missing"]
+
+
+@pytest.mark.parametrize("value", [
+    {"slide1": {"title": "a"}, "slide2": {"title": "b"}},
+    {"slides": [{"title": "a"}, {"title": "b"}]},
+    [{"title": "a"}, {"title": "b"}],
+])
+def test_unwrap_slides(value):
+    assert unwrap_slides(value) == [{"title": "a"}, {"title": "b"}]